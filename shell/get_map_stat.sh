@@ -21,13 +21,13 @@ cat > qsub_samstat << EOF
 #!/bin/bash
 
 #PBS -l walltime=300:00:00
-#PBS -l nodes=1:ppn=1
+#PBS -l nodes=1:ppn=8
 #PBS -q large
 #PBS -N samStat
 
 cd $PWD
 
-python /chongle/shared/software/pooPy/trunk/src/samStat.py -i $samfile -o$samfile.stat
+python /chongle/shared/software/pooPy/trunk/src/samStat.py -i $samfile -o$samfile.stat -p 8
 
 exit 0;
 
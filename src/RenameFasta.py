@@ -6,16 +6,18 @@
 import re
 import argparse
 import sys
+import gzio
 ## =================================================================
 ## Rename sequence names in fasta file so that paired end reads have different names
 ## with different suffixes: /1, or /2.
 ## =================================================================
 def RenameFasta(fastaFile, outputFile):
+    ''' Input:  fastaFile - fasta file, can be gzip/BGZF compressed
+        Output: outputFile - renamed fasta file, compressed (BGZF) if its name ends in .gz
     '''
-    '''
-    g = open(outputFile,'w')
+    g = gzio.open_output(outputFile)
 
-    with open(fastaFile, 'r') as f:
+    with gzio.open_input(fastaFile) as f:
         for line in f:
             if line[0]=='>':
                 line = line.strip('\n')
@@ -44,7 +46,7 @@ parser = argparse.ArgumentParser(description="Rename sequence names in fasta fil
 parser.add_argument("-i","--in",help="input fasta file",dest='fastaFile',required=True)
 
 ## output directory
-parser.add_argument("-o","--out",help="output statistics file",dest='outputFile',required=True)
+parser.add_argument("-o","--out",help="output fasta file, compressed (BGZF) if it ends in .gz",dest='outputFile',required=True)
 
 ## =================================================================
 ## main function
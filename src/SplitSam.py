@@ -4,65 +4,121 @@ import argparse
 import sys
 import os
 import re 
+import collections
+import samrecord
 ## =================================================================
 ## Split a big alignement .sam file into several files.
 ## One for each reference genome.
-## This might cause problem if there are too many reference sequences.
+## Records are buffered in memory and written through a bounded pool of open files,
+## so there can be many more references than open files.
 ## =================================================================
-def SplitSam(samFile,outputDir,rname=None):
+class SplitWriter(object):
+    ''' Write the records of each reference to its own sam file with a fixed number of open files.
+        Records are kept in memory per reference; when more than bufferSize bytes are buffered, the biggest buffers are written
+        (until half of the budget is free), through a pool of at most maxOpen files where the least recently used file is closed first.
+        Input:  outputDir - directory of the output .sam files
+                headers - dictionary reference name => header lines of its file, only these references are written
+                maxOpen - maximum number of files open at the same time
+                bufferSize - maximum number of bytes of records kept in memory
+    '''
+    def __init__(self, outputDir, headers, maxOpen=256, bufferSize=1<<26):
+        self.outputDir = outputDir
+        self.headers = headers
+        self.maxOpen = max(1, maxOpen)
+        self.bufferSize = bufferSize
+        self.buffers = collections.defaultdict(list) # reference name => buffered lines
+        self.sizes = collections.defaultdict(int) # reference name => buffered bytes
+        self.buffered = 0
+        self.handles = collections.OrderedDict() # open files, least recently used first
+        self.started = set() # references whose header is written
+
+    def file_name(self, rname):
+        return self.outputDir + '/' + re.sub('/','__',rname) + '.sam'
+
+    def _handle(self, rname):
+        ''' Open file of a reference, the least recently used file is closed if too many are open '''
+        handle = self.handles.pop(rname, None)
+        if handle is None:
+            if len(self.handles) >= self.maxOpen:
+                self.handles.popitem(last=False)[1].close()
+            handle = open(self.file_name(rname), 'a')
+        self.handles[rname] = handle # most recently used
+        return handle
+
+    def add(self, rname, line):
+        ''' Buffer a record line of a reference, records of the other references are ignored '''
+        if rname not in self.headers:
+            return
+        self.buffers[rname].append(line)
+        self.sizes[rname] += len(line)
+        self.buffered += len(line)
+        if self.buffered > self.bufferSize:
+            for name in sorted(self.sizes, key=self.sizes.get, reverse=True): # biggest buffers first, for large writes
+                self.flush(name)
+                if self.buffered <= self.bufferSize // 2:
+                    break
+
+    def flush(self, rname):
+        ''' Write the buffered records of a reference (after its header, the first time) '''
+        handle = self._handle(rname)
+        if rname not in self.started:
+            handle.writelines(self.headers[rname])
+            self.started.add(rname)
+        handle.writelines(self.buffers.pop(rname, []))
+        self.buffered -= self.sizes.pop(rname, 0)
+
+    def close(self):
+        ''' Write all the buffered records, and the header of the references without records '''
+        for rname in self.headers:
+            if rname in self.sizes or rname not in self.started:
+                self.flush(rname)
+        for handle in self.handles.itervalues():
+            handle.close()
+        self.handles.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+## =================================================================
+def SplitSam(samFile,outputDir,rname=None,maxOpen=256,bufferSize=1<<26):
     ''' From a sam file generated by aligning reads/contigs to many reference seqs,
         generate one sam file for each reference seq, each includes the reads aligning with it.
         
-        Input:  samFile
+        Input:  samFile - sam or BAM file
+                rname - only write the file of this reference, None for all the references
+                maxOpen - maximum number of output files open at the same time
+                bufferSize - maximum number of bytes of records kept in memory
         Output: outputDir - directory to store the output .sam files.
     '''
     if not os.path.exists(outputDir):
         os.makedirs(outputDir)
     
-    headerLines = '' # common for all .sam files
-    headerLinesWritten = False
-    Refs = dict()
     SQDict = dict()
-    #print rname
-    if not os.path.exists(outputDir):
-        os.mkdir(outputDir)
     HDline = ""
     RGline = ""
     PGline = ""
-    with open(samFile, 'r') as f:
-        for line in f:
-            if line[0]=='@': #header line
-                if line[1:3] == 'HD':
-                    HDline = line
-                elif line[1:3] == 'RG':
-                    RGline = line
-                elif line[1:3] == 'PG':
-                    PGline = line
-                elif line[1:3] == 'SQ':
-                    RefName = line.strip('\n').split('\t')[1][3:] # the name of refseq
-                    if rname != None and RefName == rname:
-                        RefFile = outputDir + '/' + re.sub('/','__',RefName) + '.sam'
-                        RefFileHandle = open(RefFile,'a')
-                        Refs[RefName] = RefFileHandle
-                        SQDict[RefName] = line
-                    elif rname == None:    
-                        RefFile = outputDir + '/' + re.sub('/','__',RefName) + '.sam'
-                        RefFileHandle = open(RefFile,'a')
-                        Refs[RefName] = RefFileHandle
-                        SQDict[RefName] = line
-            else:
-                if not headerLinesWritten: # write the common header lines to each sam file
-                    for key in Refs:
-                        Refs[key].write(HDline + SQDict[key] + RGline + PGline)
-                        #sys.stdout.write(HDline + SQDict[key] + RGline + PGline)
-                    headerLinesWritten = True
-                refName = line.split('\t')[2] # write this line to the corresponding sam file
-                #print refName
-                if Refs.has_key(refName):
-                    Refs[refName].write(line)
-
-    for key in Refs: # finish writing and close the files
-        Refs[key].close()
+    with samrecord.open_sam(samFile) as sam:
+        for line in sam.header_lines: #header line
+            if line[1:3] == 'HD':
+                HDline = line
+            elif line[1:3] == 'RG':
+                RGline = line
+            elif line[1:3] == 'PG':
+                PGline = line
+            elif line[1:3] == 'SQ':
+                RefName = line.strip('\n').split('\t')[1][3:] # the name of refseq
+                if rname == None or RefName == rname:
+                    SQDict[RefName] = line
+        headers = collections.OrderedDict() # the common header lines of each sam file, in header order
+        for key in sam.ref_names:
+            if key in SQDict:
+                headers[key] = [HDline + SQDict[key] + RGline + PGline]
+        with SplitWriter(outputDir, headers, maxOpen, bufferSize) as writer:
+            for record in sam:
+                writer.add(record.rname, record.line) # write this line to the corresponding sam file
 
 ## =================================================================
 ## argument parser
@@ -77,8 +133,10 @@ parser = argparse.ArgumentParser(description="Split a big alignement .sam file i
                                  )
 
 ## input files and directories
-parser.add_argument("-i","--in",help="input sam file",dest='samFile',required=True)
+parser.add_argument("-i","--in",help="input sam or BAM file",dest='samFile',required=True)
 parser.add_argument("-r","--ref",help="reference sequence name to extract",dest='rname',default=None)
+parser.add_argument("--maxOpen",help="maximum number of output files open at the same time",dest='maxOpen',default=256,type=int)
+parser.add_argument("--bufferMB",help="memory (in MB) for the records waiting to be written",dest='bufferMB',default=64,type=int)
 
 ## output directory
 parser.add_argument("-o","--out",help="output directory",dest='outputDir',required=True)
@@ -91,7 +149,7 @@ def main(argv=None):
     if argv is None:
         args = parser.parse_args()
 
-    SplitSam(args.samFile,args.outputDir,args.rname)
+    SplitSam(args.samFile,args.outputDir,args.rname,args.maxOpen,args.bufferMB << 20)
 
 ##==============================================================
 ## call from command line (instead of interactively)
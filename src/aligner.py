@@ -0,0 +1,114 @@
+#!/usr/bin/python
+
+''' Banded global alignment of a short read to a window of the PacBio sequence, used instead of Bio.pairwise2.align.globalms.
+    Scores come from params.py (match 0, mismatch -1, gap -0.9, gap opening costs the same as gap extension). They are scaled
+    to integers so that equally good alignments are recognized exactly. The dynamic programming matrix is filled one row at a time
+    with numpy: with a linear gap penalty, the gaps within a row reduce to a running maximum.
+    Only one optimal alignment is traced back. Walking back from the end, match/mismatch is preferred over gaps,
+    so the indels end up at their leftmost possible positions, which is what pick_align and shift_to_left_chop
+    looked for among all the optimal alignments enumerated by pairwise2.
+'''
+import numpy
+import params
+
+SCORE_SCALE = 10 # scores are multiplied by this to make them integers
+MATCH_SCORE = int(round(params.MATCH_SCORE * SCORE_SCALE))
+MISMATCH_SCORE = int(round(params.MISMATCH_SCORE * SCORE_SCALE))
+GAP_SCORE = int(round(params.GAP_SCORE * SCORE_SCALE))
+NEG_INF = -(1 << 40) # score of the cells outside of the band
+
+## ======================================================================
+def score_matrix(seqA, seqB, penalize_end_gaps=(True, True), band=None):
+    ''' Fill the dynamic programming matrix for the global alignment of seqA and seqB
+        Input:  seqA, seqB - sequences (strings), seqA is the reference (PacBio) part, seqB the read
+                penalize_end_gaps - (for seqA, for seqB), same as in pairwise2: whether gaps at the ends of each sequence are penalized
+                band - maximum distance of the alignment from the diagonals, measured beyond the difference of the sequence lengths. None for the whole matrix
+        Output: H - 2d int64 array (len(seqA)+1, len(seqB)+1), H[i,j] is the best score of aligning seqA[:i] and seqB[:j]
+    '''
+    m = len(seqA)
+    n = len(seqB)
+    a = numpy.frombuffer(seqA, dtype=numpy.uint8)
+    b = numpy.frombuffer(seqB, dtype=numpy.uint8)
+    if band is None: # cell (i, j) is in the band if lo <= i - j <= hi
+        lo = -n
+        hi = m
+    else:
+        lo = min(0, m - n) - band
+        hi = max(0, m - n) + band
+    steps = GAP_SCORE * numpy.arange(n + 1, dtype=numpy.int64) # scores of gaps of length 0 to n
+    H = numpy.empty((m + 1, n + 1), dtype=numpy.int64)
+    H.fill(NEG_INF)
+    jh = min(n, -lo)
+    H[0, :(jh + 1)] = steps[:(jh + 1)] if penalize_end_gaps[0] else 0 # leading gaps in seqA
+    for i in xrange(1, m + 1):
+        jl = max(0, i - hi)
+        jh = min(n, i - lo)
+        if jl > jh:
+            continue
+        prev = H[i - 1]
+        D = prev[jl:(jh + 1)] + GAP_SCORE # gap in seqB
+        dl = max(jl, 1)
+        diag = prev[(dl - 1):jh] + numpy.where(b[(dl - 1):jh] == a[i - 1], MATCH_SCORE, MISMATCH_SCORE) # match or mismatch
+        D[(dl - jl):] = numpy.maximum(D[(dl - jl):], diag)
+        if jl == 0:
+            D[0] = GAP_SCORE * i if penalize_end_gaps[1] else 0 # leading gaps in seqB
+        # gaps in seqA: H[i,j] = max over k <= j of D[k] + GAP_SCORE * (j - k)
+        H[i, jl:(jh + 1)] = numpy.maximum.accumulate(D - steps[jl:(jh + 1)]) + steps[jl:(jh + 1)]
+    return H
+## ======================================================================
+def global_align(seqA, seqB, penalize_end_gaps=(True, True), band=None):
+    ''' Global alignment with the leftmost indel positions among the optimal alignments
+        Input:  seqA, seqB, penalize_end_gaps, band - same as score_matrix
+        Output: (seqA, seqB, score, begin, end) - same format as one alignment from pairwise2.align.globalms, gaps shown as '-'
+    '''
+    m = len(seqA)
+    n = len(seqB)
+    H = score_matrix(seqA, seqB, penalize_end_gaps, band)
+    # find the ending cell, free ending gaps allow the alignment to end in the last row or column
+    ie, je = m, n
+    best = H[m, n]
+    if not penalize_end_gaps[1]: # free ending gaps in seqB, alignment can end before the end of seqA
+        i = m - int(numpy.argmax(H[::-1, n])) # last row with the best score
+        if H[i, n] > best:
+            ie, je, best = i, n, H[i, n]
+    if not penalize_end_gaps[0]: # free ending gaps in seqA
+        j = int(numpy.argmax(H[m, :]))
+        if H[m, j] > best:
+            ie, je, best = m, j, H[m, j]
+    alignA = []
+    alignB = []
+    # ending gaps
+    for i in xrange(m - 1, ie - 1, -1):
+        alignA.append(seqA[i])
+        alignB.append('-')
+    for j in xrange(n - 1, je - 1, -1):
+        alignA.append('-')
+        alignB.append(seqB[j])
+    i, j = ie, je
+    while i > 0 and j > 0:
+        h = H[i, j]
+        if h == H[i - 1, j - 1] + (MATCH_SCORE if seqA[i - 1] == seqB[j - 1] else MISMATCH_SCORE): # prefer match/mismatch, so gaps are pushed to the left
+            i -= 1
+            j -= 1
+            alignA.append(seqA[i])
+            alignB.append(seqB[j])
+        elif h == H[i - 1, j] + GAP_SCORE: # gap in seqB
+            i -= 1
+            alignA.append(seqA[i])
+            alignB.append('-')
+        else: # gap in seqA
+            j -= 1
+            alignA.append('-')
+            alignB.append(seqB[j])
+    # opening gaps
+    while i > 0:
+        i -= 1
+        alignA.append(seqA[i])
+        alignB.append('-')
+    while j > 0:
+        j -= 1
+        alignA.append('-')
+        alignB.append(seqB[j])
+    alignA = ''.join(reversed(alignA))
+    alignB = ''.join(reversed(alignB))
+    return (alignA, alignB, best / float(SCORE_SCALE), 0, len(alignA))
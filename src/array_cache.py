@@ -0,0 +1,107 @@
+#!/usr/bin/python
+
+''' On-disk cache of the arrays metalrec computes before filling the gaps, so that a run killed by the wall time (or out of memory)
+    and runs with other minOverlap/minOverlapRatio values can start at fill_gap instead of processing the sam file again.
+    The arrays of a PacBio read are kept as .npy files in a directory named after the sha1 digest of the sequence file, the sam file,
+    and the parameters used before fill_gap, so changing any of them starts a new cache:
+            pileup: ref_bps.npy, ins_pos.npy, ins_ptr.npy, ins_counts.npy
+            each good region i: region<i>.type.npy, region<i>.counts.npy, region<i>.starts.npy, region<i>.ptr.npy, region<i>.codes.npy, region<i>.npos.npy
+    Every file is written to a temporary name and renamed, and the last file of a group marks it as complete,
+    so a run killed while writing never leaves a partial entry behind. The arrays are loaded as copy-on-write memory maps.
+'''
+import os
+import hashlib
+import numpy
+import pileup
+import banded_array
+
+CACHE_VERSION = 2 # change when the cached arrays change meaning
+KEY_PARAMS = ('maxSub', 'maxIns', 'maxDel', 'maxSubRate', 'maxInDelRate', 'minPacBioLen', 'checkEnds', 'minGoodLen', 'minCV') # parameters used before fill_gap
+
+## ======================================================================
+def file_digest(fileName, digest, block_size=1048576):
+    ''' Update a hashlib digest with the content of a file '''
+    with open(fileName, 'rb') as f:
+        block = f.read(block_size)
+        while block:
+            digest.update(block)
+            block = f.read(block_size)
+## ======================================================================
+def cache_key(seqFile, samFile, params, refName=None):
+    ''' Hex digest of the input files and the parameters (dictionary name => value).
+        When only the alignments to refName are used, the (big) sam file is identified by its size and modification time instead of its content.
+    '''
+    digest = hashlib.sha1()
+    digest.update('metalrec array cache {}\n'.format(CACHE_VERSION))
+    file_digest(seqFile, digest)
+    if refName is None:
+        file_digest(samFile, digest)
+    else:
+        stat = os.stat(samFile)
+        digest.update('{} {} {!r}\n'.format(stat.st_size, stat.st_mtime, refName))
+    for name in sorted(params):
+        digest.update('{}={!r}\n'.format(name, params[name]))
+    return digest.hexdigest()
+## ======================================================================
+class ArrayCache(object):
+    ''' Cached arrays of one PacBio read '''
+    def __init__(self, cacheDir, key):
+        self.dir = os.path.join(os.path.abspath(cacheDir), key)
+        if not os.path.exists(self.dir):
+            try:
+                os.makedirs(self.dir)
+            except OSError: # made by another process in the meantime
+                if not os.path.isdir(self.dir):
+                    raise
+
+    @classmethod
+    def for_args(cls, args):
+        ''' Cache for the input files and thresholds of metalrec options args, in directory args.cacheDir '''
+        params = dict((name, getattr(args, name)) for name in KEY_PARAMS)
+        return cls(args.cacheDir, cache_key(args.seqFile, args.samFile, params, getattr(args, 'refName', None)))
+
+    def _path(self, name):
+        return os.path.join(self.dir, name + '.npy')
+
+    def _save(self, name, array):
+        tmpFile = '{}.{}.tmp'.format(self._path(name), os.getpid())
+        with open(tmpFile, 'wb') as f:
+            numpy.save(f, numpy.ascontiguousarray(array))
+        os.rename(tmpFile, self._path(name))
+
+    def _load(self, name):
+        return numpy.load(self._path(name), mmap_mode='c') # changes stay in memory, the file is not written
+
+    def has_pileup(self):
+        return os.path.exists(self._path('ref_bps'))
+
+    def save_pileup(self, ref_bps, ref_ins_dict):
+        ''' Save the base call counts and the pileup.InsertionTable '''
+        self._save('ins_pos', ref_ins_dict.pos)
+        self._save('ins_ptr', ref_ins_dict.ptr)
+        self._save('ins_counts', ref_ins_dict.counts)
+        self._save('ref_bps', ref_bps) # written last, marks the pileup as complete
+
+    def load_pileup(self):
+        ''' Output: ref_bps, ref_ins_dict - same as from metalrec_lib.read_and_process_sam_samread '''
+        ref_ins_dict = pileup.InsertionTable(self._load('ins_pos'), self._load('ins_ptr'), self._load('ins_counts'))
+        return self._load('ref_bps'), ref_ins_dict
+
+    def has_region(self, good_region_index):
+        return os.path.exists(self._path('region{}.npos'.format(good_region_index)))
+
+    def save_region(self, good_region_index, type_array, read_array, read_counts):
+        ''' Save the type array and the banded read array (with the read counts) of a good region '''
+        prefix = 'region{}.'.format(good_region_index)
+        self._save(prefix + 'type', type_array)
+        self._save(prefix + 'counts', read_counts)
+        self._save(prefix + 'starts', read_array.starts)
+        self._save(prefix + 'ptr', read_array.ptr)
+        self._save(prefix + 'codes', read_array.codes)
+        self._save(prefix + 'npos', numpy.array([read_array.npos], dtype=numpy.int64)) # written last, marks the region as complete
+
+    def load_region(self, good_region_index):
+        ''' Output: type_array, read_array (banded_array.BandedReadArray), read_counts - same as computed in metalrec.correct_region '''
+        prefix = 'region{}.'.format(good_region_index)
+        read_array = banded_array.BandedReadArray(self._load(prefix + 'starts'), self._load(prefix + 'ptr'), self._load(prefix + 'codes'), self._load(prefix + 'npos')[0])
+        return self._load(prefix + 'type'), read_array, self._load(prefix + 'counts')
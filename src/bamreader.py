@@ -0,0 +1,243 @@
+#!/usr/bin/python
+
+''' Reading BAM files with zlib and struct only, without pysam or samtools view.
+    A BAM file is a series of BGZF blocks: gzip members of at most 64KB of data, each with its compressed size in the gzip header,
+    so the blocks can be found without inflating them. BgzfReader gives file-like read() access to the uncompressed stream;
+    with threads > 1 a batch of blocks is inflated by a pool of threads (zlib releases the GIL while inflating).
+    read_header and raw_records decode the BAM layout on top of it, and the functions below decode the fields of one record.
+    samrecord.BamRecord gives a binary record the same interface as a sam line.
+'''
+import struct
+import zlib
+import collections
+from multiprocessing.pool import ThreadPool
+
+BGZF_MAGIC = '\x1f\x8b\x08\x04' # gzip member with the FEXTRA flag
+BAM_MAGIC = 'BAM\x01'
+CORE = struct.Struct('<iiBBHHHiiii') # refID, pos, l_read_name, mapq, bin, n_cigar_op, flag, l_seq, next_refID, next_pos, tlen
+CIGAR_OPS = 'MIDNSHP=X'
+SEQ_BASES = '=ACMGRSVTWYHKDBN'
+SEQ_PAIRS = [SEQ_BASES[code >> 4] + SEQ_BASES[code & 15] for code in xrange(256)] # one byte => the two bases it encodes
+QUAL_CHARS = ''.join([chr((code + 33) % 256) for code in xrange(256)]) # translation table, phred quality => sam character
+TAG_TYPES = {'c': ('i', 'b'), 'C': ('i', 'B'), 's': ('i', 'h'), 'S': ('i', 'H'), 'i': ('i', 'i'), 'I': ('i', 'I'), 'f': ('f', 'f')} # binary type => (sam type, struct format)
+
+## ======================================================================
+def is_bgzf(fileName):
+    ''' True if the file starts with a BGZF block (e.g. a BAM file) '''
+    with open(fileName, 'rb') as f:
+        return f.read(4) == BGZF_MAGIC
+## ======================================================================
+def inflate_block(raw_block):
+    ''' Decompress one BGZF block
+        Input:  raw_block - (coffset, cend, cdata, isize) from BgzfReader.read_raw_block
+        Output: (coffset, cend, data)
+    '''
+    coffset, cend, cdata, isize = raw_block
+    data = zlib.decompress(cdata, -15) # raw deflate stream
+    if len(data) != isize:
+        raise IOError("BGZF block at offset {} is corrupted".format(coffset))
+    return coffset, cend, data
+## ======================================================================
+class BgzfReader(object):
+    ''' Uncompressed stream of a BGZF file.
+        Positions are virtual offsets, as in BAM indices: (offset of the block in the file << 16) | offset in the uncompressed block,
+        the end of a block is the start of the next block.
+        Input:  fileName - BGZF file name
+                threads - number of threads inflating blocks
+                batch_blocks - number of blocks read ahead and inflated together when threads > 1
+    '''
+    def __init__(self, fileName, threads=1, batch_blocks=64):
+        self.handle = open(fileName, 'rb')
+        self.pool = ThreadPool(threads) if threads > 1 else None
+        self.batch_blocks = batch_blocks if threads > 1 else 1
+        self._batch = collections.deque() # inflated blocks read ahead, (coffset, cend, data)
+        self._block = '' # current uncompressed block
+        self._block_start = 0 # offset of the current block in the file
+        self._block_end = 0 # offset of the next block in the file
+        self._pos = 0 # offset in the current block
+
+    def read_raw_block(self):
+        ''' Next compressed block in the file, (coffset, cend, cdata, isize), None at the end of the file.
+            coffset and cend are the offsets of this block and the next block in the file
+        '''
+        coffset = self.handle.tell()
+        header = self.handle.read(12)
+        if len(header) == 0:
+            return None
+        if len(header) < 12 or header[:4] != BGZF_MAGIC:
+            raise IOError("no BGZF block at offset {}".format(coffset))
+        xlen = struct.unpack('<H', header[10:12])[0]
+        extra = self.handle.read(xlen)
+        bsize = None
+        i = 0
+        while i + 4 <= len(extra): # extra subfields: SI1, SI2, SLEN, data
+            slen = struct.unpack('<H', extra[(i + 2):(i + 4)])[0]
+            if extra[i:(i + 2)] == 'BC':
+                bsize = struct.unpack('<H', extra[(i + 4):(i + 6)])[0] # total block size - 1
+            i += 4 + slen
+        if bsize is None:
+            raise IOError("gzip member at offset {} is not a BGZF block".format(coffset))
+        rest = self.handle.read(bsize + 1 - 12 - xlen) # compressed data, CRC32 and ISIZE
+        return coffset, coffset + bsize + 1, rest[:-8], struct.unpack('<I', rest[-4:])[0]
+
+    def _next_block(self):
+        ''' Move to the next non-empty block, False at the end of the file '''
+        while True:
+            if len(self._batch) == 0:
+                raw_blocks = []
+                while len(raw_blocks) < self.batch_blocks:
+                    raw_block = self.read_raw_block()
+                    if raw_block is None:
+                        break
+                    raw_blocks.append(raw_block)
+                if len(raw_blocks) == 0:
+                    return False
+                if self.pool is not None:
+                    self._batch.extend(self.pool.map(inflate_block, raw_blocks))
+                else:
+                    self._batch.extend(map(inflate_block, raw_blocks))
+            self._block_start, self._block_end, self._block = self._batch.popleft()
+            self._pos = 0
+            if len(self._block) > 0: # the end-of-file marker is an empty block
+                return True
+
+    def read(self, size):
+        ''' Next size uncompressed bytes, fewer at the end of the file '''
+        end = self._pos + size
+        if end <= len(self._block): # within the current block
+            data = self._block[self._pos:end]
+            self._pos = end
+            return data
+        chunks = []
+        while size > 0:
+            if self._pos == len(self._block) and not self._next_block():
+                break
+            data = self._block[self._pos:(self._pos + size)]
+            self._pos += len(data)
+            size -= len(data)
+            chunks.append(data)
+        return ''.join(chunks)
+
+    def tell(self):
+        ''' Virtual offset of the next byte '''
+        if self._pos == len(self._block) and self._pos > 0: # end of the block
+            return self._block_end << 16
+        return (self._block_start << 16) | self._pos
+
+    def seek(self, voffset):
+        ''' Move to a virtual offset '''
+        self._batch.clear()
+        self.handle.seek(voffset >> 16)
+        self._block = ''
+        self._pos = 0
+        self._block_start = self._block_end = voffset >> 16
+        raw_block = self.read_raw_block()
+        if raw_block is not None:
+            self._block_start, self._block_end, self._block = inflate_block(raw_block)
+        self._pos = min(voffset & 0xFFFF, len(self._block))
+
+    def close(self):
+        self.handle.close()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+## ======================================================================
+def read_header(bgzf):
+    ''' Read the BAM header from the start of the stream
+        Input:  bgzf - BgzfReader at the start of the file
+        Output: text - sam header text
+                ref_names, ref_lens - reference sequence dictionary
+    '''
+    if bgzf.read(4) != BAM_MAGIC:
+        raise IOError("not a BAM file")
+    l_text = struct.unpack('<i', bgzf.read(4))[0]
+    text = bgzf.read(l_text).rstrip('\x00')
+    n_ref = struct.unpack('<i', bgzf.read(4))[0]
+    ref_names = []
+    ref_lens = []
+    for i in xrange(n_ref):
+        l_name = struct.unpack('<i', bgzf.read(4))[0]
+        ref_names.append(bgzf.read(l_name)[:-1]) # name is NUL terminated
+        ref_lens.append(struct.unpack('<i', bgzf.read(4))[0])
+    return text, ref_names, ref_lens
+## ======================================================================
+def raw_records(bgzf, end=None):
+    ''' Generator of the binary alignment records (without the block_size field)
+        Input:  bgzf - BgzfReader, records are read from its current position
+                end - virtual offset where to stop, None for the end of the file
+    '''
+    while end is None or bgzf.tell() < end:
+        head = bgzf.read(4)
+        if len(head) < 4:
+            return
+        block_size = struct.unpack('<i', head)[0]
+        data = bgzf.read(block_size)
+        if len(data) < block_size:
+            raise IOError("truncated BAM record")
+        yield data
+## ======================================================================
+def decode_cigar(data, offset, n_cigar_op):
+    ''' CIGAR string of a binary record, '*' if there is no CIGAR '''
+    if n_cigar_op == 0:
+        return '*'
+    ops = struct.unpack_from('<{}I'.format(n_cigar_op), data, offset)
+    return ''.join(['{}{}'.format(op >> 4, CIGAR_OPS[op & 15]) for op in ops])
+## ======================================================================
+def decode_seq(data, offset, l_seq):
+    ''' Sequence of a binary record (4 bits per base), '*' if there is no sequence '''
+    if l_seq == 0:
+        return '*'
+    packed = bytearray(data[offset:(offset + (l_seq + 1) // 2)])
+    return ''.join([SEQ_PAIRS[code] for code in packed])[:l_seq]
+## ======================================================================
+def decode_qual(data, offset, l_seq):
+    ''' Base qualities of a binary record as sam characters, '*' if they are missing (0xFF) '''
+    qual = data[offset:(offset + l_seq)]
+    if l_seq == 0 or qual[0] == '\xff':
+        return '*'
+    return qual.translate(QUAL_CHARS)
+## ======================================================================
+def float_string(value):
+    ''' Shortest %g string of a float tag value that reads back as the same float32 (at most 9 significant digits) '''
+    packed = struct.pack('<f', value)
+    for digits in xrange(6, 9):
+        text = '%.*g' % (digits, value)
+        if struct.pack('<f', float(text)) == packed:
+            return text
+    return '%.9g' % value
+## ======================================================================
+def decode_tags(data, offset):
+    ''' Optional fields of a binary record
+        Output: list of (tag, sam type, value string) tuples, integer types are all shown as sam type 'i'
+    '''
+    tags = []
+    end = len(data)
+    while offset < end:
+        tag = data[offset:(offset + 2)]
+        val_type = data[offset + 2]
+        offset += 3
+        if val_type == 'A':
+            tags.append((tag, 'A', data[offset]))
+            offset += 1
+        elif val_type in TAG_TYPES:
+            sam_type, fmt = TAG_TYPES[val_type]
+            value = struct.unpack_from('<' + fmt, data, offset)[0]
+            tags.append((tag, sam_type, float_string(value) if sam_type == 'f' else str(value)))
+            offset += struct.calcsize(fmt)
+        elif val_type == 'Z' or val_type == 'H':
+            value_end = data.index('\x00', offset)
+            tags.append((tag, val_type, data[offset:value_end]))
+            offset = value_end + 1
+        elif val_type == 'B':
+            sub_type = data[offset]
+            count = struct.unpack_from('<i', data, offset + 1)[0]
+            fmt = TAG_TYPES[sub_type][1]
+            values = struct.unpack_from('<{}{}'.format(count, fmt), data, offset + 5)
+            if sub_type == 'f':
+                values = [float_string(value) for value in values]
+            tags.append((tag, 'B', ','.join([sub_type] + map(str, values))))
+            offset += 5 + count * struct.calcsize(fmt)
+        else:
+            raise IOError("unknown BAM tag type {}".format(val_type))
+    return tags
@@ -0,0 +1,232 @@
+#!/usr/bin/python
+
+''' Compact (banded) version of the read array used in metalrec_lib.
+    The dense read array has one row per unique read string and 5 0-1 columns (ACGTD) for every position of the region,
+    although a short read only covers a small part of a long PacBio region. BandedReadArray keeps, for every read,
+    only the band from its first to its last covered position, with the 5 calls of a position packed into one byte
+    (bit k set for base call alphabet[k]), so the memory scales with the number of aligned bases instead of reads x region length.
+'''
+import numpy
+
+POPCOUNT = numpy.array([bin(code).count('1') for code in xrange(32)], dtype=numpy.int32) # number of base calls in a packed code
+
+## ======================================================================
+def pack_calls(calls):
+    ''' Pack 0-1 base calls, 5 entries (ACGTD) per position, into one byte per position
+        Input:  calls - 1d or 2d array, the last dimension has 5 entries for each position
+        Output: codes - uint8 array with one entry per position, bit k set if base alphabet[k] is called, 0 if the position is not covered
+    '''
+    calls = numpy.asarray(calls)
+    c = (calls.reshape(calls.shape[:-1] + (-1, 5)) == 1).astype(numpy.uint8)
+    codes = c[..., 0].copy()
+    for k in xrange(1, 5):
+        codes |= c[..., k] << k
+    return codes
+## ======================================================================
+def unpack_codes(codes):
+    ''' Inverse of pack_calls
+        Input:  codes - uint8 array of packed base calls
+        Output: calls - int32 0-1 array, 5 entries per position in the last dimension
+    '''
+    codes = numpy.asarray(codes, dtype=numpy.uint8)
+    calls = numpy.zeros(codes.shape + (5,), dtype=numpy.int32)
+    for k in xrange(5):
+        calls[..., k] = (codes >> k) & 1
+    return calls.reshape(codes.shape[:-1] + (-1,))
+## ======================================================================
+class BandedReadArray(object):
+    ''' Read array that only stores the covered band of every read.
+        Attributes:
+                npos - number of positions in the region
+                starts - int32 array, position of the first entry in the band of each read
+                ptr - int64 array of length nreads+1, band of read i is codes[ptr[i]:ptr[i+1]]
+                codes - uint8 array, packed base calls of all the bands concatenated
+        shape is the shape of the equivalent dense read array: (nreads, npos*5)
+    '''
+    def __init__(self, starts, ptr, codes, npos):
+        self.starts = numpy.asarray(starts, dtype=numpy.int32)
+        self.ptr = numpy.asarray(ptr, dtype=numpy.int64)
+        self.codes = numpy.asarray(codes, dtype=numpy.uint8)
+        self.npos = int(npos)
+
+    @classmethod
+    def from_bands(cls, bands, npos):
+        ''' Build from a list of (start, codes) tuples, one for each read '''
+        starts = numpy.array([start for start, codes in bands], dtype=numpy.int32)
+        lengths = numpy.array([len(codes) for start, codes in bands], dtype=numpy.int64)
+        ptr = numpy.concatenate(([0], numpy.cumsum(lengths)))
+        if len(bands) > 0:
+            codes = numpy.concatenate([codes for start, codes in bands]).astype(numpy.uint8)
+        else:
+            codes = numpy.zeros(0, dtype=numpy.uint8)
+        return cls(starts, ptr, codes, npos)
+
+    @classmethod
+    def from_dense(cls, read_array):
+        ''' Build from a dense 2d read array, each read's band goes from its first to its last covered position '''
+        packed = pack_calls(read_array)
+        bands = []
+        for i in xrange(packed.shape[0]):
+            covered = numpy.flatnonzero(packed[i])
+            if len(covered) == 0:
+                bands.append((0, packed[i, :0]))
+            else:
+                bands.append((covered[0], packed[i, covered[0]:(covered[-1] + 1)]))
+        return cls.from_bands(bands, packed.shape[1])
+
+    @property
+    def nreads(self):
+        return len(self.starts)
+
+    @property
+    def shape(self):
+        return (self.nreads, self.npos * 5)
+
+    def lengths(self):
+        ''' Length of the band of each read '''
+        return numpy.diff(self.ptr)
+
+    def row_ids(self):
+        ''' Read (row) index of every entry in codes '''
+        return numpy.repeat(numpy.arange(self.nreads), self.lengths())
+
+    def positions(self):
+        ''' Position in the region of every entry in codes '''
+        lengths = self.lengths()
+        return numpy.arange(len(self.codes)) - numpy.repeat(self.ptr[:-1] - self.starts, lengths)
+
+    def band(self, i):
+        ''' (start, codes) of the i-th read, codes is a view, so changing it changes the array '''
+        return self.starts[i], self.codes[self.ptr[i]:self.ptr[i + 1]]
+
+    def row(self, i):
+        ''' Dense 0-1 vector (length npos*5) of the i-th read '''
+        start, codes = self.band(i)
+        row = numpy.zeros(self.npos * 5, dtype=numpy.int32)
+        row[(start * 5):((start + len(codes)) * 5)] = unpack_codes(codes)
+        return row
+
+    def toarray(self):
+        ''' Equivalent dense 2d read array '''
+        read_array = numpy.zeros(self.shape, dtype=numpy.int32)
+        for i in xrange(self.nreads):
+            read_array[i, :] = self.row(i)
+        return read_array
+
+    def take(self, ind):
+        ''' New BandedReadArray with the reads (rows) in ind, data is copied '''
+        return BandedReadArray.from_bands([(self.starts[i], self.band(i)[1].copy()) for i in ind], self.npos)
+
+    def copy(self):
+        return BandedReadArray(self.starts.copy(), self.ptr.copy(), self.codes.copy(), self.npos)
+
+    def any(self):
+        ''' True if any read calls any base '''
+        return bool(self.codes.any())
+
+    def masked(self, ref_codes):
+        ''' New BandedReadArray with only the base calls that are also made by the reference (packed codes, one per position) '''
+        return BandedReadArray(self.starts.copy(), self.ptr.copy(), self.codes & ref_codes[self.positions()], self.npos)
+
+    def call_sums(self):
+        ''' Number of reads calling each base at each position, same as the column sums of the dense array reshaped to (npos, 5) '''
+        positions = self.positions()
+        sums = numpy.zeros((self.npos, 5), dtype=numpy.int64)
+        for k in xrange(5):
+            sums[:, k] = numpy.bincount(positions[(self.codes >> k) & 1 == 1], minlength=self.npos)
+        return sums
+
+    def coverage(self, start=0, end=None):
+        ''' Number of positions in [start, end) covered by each read '''
+        if end is None:
+            end = self.npos
+        positions = self.positions()
+        keep = (self.codes != 0) & (positions >= start) & (positions < end)
+        return numpy.bincount(self.row_ids()[keep], minlength=self.nreads)
+
+    def span(self):
+        ''' First and last covered positions of each read, (0, -1) if the read does not cover anything
+            Output: first_pos, last_pos - int32 arrays
+        '''
+        first_pos = numpy.zeros(self.nreads, dtype=numpy.int32)
+        last_pos = -numpy.ones(self.nreads, dtype=numpy.int32)
+        covered = self.codes != 0
+        rows = self.row_ids()[covered]
+        positions = self.positions()[covered]
+        if len(rows) > 0: # entries are ordered by row, and by position within a row
+            ind = numpy.flatnonzero(numpy.concatenate(([True], rows[1:] != rows[:-1])))
+            first_pos[rows[ind]] = positions[ind]
+            ind = numpy.flatnonzero(numpy.concatenate((rows[1:] != rows[:-1], [True])))
+            last_pos[rows[ind]] = positions[ind]
+        return first_pos, last_pos
+
+    def first_last(self, i):
+        ''' First and last covered positions of the i-th read, None if the read does not cover anything '''
+        start, codes = self.band(i)
+        covered = numpy.flatnonzero(codes)
+        if len(covered) == 0:
+            return None
+        return start + covered[0], start + covered[-1]
+
+    def clear(self, i, start, end):
+        ''' Remove base calls of the i-th read at positions start to end-1, with the same meaning as slicing a dense row '''
+        start, end, step = slice(start, end).indices(self.npos)
+        band_start, codes = self.band(i)
+        start = max(start - band_start, 0)
+        end = min(end - band_start, len(codes))
+        if start < end:
+            codes[start:end] = 0
+
+    def window(self, rows, start, end):
+        ''' Dense packed codes of the reads in rows at positions start to end-1
+            Output: 2d uint8 array (len(rows), end-start)
+        '''
+        out = numpy.zeros((len(rows), end - start), dtype=numpy.uint8)
+        for n, i in enumerate(rows):
+            band_start, codes = self.band(i)
+            lo = max(start, band_start)
+            hi = min(end, band_start + len(codes))
+            if lo < hi:
+                out[n, (lo - start):(hi - start)] = codes[(lo - band_start):(hi - band_start)]
+        return out
+
+    def trimmed(self):
+        ''' New BandedReadArray without the reads that cover nothing, and without the positions at both ends that no read covers '''
+        first_pos, last_pos = self.span()
+        keep = numpy.flatnonzero(last_pos >= first_pos)
+        if len(keep) == 0:
+            return BandedReadArray.from_bands([], 0)
+        offset = first_pos[keep].min()
+        bands = []
+        for i in keep:
+            start, codes = self.band(i)
+            bands.append((first_pos[i] - offset, codes[(first_pos[i] - start):(last_pos[i] - start + 1)].copy()))
+        return BandedReadArray.from_bands(bands, last_pos[keep].max() - offset + 1)
+## ======================================================================
+def overlap_lengths(read_array, block_reads=64):
+    ''' Overlap lengths between all pairs of reads, same as the matrix product of the dense read array with its transpose.
+        Reads are sorted by their first covered position and compared in blocks, over the positions covered by the block only.
+        Input:  read_array - BandedReadArray
+                block_reads - number of reads in a block
+        Output: overlap - 2d int32 array (nreads x nreads), number of shared base calls between each pair of reads
+    '''
+    nreads = read_array.nreads
+    overlap = numpy.zeros((nreads, nreads), dtype=numpy.int32)
+    first_pos, last_pos = read_array.span()
+    order = numpy.flatnonzero(last_pos >= first_pos) # reads that cover at least one position
+    order = order[numpy.argsort(first_pos[order], kind='mergesort')]
+    for b in xrange(0, len(order), block_reads):
+        rows = order[b:(b + block_reads)]
+        start = first_pos[rows].min()
+        end = last_pos[rows].max() + 1
+        later = order[b:]
+        others = later[ (first_pos[later] < end) & (last_pos[later] >= start) ] # reads from this block on that overlap the block
+        a = read_array.window(rows, start, end)
+        o = read_array.window(others, start, end)
+        ov = numpy.zeros((len(rows), len(others)), dtype=numpy.float32)
+        for k in xrange(5): # one matrix product for each base
+            ov += numpy.dot(((a >> k) & 1).astype(numpy.float32), ((o >> k) & 1).astype(numpy.float32).T)
+        ov = ov.astype(numpy.int32)
+        overlap[numpy.ix_(rows, others)] = ov
+        overlap[numpy.ix_(others, rows)] = ov.T
+    return overlap
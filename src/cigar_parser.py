@@ -0,0 +1,172 @@
+#!/usr/bin/python
+
+''' Single-pass CIGAR string parser shared by metalrec_lib, samread and mapStat.
+    Parsed results are kept in a bounded LRU cache keyed by the CIGAR string,
+    since the same string is parsed many times for every alignment record.
+'''
+import re
+
+CIGAR_CACHE_SIZE = 65536 # maximum number of distinct CIGAR strings kept in the cache
+_cigar_token = re.compile(r'(\d+)(\D)') # one (count, operation) pair of the CIGAR string
+
+## ======================================================================
+class LRUCache(object):
+    ''' Bounded dictionary that drops the least recently used entry when full.
+        Entries are kept in a circular doubly linked list: [prev, next, key, value]
+    '''
+    __slots__ = ('maxsize', 'data', 'root')
+
+    def __init__(self, maxsize=CIGAR_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.data = dict() # key => link in the list
+        root = []
+        root[:] = [root, root, None, None] # sentinel, root[1] is the oldest entry, root[0] the newest
+        self.root = root
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        link = self.data.get(key)
+        if link is None:
+            return default
+        # move the link to the most recently used end
+        link_prev, link_next = link[0], link[1]
+        link_prev[1] = link_next
+        link_next[0] = link_prev
+        root = self.root
+        last = root[0]
+        last[1] = root[0] = link
+        link[0] = last
+        link[1] = root
+        return link[3]
+
+    def put(self, key, value):
+        if key in self.data:
+            self.data[key][3] = value
+            self.get(key)
+            return
+        root = self.root
+        if len(self.data) >= self.maxsize: # full, recycle the oldest link
+            oldest = root[1]
+            root[1] = oldest[1]
+            oldest[1][0] = root
+            del self.data[oldest[2]]
+        last = root[0]
+        link = [last, root, key, value]
+        last[1] = root[0] = link
+        self.data[key] = link
+
+    def clear(self):
+        self.data.clear()
+        self.root[:] = [self.root, self.root, None, None]
+## ======================================================================
+class CigarInfo(object):
+    ''' Summary of one CIGAR string. Fields can be read as attributes or with the
+        dictionary style used by metalrec_lib.cigar callers, e.g. info['ins_len'].
+        Instances are shared through the cache, so they must not be modified.
+    '''
+    __slots__ = ('read_len', 'seq_len', 'ref_len', 'ins_len', 'del_len', 'match_len', 'sub_len', 'align_len',
+                 'pad_len', 'max_ins', 'max_del', 'max_sub', 'left_clip_len', 'right_clip_len', 'ops')
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def keys(self):
+        return [key for key in self.__slots__ if key != 'ops']
+
+    def as_dict(self):
+        ''' Plain (modifiable) dictionary copy of the summary, without the operation list '''
+        return dict((key, getattr(self, key)) for key in self.keys())
+## ======================================================================
+def cigar_ops(cigar_string):
+    ''' Tokenize CIGAR string into a list of (count, operation) tuples, operations in upper case.
+        '*' (CIGAR not available) gives an empty list.
+    '''
+    return [(int(count), op.upper()) for count, op in _cigar_token.findall(cigar_string)]
+## ======================================================================
+def parse_cigar(cigar_string):
+    ''' Parse CIGAR string in one pass over its operations, find number of matches, mismatches, insertion (to ref), deletion,
+        soft clipping, hard clipping, padding, maximum continuous substitution/insertion/deletion length
+        Input:  cigar_string - CIGAR string from the sam record
+        Output: CigarInfo object, same fields as the dictionary returned by metalrec_lib.cigar before,
+                plus ops, the tuple of (count, operation) pairs
+    '''
+    ops = cigar_ops(cigar_string)
+    read_len = seq_len = ref_len = 0
+    ins_len = del_len = pad_len = 0
+    m_len = match_len = sub_len = 0
+    max_ins = max_del = max_sub = 0
+    extended = False # '=' or 'X' detected, sam 1.4 format for CIGAR string
+    for count, op in ops:
+        if op == 'M':
+            m_len += count
+            read_len += count
+            seq_len += count
+            ref_len += count
+        elif op == '=':
+            extended = True
+            match_len += count
+            read_len += count
+            seq_len += count
+            ref_len += count
+        elif op == 'X':
+            extended = True
+            sub_len += count
+            if count > max_sub:
+                max_sub = count
+            read_len += count
+            seq_len += count
+            ref_len += count
+        elif op == 'I':
+            ins_len += count
+            if count > max_ins:
+                max_ins = count
+            read_len += count
+            seq_len += count
+        elif op == 'D':
+            del_len += count
+            if count > max_del:
+                max_del = count
+            ref_len += count
+        elif op == 'S' or op == 'H':
+            read_len += count
+        elif op == 'P':
+            pad_len += count
+
+    info = CigarInfo()
+    info.read_len = read_len # length of the mapped read (including clipped part)
+    info.seq_len = seq_len # length of the mapped read (excluding clipped part)
+    info.ref_len = ref_len # length of the region on the reference sequence corresponding to the read
+    info.ins_len = ins_len
+    info.del_len = del_len
+    info.pad_len = pad_len # padded bps, inserted both in reference sequence and the read sequence
+    info.max_ins = max_ins
+    info.max_del = max_del
+    if extended: # match and substitution lengths are only available with X= in the cigar string, sam 1.4 and after
+        info.match_len = match_len
+        info.sub_len = sub_len
+        info.max_sub = max_sub
+        info.align_len = match_len + sub_len
+    else: # sam 1.3, aligned bps from 'M'
+        info.match_len = None
+        info.sub_len = None
+        info.max_sub = 0
+        info.align_len = m_len
+    info.left_clip_len = ops[0][0] if ops and ops[0][1] in 'SH' else 0
+    info.right_clip_len = ops[-1][0] if ops and ops[-1][1] in 'SH' else 0
+    info.ops = tuple(ops)
+    return info
+## ======================================================================
+_cigar_cache = LRUCache(CIGAR_CACHE_SIZE)
+
+def cigar_info(cigar_string):
+    ''' Cached version of parse_cigar, the same CigarInfo object is returned for the same CIGAR string. '''
+    info = _cigar_cache.get(cigar_string)
+    if info is None:
+        info = parse_cigar(cigar_string)
+        _cigar_cache.put(cigar_string, info)
+    return info
@@ -4,23 +4,23 @@ import argparse
 import sys
 import os
 import re 
+import gzio
 ## =================================================================
 ## Find length of all sequences in a fasta file
 ## =================================================================
 def count_bps(fastaFile,mycount,trim_string=None):
     ''' Find length of all sequences in a fasta file
 
-        Input:  fastaFile - file that includes filtered subreads
+        Input:  fastaFile - file that includes filtered subreads, can be gzip/BGZF compressed
         Output: countFile - file that contains the number of bases in each sequence
     '''
     if not os.path.exists(fastaFile):
         sys.stderr.write("fastaFile {} does not exist!\n".format(fastaFile))
         return -1
         
-    fasta = open(fastaFile,'r') 
     seqID = ''
     seqLen = 0
-    with open(fastaFile,'r') as fasta:
+    with gzio.open_input(fastaFile) as fasta:
         for line in fasta:
             if line[0] == '>':
                 if seqLen != 0:
@@ -4,6 +4,7 @@ import argparse
 import sys
 import os
 import re 
+import gzio
 ## =================================================================
 ## Given a fasta file of filtered subreads, find the number of passes
 ## for each ZMW.
@@ -13,17 +14,16 @@ def count_passes(fastaFile,countFile):
     ''' Given a fasta file of filtered subreads, find the number of passes
         for each ZMW
 
-        Input:  fastaFile - file that includes filtered subreads
+        Input:  fastaFile - file that includes filtered subreads, can be gzip/BGZF compressed
         Output: countFile - file that contains the number of passes for each ZMW
     '''
     if not os.path.exists(fastaFile):
         sys.stderr.write("fastaFile {} does not exist!\n".format(fastaFile))
         return -1
         
-    fasta = open(fastaFile,'r') 
     passes = dict()
     lengths = dict()
-    with open(fastaFile,'r') as fasta:
+    with gzio.open_input(fastaFile) as fasta:
         for line in fasta:
             if line[0] == '>':
                 seqID = line[1:line.rfind('/')]
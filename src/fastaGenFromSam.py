@@ -10,7 +10,7 @@ Created on Tue Oct 28 09:10:01 EDT 2014
 """
 import sys
 import argparse
-import samread 
+import samrecord
 
 ## =================================================================
 ## generate fasta file including mapped sequences from sam file
@@ -20,20 +20,16 @@ def fastaGenFromSam(samFile, out, checkReads = True, verbose=False):
         Input:  samFile - sam file from mapping/alignment result
         Output: out - file object (where the sequences will be written to)
     '''
-    recorded_reads = []
+    recorded_reads = set()
     mapping_count = 0
-    with open(samFile, 'r') as sam:
-        for line in sam:
-            if line[0] == '@':
-                continue
-            else:
-                myread = samread.SamRead(line)
-                if checkReads and myread.is_unmapped():
-                    continue
-                mapping_count += 1
-                if myread.qname not in recorded_reads:
-                    out.write(">{}\n{}\n".format(myread.qname, myread.qSeq))
-                    recorded_reads.append(myread.qname)
+    for myread in samrecord.read_sam(samFile):
+        if checkReads and myread.is_unmapped():
+            continue
+        mapping_count += 1
+        qname = myread.qname
+        if qname not in recorded_reads:
+            out.write(">{}\n{}\n".format(qname, myread.seq))
+            recorded_reads.add(qname)
     if verbose:
         sys.stdout.write("{} reads with {} mappings\n".format(len(recorded_reads), mapping_count))
     
@@ -51,7 +47,7 @@ parser = argparse.ArgumentParser(description="generate fasta file including mapp
                                  )
 
 ## input files and directories
-parser.add_argument("-i","--in",help="input sam file",dest='samFile',required=True)
+parser.add_argument("-i","--in",help="input sam or BAM file",dest='samFile',required=True)
 
 ## output directory
 parser.add_argument("-o","--out",help="output fasta file",dest='outputFile',default=sys.stdout, type = argparse.FileType('w'))
@@ -0,0 +1,281 @@
+#!/usr/bin/python
+
+''' Incremental evaluation of the gaps of the PacBio sequences proposed by metalrec_lib.greedy_fill_gap.
+    A gap position is a position that no compatible read covers, after the reads with too small overlaps are trimmed (see metalrec_lib.gap_pos).
+    A proposed reference array differs from the current one only at the positions covered by the read that was picked to fill a gap,
+    so GapEngine keeps, for a reference array, the number of base calls every read shares with it and the number of compatible reads
+    covering every position, and a proposal only re-checks the reads covering the changed positions.
+    Reference arrays have exactly one base call at every position, so the overlap length of two compatible reads (shared base calls
+    agreeing with the reference) is the number of positions both of them cover, and is computed only once for all the reads.
+    GapQueue keeps the gaps to fill across the iterations of metalrec_lib.fill_gap, so the gaps are not sorted again, and the reads covering
+    a gap are not looked up again, every time the sequence improves.
+'''
+import heapq
+import numpy
+import banded_array
+
+## ======================================================================
+class GapState(object):
+    ''' Gaps of one reference array
+        Attributes:
+                ref - 0-1 reference array, 5 entries (ACGTD) per position
+                ref_codes - packed base calls of the reference, one per position
+                shared - number of base calls each read shares with the reference
+                compatible - boolean array, True for the reads compatible with the reference
+                cov_count - number of compatible (untrimmed) reads covering each position
+                Cvec - int32 array, indices of the compatible reads, same as metalrec_lib.get_compatible_reads
+                gaps - gap positions, same as metalrec_lib.gap_pos
+                max_len - length of the longest contiguous segment, same as the longest sequence from metalrec_lib.split_at_gap
+    '''
+    def __init__(self, ref, ref_codes, shared, compatible, cov_count):
+        self.ref = ref
+        self.ref_codes = ref_codes
+        self.shared = shared
+        self.compatible = compatible
+        self.cov_count = cov_count
+        self.Cvec = numpy.flatnonzero(compatible).astype(numpy.int32)
+        self.gaps = None
+        self.max_len = None
+## ======================================================================
+class GapEngine(object):
+    ''' Gap evaluation for one read array, reused for all the reference arrays proposed for it.
+        Input:  read_array - 2d read array or BandedReadArray
+                minOverlap, minOverlapRatio - overlap thresholds, same as metalrec_lib.gap_pos
+    '''
+    def __init__(self, read_array, minOverlap=10, minOverlapRatio=0.1):
+        if not isinstance(read_array, banded_array.BandedReadArray):
+            read_array = banded_array.BandedReadArray.from_dense(read_array)
+        self.minOverlap = minOverlap
+        self.minOverlapRatio = minOverlapRatio
+        self.npos = read_array.npos
+        self.nreads = read_array.nreads
+        self.codes = read_array.codes
+        self.rows = read_array.row_ids()
+        self.positions = read_array.positions()
+        covered = self.codes != 0
+        self.ncovered = numpy.bincount(self.rows[covered], minlength=self.nreads) # number of positions covered by each read
+        self.cov_array = banded_array.BandedReadArray(read_array.starts, read_array.ptr, covered.astype(numpy.uint8), self.npos) # coverage of each read
+        self.first_pos, self.last_pos = read_array.span()
+        # entries of all the reads sorted by position, entries at position p are pos_ptr[p] to pos_ptr[p+1]-1
+        order = numpy.argsort(self.positions, kind='mergesort')
+        self.pos_rows = self.rows[order]
+        self.pos_codes = self.codes[order]
+        self.pos_ptr = numpy.concatenate(([0], numpy.cumsum(numpy.bincount(self.positions, minlength=self.npos))))
+        self._overlap = None # number of positions covered by both reads, for all pairs of reads
+
+    def overlap(self):
+        ''' Number of positions covered by both reads, for all pairs, computed when first needed '''
+        if self._overlap is None:
+            self._overlap = banded_array.overlap_lengths(self.cov_array)
+        return self._overlap
+
+    def state(self, ref):
+        ''' GapState of a reference array, computed from scratch '''
+        ref_codes = banded_array.pack_calls(ref)
+        shared = numpy.bincount(self.rows, weights=banded_array.POPCOUNT[self.codes & ref_codes[self.positions]], minlength=self.nreads).astype(numpy.int64)
+        compatible = (self.ncovered > 0) & (shared == self.ncovered)
+        cov_count = numpy.bincount(self.positions[(self.codes != 0) & compatible[self.rows]], minlength=self.npos)
+        return self._finish(GapState(ref, ref_codes, shared, compatible, cov_count))
+
+    def propose(self, state, ref1):
+        ''' GapState of a new reference array, updated from the state of the current one. Only the reads covering the changed positions are checked again. '''
+        ref_codes1 = banded_array.pack_calls(ref1)
+        changed = numpy.flatnonzero(ref_codes1 != state.ref_codes) # positions with changed base calls
+        lengths = self.pos_ptr[changed + 1] - self.pos_ptr[changed]
+        entries = numpy.repeat(self.pos_ptr[changed] - numpy.cumsum(lengths) + lengths, lengths) + numpy.arange(lengths.sum()) # entries at the changed positions
+        entry_pos = numpy.repeat(changed, lengths)
+        entry_rows = self.pos_rows[entries]
+        delta = banded_array.POPCOUNT[self.pos_codes[entries] & ref_codes1[entry_pos]] - banded_array.POPCOUNT[self.pos_codes[entries] & state.ref_codes[entry_pos]]
+        shared = state.shared.copy()
+        compatible = state.compatible.copy()
+        cov_count = state.cov_count.copy()
+        if len(entries) > 0:
+            shared += numpy.bincount(entry_rows, weights=delta, minlength=self.nreads).astype(numpy.int64)
+            affected = numpy.unique(entry_rows) # reads covering the changed positions
+            compatible[affected] = (self.ncovered[affected] > 0) & (shared[affected] == self.ncovered[affected])
+            for i in affected[compatible[affected] != state.compatible[affected]]: # reads that became compatible or incompatible
+                start, covered = self.cov_array.band(i)
+                if compatible[i]:
+                    cov_count[start:(start + len(covered))] += covered
+                else:
+                    cov_count[start:(start + len(covered))] -= covered
+        return self._finish(GapState(ref1, ref_codes1, shared, compatible, cov_count))
+
+    def _finish(self, state):
+        ''' Fill in the gaps and the longest contiguous length of a state '''
+        state.gaps = self.gap_pos(state.Cvec, state.cov_count)
+        state.max_len = self.max_len(state.ref, state.gaps)
+        return state
+
+    def gap_pos(self, Cvec, cov_count):
+        ''' Positions not covered by the compatible reads in Cvec after trimming, same as metalrec_lib.gap_pos
+            Input:  Cvec - indices of compatible reads
+                    cov_count - number of compatible reads covering each position
+            Output: gap_vec - gap positions
+        '''
+        if len(Cvec) == 0: # no compatible reads, all positions are gap positions
+            return numpy.arange(self.npos)
+        cov = cov_count
+        if self.minOverlap != -1 or self.minOverlapRatio != 0: # check minOverlap if at least one of the minOverlap and minOverlapRatio is specified
+            bands = self._trim(Cvec)
+            if len(bands) > 0:
+                cov = cov_count.copy()
+                for k in bands: # coverage of the trimmed reads
+                    start, covered = self.cov_array.band(Cvec[k])
+                    cov[start:(start + len(covered))] -= covered
+                    start, covered = bands[k]
+                    cov[start:(start + len(covered))] += covered
+        return numpy.flatnonzero(cov == 0)
+
+    def max_len(self, ref, gaps):
+        ''' Length of the longest contiguous segment between the gaps, deletion positions not counted '''
+        is_gap = numpy.zeros(self.npos, dtype=bool)
+        is_gap[gaps] = True
+        kept = numpy.flatnonzero(~is_gap)
+        if len(kept) == 0:
+            return 0
+        segment = numpy.cumsum(is_gap)[kept] # segment index of each position that is not a gap
+        not_deleted = ref.reshape(-1, 5)[kept, 4] != 1
+        return int(numpy.bincount(segment, weights=not_deleted).max())
+
+    def _band(self, Cvec, i, bands):
+        ''' Current coverage band of the i-th compatible read, trimmed or not '''
+        if i in bands:
+            return bands[i]
+        return self.cov_array.band(Cvec[i])
+
+    def _trim(self, Cvec):
+        ''' Trim the reads with small overlaps the same way as metalrec_lib.gap_pos, iteratively until no more read needs trimming.
+            Input:  Cvec - indices of compatible reads
+            Output: bands - dictionary index in Cvec => (start, coverage) of the trimmed reads
+        '''
+        n = len(Cvec)
+        overlap_len = self.overlap()[numpy.ix_(Cvec, Cvec)]
+        first_pos = self.first_pos[Cvec].copy()
+        last_pos = self.last_pos[Cvec].copy()
+        trimmed_reads = numpy.zeros((n, 2), dtype=numpy.int32)
+        bands = dict()
+        while True:
+            # overlap matrix as in metalrec_lib.get_overlapLen: positive if the first read is to the left of the second read, negative if to the right
+            left_of = (first_pos[:, numpy.newaxis] < first_pos[numpy.newaxis, :]) & (last_pos[:, numpy.newaxis] < last_pos[numpy.newaxis, :])
+            overlap_mat = numpy.where(left_of, overlap_len, 0)
+            overlap_mat -= overlap_mat.T
+            abs_overlap = numpy.abs(overlap_mat)
+            if abs_overlap.max() == 0:
+                avgOverlap = 0
+            else:
+                avgOverlap = numpy.mean(abs_overlap[abs_overlap > 0]) # average overlap length
+            cutOverlap = max(self.minOverlap, avgOverlap * self.minOverlapRatio) # hard cutoff and soft ratio cutoff, whichever is larger will be used
+            # maximum overlap with reads to the left and to the right, as in metalrec_lib.find_maxOverlap
+            maxOverlap_mat = numpy.column_stack((numpy.where(overlap_mat < 0, abs_overlap, 0).max(axis=1), numpy.where(overlap_mat > 0, overlap_mat, 0).max(axis=1)))
+            small_ind = numpy.where(maxOverlap_mat <= cutOverlap)
+            if len(small_ind[0]) == 0 or numpy.all(trimmed_reads[small_ind] == 1):
+                break
+            changed = []
+            for i, side in zip(small_ind[0].tolist(), small_ind[1].tolist()):
+                if trimmed_reads[i, side] == 1:
+                    continue
+                trimmed_reads[i, side] = 1 # mark that this read has been trimmed for the overlap checking
+                start, covered = self._band(Cvec, i, bands)
+                covered_pos = numpy.flatnonzero(covered)
+                if len(covered_pos) == 0:
+                    continue
+                length = maxOverlap_mat[i, side]
+                if side == 0 and start + covered_pos[0] > 0: # left overlap problem, and the read is not mapped to the beginning of the region
+                    trim_start = start + covered_pos[0]
+                    trim_end = trim_start + length + 1
+                elif side == 1 and start + covered_pos[-1] < self.npos - 1: # right overlap problem, and the read is not mapped to the end of the region
+                    trim_start = start + covered_pos[-1] - length
+                    trim_end = start + covered_pos[-1] + 1
+                else:
+                    continue
+                covered = covered.copy()
+                trim_start, trim_end, step = slice(trim_start, trim_end).indices(self.npos) # same meaning as slicing a dense row
+                trim_start = max(trim_start - start, 0)
+                trim_end = min(trim_end - start, len(covered))
+                if trim_start < trim_end:
+                    covered[trim_start:trim_end] = 0
+                bands[i] = (start, covered)
+                changed.append(i)
+            # overlaps and spans of the trimmed reads
+            for i in set(changed):
+                start, covered = bands[i]
+                covered_pos = numpy.flatnonzero(covered)
+                if len(covered_pos) == 0:
+                    first_pos[i], last_pos[i] = 0, -1
+                    overlap_len[i, :] = 0
+                    overlap_len[:, i] = 0
+                    continue
+                first_pos[i] = start + covered_pos[0]
+                last_pos[i] = start + covered_pos[-1]
+                others = numpy.flatnonzero((first_pos <= last_pos[i]) & (last_pos >= first_pos[i]))
+                row = numpy.zeros(n, dtype=numpy.int32)
+                window = covered[covered_pos[0]:(covered_pos[-1] + 1)].astype(numpy.int32)
+                for j in others:
+                    other_start, other_covered = self._band(Cvec, j, bands)
+                    lo = max(first_pos[i], other_start)
+                    hi = min(last_pos[i] + 1, other_start + len(other_covered))
+                    if lo < hi:
+                        row[j] = numpy.dot(window[(lo - first_pos[i]):(hi - first_pos[i])], other_covered[(lo - other_start):(hi - other_start)])
+                overlap_len[i, :] = row
+                overlap_len[:, i] = row
+        return bands
+## ======================================================================
+class GapQueue(object):
+    ''' Gaps to try to fill, widest first (rightmost first among gaps of the same length), kept across the iterations of metalrec_lib.fill_gap.
+        A gap that could not be filled is not tried again until the reference changes; any change can make a difference to it
+        (compatible reads, segments that filling it would join), so all the failed gaps are tried again then.
+        Entries of gaps that do not exist any more are only dropped when they come up (lazy invalidation).
+        Input:  engine - GapEngine of the read array
+    '''
+    def __init__(self, engine):
+        self.engine = engine
+        self.heap = [] # (-gap length, -gap start, gap)
+        self.queued = set() # gaps (start, end) with an entry in the heap
+        self.failed = set() # gaps that could not be filled with the current reference
+        self.candidates = dict() # gap => (reads_ind, reads_cov) of all the reads covering at least one position of the gap
+        self.gaps = set() # gaps of the current reference
+        self.ref_codes = None # packed base calls of the current reference
+
+    def update(self, state):
+        ''' Make the gaps of a GapState current: if the reference changed, the failed gaps are tried again, new gaps are queued '''
+        gaps = state.gaps
+        breaks = numpy.flatnonzero(numpy.diff(gaps) != 1) # consecutive gap positions belong to the same gap
+        starts = numpy.concatenate((gaps[:1], gaps[breaks + 1])).tolist()
+        ends = numpy.concatenate((gaps[breaks], gaps[-1:])).tolist()
+        sorted_gaps = zip(starts, ends)
+        self.gaps = set(sorted_gaps)
+        if self.ref_codes is None or not numpy.array_equal(state.ref_codes, self.ref_codes):
+            self.failed = set()
+        self.ref_codes = state.ref_codes
+        for gap in self.gaps:
+            if gap not in self.queued and gap not in self.failed:
+                heapq.heappush(self.heap, (gap[0] - gap[1] - 1, -gap[0], gap))
+                self.queued.add(gap)
+
+    def pop(self):
+        ''' Widest current gap worth trying, None if there is none '''
+        while len(self.heap) > 0:
+            gap = heapq.heappop(self.heap)[2]
+            self.queued.discard(gap)
+            if gap in self.gaps and gap not in self.failed:
+                return gap
+        return None
+
+    def reads_for_gap(self, gap, compatible):
+        ''' Reads that are not compatible with the reference and cover at least one position of the gap, same as metalrec_lib.get_reads_for_gap with the compatible reads skipped
+            Input:  gap - (start, end) of the gap
+                    compatible - boolean array, compatible reads of the current reference
+            Output: reads_ind, reads_cov - indices of the reads, and the numbers of gap positions they cover
+        '''
+        if gap not in self.candidates: # coverage of the gap does not depend on the reference, computed once
+            coverages = self.engine.cov_array.coverage(gap[0], gap[1] + 1)
+            reads_ind = numpy.flatnonzero(coverages != 0)
+            self.candidates[gap] = (reads_ind, coverages[reads_ind])
+        reads_ind, reads_cov = self.candidates[gap]
+        keep = ~compatible[reads_ind]
+        return reads_ind[keep], reads_cov[keep]
+
+    def fail(self, gap):
+        ''' Mark a gap that could not be filled with the current reference '''
+        self.failed.add(gap)
@@ -5,21 +5,20 @@
 #============================
 import sys
 import os
+import gzio
 
 # get base_out filename and extension
 input_filename = sys.argv[1]
 output_filename = sys.argv[2]
-out = open(output_filename, 'wb')
+out = gzio.open_output(output_filename) # compressed (BGZF) if the name ends in .gz
 quality='F'
 
 # open and read input file
-with open(input_filename, 'r') as f:
+with gzio.open_input(input_filename) as f: # plain, gzip or BGZF
     for line in f:
         line = line.strip()
         if (line.startswith(">")):
             out.write(line+"\n")
         else:
-            line_len = len(line)
-            for x in range(0, line_len):
-                out.write(quality)
-            out.write("\n")
+            out.write(quality * len(line) + "\n")
+out.close()
@@ -4,18 +4,188 @@ import argparse
 import sys
 import os
 import re 
+import seqreader
+## =================================================================
+## samtools style .fai index of a fasta file, one line per sequence:
+## name, length, offset of the first base, bases per line, bytes per line
+## =================================================================
+def build_fai(fastaFile, faiFile=None):
+    ''' Build .fai index for a fasta file (same format as samtools faidx) and write it to faiFile.
+        Input:  fastaFile - fasta file to index
+                faiFile - index file, default: fastaFile + '.fai'
+        Output: index - dictionary seqID => (length, offset, line_bases, line_width), None if the fasta file
+                        cannot be indexed (lines of a sequence with different lengths)
+                names - sequence IDs in file order
+    '''
+    if faiFile is None:
+        faiFile = fastaFile + '.fai'
+    index = dict()
+    names = []
+    name = None
+    offset = 0 # byte offset of the current line
+    with open(fastaFile, 'rb') as fasta:
+        for line in fasta:
+            line_width = len(line)
+            if line[0] == '>':
+                if name is not None:
+                    index[name] = (seq_len, seq_offset, line_bases, width)
+                name = line[1:].split(None, 1)[0] if line[1:].strip() != '' else ''
+                names.append(name)
+                seq_len = 0
+                seq_offset = offset + line_width
+                line_bases = -1
+                width = -1
+                short_line = False # a line shorter than the others was seen, it has to be the last line of the sequence
+            elif name is not None and line.strip() == '':
+                if line_bases != -1: # empty line, only allowed after the last line of the sequence
+                    short_line = True
+            elif name is not None:
+                bases = len(line.rstrip('\r\n'))
+                if line_bases == -1:
+                    line_bases = bases
+                    width = line_width
+                elif short_line or bases > line_bases or (bases == line_bases and line_width != width):
+                    sys.stderr.write("sequence {} in {} has lines of different lengths, cannot index it.\n".format(name, fastaFile))
+                    return None, []
+                if bases < line_bases:
+                    short_line = True
+                seq_len += bases
+            offset += line_width
+    if name is not None:
+        index[name] = (seq_len, seq_offset, line_bases, width)
+    with open(faiFile, 'w') as fai:
+        for name in names:
+            seq_len, seq_offset, line_bases, width = index[name]
+            fai.write("{}\t{}\t{}\t{}\t{}\n".format(name, seq_len, seq_offset, max(line_bases, 0), max(width, 0)))
+    return index, names
+
+def read_fai(faiFile):
+    ''' Read .fai index file
+        Output: index - dictionary seqID => (length, offset, line_bases, line_width)
+                names - sequence IDs in file order
+    '''
+    index = dict()
+    names = []
+    with open(faiFile, 'r') as fai:
+        for line in fai:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 5:
+                continue
+            index[fields[0]] = tuple(map(int, fields[1:5]))
+            names.append(fields[0])
+    return index, names
+
+def load_fai(fastaFile):
+    ''' Reuse the .fai index next to the fasta file if it is up to date, otherwise build it.
+        Output: same as read_fai, (None, []) if the fasta file cannot be indexed
+    '''
+    faiFile = fastaFile + '.fai'
+    if os.path.exists(faiFile) and os.path.getmtime(faiFile) >= os.path.getmtime(fastaFile):
+        return read_fai(faiFile)
+    try:
+        return build_fai(fastaFile, faiFile)
+    except IOError: # e.g. no permission to write next to the fasta file, keep the index in memory only
+        return build_fai(fastaFile, os.devnull)
+
+def fetch_region(fasta, entry, start, end):
+    ''' Read a region of a sequence directly from its byte offset in the fasta file
+        Input:  fasta - fasta file object (opened in binary mode)
+                entry - (length, offset, line_bases, line_width) from the index
+                start, end - 1-based starting and ending positions, end is included, -1 for the end of the sequence
+        Output: sequence of the region (shorter than requested if end passes the end of the sequence)
+    '''
+    seq_len, offset, line_bases, line_width = entry
+    if end == -1 or end > seq_len:
+        end = seq_len
+    if start < 1:
+        start = 1
+    if line_bases <= 0 or start > end:
+        return ''
+    begin_byte = offset + (start - 1) / line_bases * line_width + (start - 1) % line_bases
+    end_byte = offset + (end - 1) / line_bases * line_width + (end - 1) % line_bases + 1
+    fasta.seek(begin_byte)
+    return fasta.read(end_byte - begin_byte).replace('\n', '').replace('\r', '')
+
+## =================================================================
+## Same as get_contig, using the .fai index to seek to the region
+## instead of scanning the file.
+## =================================================================
+def get_contig_indexed(fastaFile, seqID, start, end, limit, index=None, names=None, fasta=None):
+    ''' Given a fasta file, find the sequence for the specific region of 
+        a sequence with given ID, with the help of the .fai index.
+        An exact ID match is looked up directly, otherwise the IDs including seqID are used (like get_contig).
+
+        Input:  fastaFile, seqID, start, end, limit - same as get_contig
+                index, names - output of load_fai, loaded here if not given
+                fasta - fasta file already opened (in binary mode), opened here if not given
+        Output: None if found, -1 if not found or the region passes the end of the sequence
+    '''
+    if index is None:
+        index, names = load_fai(fastaFile)
+        if index is None: # cannot be indexed, scan the file instead
+            return get_contig(fastaFile, seqID, start, end, limit)
+    if end != -1 and start > end:
+        sys.stderr.write("Please check input for starting and ending positiosn.\n")
+        return -1
+    if seqID in index:
+        matched = [seqID]
+    else:
+        matched = [name for name in names if seqID in name]
+    if limit != -1:
+        matched = matched[:limit]
+    if len(matched) == 0:
+        sys.stderr.write("sequence {} was not found in file {}!\n".format(seqID, fastaFile))
+        return -1
+
+    close_fasta = fasta is None
+    if fasta is None:
+        fasta = open(fastaFile, 'rb')
+    status = None
+    for thisID in matched:
+        sys.stdout.write('>{}\n'.format(thisID))
+        sys.stdout.write('{}\n'.format(fetch_region(fasta, index[thisID], start, end)))
+        if end != -1 and end > index[thisID][0]:
+            sys.stderr.write("end position passed end of the sequence!\n")
+            status = -1
+            break
+    if close_fasta:
+        fasta.close()
+    return status
+
+def get_regions(fastaFile, regions):
+    ''' Batch mode: fetch many regions with one index load and one open file.
+        Input:  fastaFile - fasta file
+                regions - list of (seqID, start, end) tuples, 1-based, end -1 for the end of the sequence
+        Output: number of regions that could not be fetched
+    '''
+    index, names = load_fai(fastaFile)
+    failed = 0
+    if index is None:
+        for seqID, start, end in regions:
+            if get_contig(fastaFile, seqID, start, end, 1) == -1:
+                failed += 1
+        return failed
+    with open(fastaFile, 'rb') as fasta:
+        for seqID, start, end in regions:
+            if get_contig_indexed(fastaFile, seqID, start, end, 1, index, names, fasta) == -1:
+                failed += 1
+    return failed
+
+def get_region_list(region_file):
+    ''' Read regions to fetch, one per line: seqID [start [end]]
+        Output: list of (seqID, start, end) tuples
+    '''
+    regions = []
+    with open(region_file, 'r') as lines:
+        for line in lines:
+            fields = line.split()
+            if len(fields) == 0:
+                continue
+            start = int(fields[1]) if len(fields) > 1 else 1
+            end = int(fields[2]) if len(fields) > 2 else -1
+            regions.append((fields[0], start, end))
+    return regions
 
-def getReadFromFasta(fin):
-    output = ""
-    for line in fin:
-        if line.strip("\n").strip() != "":
-            if line[0] != ">":
-                output += line
-            else:
-                if output != "":
-                    yield output
-                output = line
-    yield output
 ## =================================================================
 ## Given a fasta file, find the sequence for the specific region of 
 ## a sequence with given ID. 
@@ -89,8 +259,8 @@ def get_IDs(id_file):
 def get_contigs(fastaFile, seqIDs):
     index = 0
     with open(fastaFile, 'r') as fin:
-        for readLines in getReadFromFasta(fin):
-            seq_id = readLines.split()[0][1:] # sequence name
+        for readLines, seq_len in seqreader.read_fasta(fin, raw=True):
+            seq_id = readLines[1:readLines.find('\n')].split()[0] # sequence name
             if seq_id == seqIDs[index]:
                 sys.stdout.write(readLines)
                 index += 1
@@ -115,6 +285,8 @@ parser.add_argument("-n","--name",help="ID of the sequence to find",dest='seqID'
 parser.add_argument("-s","--start",help="1-based starting position of the sequence",dest='start',default=1, type=int)
 parser.add_argument("-e","--end",help="1-based ending position of the sequence",dest='end',default=-1, type=int)
 parser.add_argument("-l","--limit",help="maximum number of sequences to return",dest='limit',default=-1, type=int)
+parser.add_argument("-b","--batch",help="file with regions to extract, one per line: ID [start [end]]",dest='region_file')
+parser.add_argument("--no_index",help="scan the fasta file instead of using (or building) the .fai index",dest='use_index',action='store_false')
 
 ## output directory
 #parser.add_argument("-o","--out",help="output directory",dest='outputDir',required=True)
@@ -126,10 +298,17 @@ def main(argv=None):
     
     if argv is None:
         args = parser.parse_args()
-    if args.seqID is None and args.id_file is None:
+    if args.seqID is None and args.id_file is None and args.region_file is None:
         sys.exit("At least a sequence ID or a file of IDs is needed.\n")
+    if not os.path.exists(args.fastaFile):
+        sys.exit("fastaFile {} does not exist!\n".format(args.fastaFile))
     if args.seqID is not None:
-        get_contig(args.fastaFile,args.seqID,args.start,args.end, args.limit)
+        if args.use_index:
+            get_contig_indexed(args.fastaFile,args.seqID,args.start,args.end, args.limit)
+        else:
+            get_contig(args.fastaFile,args.seqID,args.start,args.end, args.limit)
+    elif args.region_file is not None:
+        get_regions(args.fastaFile, get_region_list(args.region_file))
     elif args.id_file is not None:
         seqIDs = get_IDs(args.id_file)
         get_contigs(args.fastaFile, seqIDs)
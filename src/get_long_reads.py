@@ -4,68 +4,37 @@ import argparse
 import sys
 import os
 import re 
-## =================================================================
-## Function: getRead
-## =================================================================
-def getReadFromFasta(fin):
-    output = ""
-    for line in fin:
-        if line.strip("\n").strip() != "":
-            if line[0] != ">":
-                output += line
-            else:
-                if output != "":
-                    yield output
-                output = line
-    yield output
-
-def getReadFromFastq(fin):
-    output = ""
-    count = 0
-    for line in fin:
-        if count != 4:
-            output += line
-            count = count + 1
-        else:
-            yield output
-            output = line
-            count = 1
-    yield output
-
+import seqreader
+import gzio
 ## =================================================================
 ## Find length of all sequences in a fasta file
 ## =================================================================
 def get_long_reads_1(fin, fout, fileType,cutoff=1000):
     readCount = 0
     if fileType == "fastq":
-        for readLines in getReadFromFastq(fin):
-            seq_len = len(readLines.split("\n")[1])
+        for readLines, seq_len in seqreader.read_fastq(fin, raw=True):
             if seq_len >= cutoff:
                 fout.write(readLines)
                 readCount += 1
     elif fileType == "fasta":
-        for readLines in getReadFromFasta(fin):
-            seq_len = sum(map(len, readLines.split("\n")[1:]))
+        for readLines, seq_len in seqreader.read_fasta(fin, raw=True):
             if seq_len >= cutoff:
                 fout.write(readLines)
                 readCount += 1
     sys.stderr.write("Total number of sequences longer than {} is {}\n".format(cutoff, readCount))
 
 
-def get_long_reads(inputFile,outFile=None,cutoff=1000, fileType=None):
+def get_long_reads(inputFile,outFile=None,cutoff=1000, fileType=None, threads=1):
     ''' Extract sequences longer than the specified cutoff from inputFile
-        Input:  inputFile - file including all the sequences to investigate
-                outFile - output file with long sequences
+        Input:  inputFile - file including all the sequences to investigate, can be gzip/BGZF compressed
+                outFile - output file with long sequences, compressed (BGZF) if it ends in .gz
                 cutoff - length cutoff
+                threads - number of threads decompressing the input and compressing the output
         Output: outFile
     '''
     if fileType is None:
-        fileExt = inputFile.split(".")[-1] # file type, fasta or fastq, autodetect
-        if fileExt in ["fa", "Fa", "fasta", "Fasta"]:  # either fa or fq
-            fileType = "fasta" 
-        elif fileExt in ["fq", "Fq", "fastq", "Fastq"]:  # either fa or fq
-            fileType = "fastq" 
-        else:
+        fileType = seqreader.file_type(inputFile) # file type, fasta or fastq, autodetect
+        if fileType is None:
             sys.stderr.write("File type is not correct...\n") 
 
     if inputFile is not None and not os.path.exists(inputFile):
@@ -76,12 +45,8 @@ def get_long_reads(inputFile,outFile=None,cutoff=1000, fileType=None):
         if not os.path.exists(outDir):
             os.makedirs(outDir)
         
-    fin = sys.stdin
-    fout = sys.stdout
-    if inputFile is not None:
-        fin = open(inputFile, 'r')
-    if outFile is not None:
-        fout = open(outFile, 'w')
+    fin = gzio.open_input(inputFile, threads) # standard input if inputFile is None
+    fout = gzio.open_output(outFile, threads) # standard output if outFile is None
     get_long_reads_1(fin, fout, fileType,cutoff)
     if inputFile is not None:
         fin.close()
@@ -101,13 +66,14 @@ parser = argparse.ArgumentParser(description="Extract sequences longer than the
                                  )
 
 ## input files and directories
-parser.add_argument("-i","--in",help="input file, if not specified, use standard input",dest='inputFile')
+parser.add_argument("-i","--in",help="input file (can be gzip/BGZF compressed), if not specified, use standard input",dest='inputFile')
 parser.add_argument("-c","--cutoff",help="length cutoff",dest='cutoff',default=1000, type=int)
 
 ## options
 parser.add_argument("-t", "--type", help="type of input file, fasta or fastq", dest="fileType")
 ## output directory
-parser.add_argument("-o","--out",help="output file, default is standard output",dest='outFile',default=None)
+parser.add_argument("-o","--out",help="output file, compressed (BGZF) if it ends in .gz, default is standard output",dest='outFile',default=None)
+parser.add_argument("--threads",help="number of threads for decompressing the input and compressing the output",dest='threads',default=1,type=int)
 
 ## =================================================================
 ## main function
@@ -119,7 +85,7 @@ def main(argv=None):
     if args.inputFile is None and args.fileType is None:
         sys.stderr.write("Reading from standard input, file type need to be specified.\n")
     else:
-        get_long_reads(args.inputFile, args.outFile, args.cutoff, args.fileType)
+        get_long_reads(args.inputFile, args.outFile, args.cutoff, args.fileType, args.threads)
 ##==============================================================
 ## call from command line (instead of interactively)
 ##==============================================================
@@ -0,0 +1,314 @@
+#!/usr/bin/python
+
+''' Transparent compressed input and output for the sequence tools.
+    open_input recognizes gzip (and BGZF, which is multi-member gzip) files by their first bytes and returns a file-like
+    object of the decompressed stream. The data is inflated by a background thread while the caller parses it (zlib releases
+    the GIL); BGZF blocks can also be inflated by several threads at once (bamreader.BgzfReader).
+    open_output writes a file ending in .gz as BGZF: 64KB blocks compressed by a pool of threads, each block a gzip member,
+    so gzip/zcat and samtools/tabix can read it.
+    Plain files are opened as usual. '-' (or None) is the standard input or output; the standard input is decompressed too if it
+    starts with the gzip magic bytes (one background thread, BGZF is read as multi-member gzip).
+'''
+import sys
+import zlib
+import struct
+import threading
+import Queue
+from multiprocessing.pool import ThreadPool
+import bamreader
+
+GZIP_MAGIC = '\x1f\x8b'
+CHUNK_SIZE = 1 << 20 # bytes read or inflated at a time
+BGZF_BLOCK_DATA = 0xff00 # uncompressed bytes per BGZF block, so that a compressed block always fits in 64KB
+BGZF_EOF = '\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00' # empty block at the end of a BGZF file
+
+## ======================================================================
+def is_gzip(fileName):
+    ''' True if the file starts with the gzip magic bytes (gzip or BGZF) '''
+    with open(fileName, 'rb') as f:
+        return f.read(2) == GZIP_MAGIC
+## ======================================================================
+class PeekedStream(object):
+    ''' A stream whose first bytes were already read (to look for the gzip magic bytes), read like the stream itself
+        Input:  handle - open file object, e.g. sys.stdin
+                head - bytes already read from handle
+    '''
+    def __init__(self, handle, head):
+        self.handle = handle
+        self.name = getattr(handle, 'name', '<stream>')
+        self._head = head
+
+    def read(self, size=-1):
+        head = self._head
+        if not head:
+            return self.handle.read(size)
+        if 0 <= size <= len(head):
+            self._head = head[size:]
+            return head[:size]
+        self._head = ''
+        return head + self.handle.read(size - len(head) if size > 0 else -1)
+
+    def readline(self):
+        head = self._head
+        if not head:
+            return self.handle.readline()
+        end = head.find('\n')
+        if end >= 0:
+            self._head = head[(end + 1):]
+            return head[:(end + 1)]
+        self._head = ''
+        return head + self.handle.readline()
+
+    def __iter__(self):
+        line = self.readline()
+        while line:
+            yield line
+            line = self.readline()
+
+    def close(self):
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+## ======================================================================
+class InflateReader(object):
+    ''' Decompressed stream of a gzip or BGZF file, with read(), readline() and iteration over lines like a file object.
+        A background thread inflates chunks of the file into a bounded queue.
+        Input:  fileName - gzip or BGZF file name
+                threads - number of threads inflating BGZF blocks (gzip files are inflated by the background thread only)
+                queue_size - number of inflated chunks kept ahead of the reader
+                handle - open stream of gzip data to read instead of the file (e.g. PeekedStream of the standard input), fileName is only its name
+    '''
+    def __init__(self, fileName, threads=1, queue_size=8, handle=None):
+        self.name = fileName
+        self._queue = Queue.Queue(queue_size)
+        self._closed = False
+        self._buffer = '' # current inflated chunk
+        self._pos = 0 # offset in the current chunk
+        self._eof = False
+        if handle is not None:
+            chunks = self._gzip_chunks(handle)
+        elif bamreader.is_bgzf(fileName):
+            chunks = self._bgzf_chunks(fileName, threads)
+        else:
+            chunks = self._gzip_chunks(open(fileName, 'rb'))
+        self._thread = threading.Thread(target=self._produce, args=(chunks,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _gzip_chunks(self, handle):
+        ''' Inflated chunks of an open gzip file, all the members one after another '''
+        with handle:
+            inflater = zlib.decompressobj(16 + zlib.MAX_WBITS) # gzip header and trailer
+            data = handle.read(CHUNK_SIZE)
+            while data:
+                chunk = inflater.decompress(data)
+                if chunk:
+                    yield chunk
+                data = inflater.unused_data # start of the next member
+                if data:
+                    inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                else:
+                    data = handle.read(CHUNK_SIZE)
+            chunk = inflater.flush()
+            if chunk:
+                yield chunk
+
+    def _bgzf_chunks(self, fileName, threads):
+        ''' Inflated chunks of a BGZF file '''
+        bgzf = bamreader.BgzfReader(fileName, threads)
+        try:
+            chunk = bgzf.read(CHUNK_SIZE)
+            while chunk:
+                yield chunk
+                chunk = bgzf.read(CHUNK_SIZE)
+        finally:
+            bgzf.close()
+
+    def _produce(self, chunks):
+        ''' Background thread: put the inflated chunks in the queue, then None (or the exception raised) '''
+        try:
+            for chunk in chunks:
+                if self._closed:
+                    break
+                self._queue.put(chunk)
+            else:
+                self._queue.put(None)
+        except Exception as error:
+            self._queue.put(error)
+        finally:
+            chunks.close() # closes the input file
+
+    def _fill(self):
+        ''' Move to the next inflated chunk, False at the end of the stream '''
+        if self._eof:
+            return False
+        chunk = self._queue.get()
+        if isinstance(chunk, Exception):
+            self._eof = True
+            raise IOError("error reading {}: {}".format(self.name, chunk))
+        if chunk is None:
+            self._eof = True
+            return False
+        self._buffer = chunk
+        self._pos = 0
+        return True
+
+    def read(self, size=-1):
+        ''' Next size bytes (all the rest if size < 0), fewer at the end of the stream '''
+        pieces = []
+        while size != 0:
+            if self._pos >= len(self._buffer) and not self._fill():
+                break
+            end = len(self._buffer) if size < 0 else min(len(self._buffer), self._pos + size)
+            pieces.append(self._buffer[self._pos:end])
+            if size > 0:
+                size -= end - self._pos
+            self._pos = end
+        return pieces[0] if len(pieces) == 1 else ''.join(pieces)
+
+    def readline(self):
+        ''' Next line, including the newline character, '' at the end of the stream '''
+        end = self._buffer.find('\n', self._pos)
+        if end >= 0: # within the current chunk
+            line = self._buffer[self._pos:(end + 1)]
+            self._pos = end + 1
+            return line
+        pieces = []
+        while True:
+            if self._pos >= len(self._buffer) and not self._fill():
+                break
+            end = self._buffer.find('\n', self._pos)
+            if end >= 0:
+                pieces.append(self._buffer[self._pos:(end + 1)])
+                self._pos = end + 1
+                break
+            pieces.append(self._buffer[self._pos:])
+            self._pos = len(self._buffer)
+        return ''.join(pieces)
+
+    def __iter__(self):
+        line = self.readline()
+        while line:
+            yield line
+            line = self.readline()
+
+    def close(self):
+        ''' Stop the background thread '''
+        self._closed = True
+        while self._thread.is_alive(): # unblock the thread if it waits for room in the queue
+            try:
+                self._queue.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+## ======================================================================
+def deflate_block(data, level=6):
+    ''' One BGZF block (gzip member with the BC extra field) of at most BGZF_BLOCK_DATA bytes of data '''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15) # raw deflate stream
+    cdata = compressor.compress(data) + compressor.flush()
+    bsize = 18 + len(cdata) + 8 - 1 # total block size - 1: header, compressed data, CRC32 and ISIZE
+    return bamreader.BGZF_MAGIC + '\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00' + struct.pack('<H', bsize) + cdata + struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
+## ======================================================================
+def _deflate_level(args):
+    return deflate_block(*args)
+## ======================================================================
+class BgzfWriter(object):
+    ''' Write a BGZF file, with write() and writelines() like a file object.
+        The data is cut into blocks which are compressed by a pool of threads in batches, while the caller goes on writing.
+        Input:  fileName - output file name
+                threads - number of threads compressing blocks
+                level - zlib compression level
+                batch_blocks - number of blocks compressed together
+    '''
+    def __init__(self, fileName, threads=1, level=6, batch_blocks=64):
+        self.name = fileName
+        self.handle = open(fileName, 'wb')
+        self.pool = ThreadPool(max(1, threads))
+        self.level = level
+        self.batch_size = BGZF_BLOCK_DATA * batch_blocks
+        self._pieces = [] # data not compressed yet
+        self._size = 0
+        self._pending = None # batch being compressed
+
+    def write(self, data):
+        self._pieces.append(data)
+        self._size += len(data)
+        if self._size >= self.batch_size:
+            self._compress(final=False)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def _compress(self, final):
+        ''' Start compressing the buffered data, the last partial block is kept unless final.
+            The previous batch is written first, so at most one batch is compressed in the background.
+        '''
+        data = ''.join(self._pieces)
+        end = len(data) if final else len(data) - len(data) % BGZF_BLOCK_DATA
+        blocks = [(data[i:(i + BGZF_BLOCK_DATA)], self.level) for i in xrange(0, end, BGZF_BLOCK_DATA)]
+        self._pieces = [data[end:]] if end < len(data) else []
+        self._size = len(data) - end
+        self._write_pending()
+        self._pending = self.pool.map_async(_deflate_level, blocks)
+
+    def _write_pending(self):
+        if self._pending is not None:
+            self.handle.write(''.join(self._pending.get()))
+            self._pending = None
+
+    def close(self):
+        if self.handle.closed:
+            return
+        self._compress(final=True)
+        self._write_pending()
+        self.handle.write(BGZF_EOF)
+        self.handle.close()
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+## ======================================================================
+def open_input(fileName, threads=1):
+    ''' Open a sequence (or any text) file for reading, gzip and BGZF files are decompressed
+        Input:  fileName - file name, '-' or None for the standard input
+                threads - number of threads inflating a BGZF file
+        Output: file object (PeekedStream for the standard input), or InflateReader for compressed data
+    '''
+    if fileName is None or fileName == '-':
+        head = sys.stdin.read(len(GZIP_MAGIC))
+        stdin = PeekedStream(sys.stdin, head)
+        if head == GZIP_MAGIC:
+            return InflateReader(stdin.name, threads, handle=stdin)
+        return stdin
+    if is_gzip(fileName):
+        return InflateReader(fileName, threads)
+    return open(fileName, 'r')
+## ======================================================================
+def open_output(fileName, threads=1, level=6):
+    ''' Open a file for writing, as BGZF if its name ends in .gz
+        Input:  fileName - file name, '-' or None for the standard output
+                threads - number of threads compressing the blocks
+        Output: file object, or BgzfWriter
+    '''
+    if fileName is None or fileName == '-':
+        return sys.stdout
+    if fileName.endswith('.gz'):
+        return BgzfWriter(fileName, threads, level)
+    return open(fileName, 'w')
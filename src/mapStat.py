@@ -11,6 +11,7 @@
     
 '''
 import re
+import cigar_parser
 
 ## ======================================================================
 ## From CIGAR string, find number of indels and substitutions  
@@ -20,29 +21,9 @@ import re
 def cigar(cigar_string):
     """ parse CIGAR string from .sam file, find number of matches, mismatches, insertion (to ref), deletion,
         soft clipping, hard clipping, padding
-        return: 1-level dictionary
+        return: CigarInfo object (cached by CIGAR string, read-only), fields accessible as a 1-level dictionary
     """
-    char = re.findall('\D',cigar_string) # operation characters, MIDNSHP=X
-    char = [x.upper() for x in char]  # convert to upper case
-    count = map(int,re.findall('\d+',cigar_string))
-    read_len = sum(count[i] for i in xrange(len(char)) if char[i] in 'MIS=XH') # length of the mapped read (including clipped part)
-    seq_len = sum(count[i] for i in xrange(len(char)) if char[i] in 'MI=X') # length of the mapped read (excluding lipped part)
-    ref_region_len = sum(count[i] for i in xrange(len(char)) if char[i] in 'MD=X') # length of the region on the reference sequence corresponding to the read
-    ins_len = sum(count[i] for i in xrange(len(char)) if char[i] == 'I') # insert bps
-    del_len = sum(count[i] for i in xrange(len(char)) if char[i] == 'D') # deletion bps
-
-    match_len = None # these are only available with X= in the cigar string, sam 1.4 and after
-    sub_len = None
-    if '=' in char or 'X' in char: # if either '=' or 'X' is detected, indicating sam 1.4 format for CIGAR string
-        match_len = sum(count[i] for i in xrange(len(char)) if char[i] == '=') # matched bps
-        sub_len = sum(count[i] for i in xrange(len(char)) if char[i] == 'X') # substitution bps
-        align_len = match_len + sub_len
-    else:   # sam 1.3, aligned bps from 'M'
-        align_len = sum(count[i] for i in xrange(len(char)) if char[i] == 'M') # aligned bps(including matching and substitution)
-
-    pad_len = sum(count[i] for i in xrange(len(char)) if char[i] == 'P') # padded bps, inserted both in reference sequence and the read sequence)
-    return {'read_len':read_len, 'seq_len': seq_len, 'ref_len':ref_region_len, 'ins_len':ins_len, 'del_len':del_len, 'match_len':match_len, 'sub_len':sub_len, 'align_len':align_len, 'pad_len':pad_len}
-
+    return cigar_parser.cigar_info(cigar_string)
     
 ##################################################################
 ## From MD tag, find the number of matched, deletion, and substitution bps 
@@ -166,11 +147,6 @@ def readAlign(alignRecord):
     else:
         NM = None
     
-    char = re.findall('\D',cigarstring) # operation characters, MIDNSHP=X
-    char = [x.upper() for x in char]  # convert to upper case
-    count = map(int,re.findall('\d+',cigarstring))
-    #print cigarstring, '\t',len(char), '\t', len(count)
-
     positions = []
     if cigarstring == '*':
         cigar = [(0,'M')]
@@ -178,7 +154,7 @@ def readAlign(alignRecord):
         qstart = 0
         qend = 0
     else:
-        cigar = [(count[x], char[x]) for x in xrange(len(char))]
+        cigar = list(cigar_parser.cigar_info(cigarstring).ops) # (count, operation) pairs
 
         lastBp = rstart-1
         for bp, ch in cigar:
@@ -12,49 +12,24 @@ import argparse
 import time
 import re
 import itertools
-## =================================================================
-## Function: getRead
-## =================================================================
-def getReadFromFasta(fin):
-    output = ""
-    for line in fin:
-        if line[0] != ">":
-            output += line
-        else:
-            yield output
-            output = line
-    yield output
-
-
-def getReadFromFastq(fin):
-    output = ""
-    count = 0
-    for line in fin:
-        if count != 4:
-            output += line
-            count = count + 1
-        else:
-            yield output
-            output = line
-            count = 1
-    yield output
-
-
+import seqreader
+import gzio
 ## =================================================================
 ## Function: splitReads
 ## =================================================================
 def mergeFastq(Fastq1, Fastq2, out):
     ''' Merge 2 fastq files with paired end reads into one interleaved fastq file
-        Input:  2 fastq files with paired end reads
+        Input:  2 fastq files with paired end reads (file names or file objects, possibly compressed)
         Output: interleaved merged file, default: sys.stdout
     '''
     count = 0
         
-    for (r1,r2) in itertools.izip(getReadFromFastq(Fastq1), getReadFromFastq(Fastq2)):
-        out.write('{}{}'.format(r1,r2))
+    for (r1,r2) in itertools.izip(seqreader.read_fastq(Fastq1, raw=True), seqreader.read_fastq(Fastq2, raw=True)):
+        out.write(r1[0])
+        out.write(r2[0])
         count = count + 1
         if count > 0 and count % 10000 == 0:
-            sys.stderr.write("Merged {} reads..\n".formate(count))
+            sys.stderr.write("Merged {} reads..\n".format(count))
     return count
 
 
@@ -71,10 +46,11 @@ parser = argparse.ArgumentParser(description="Split big equence file in fasta/fa
                                  )
 
 ## input files and directories
-parser.add_argument("fastqs", help = "2 fastq files to merge", nargs=2, type=argparse.FileType('r'))
+parser.add_argument("fastqs", help = "2 fastq files to merge, can be gzip/BGZF compressed, - for the standard input", nargs=2)
 
 ## output directory
-parser.add_argument("-o","--out",help="output fastq file",dest='outputFile',default=sys.stdout, type=argparse.FileType('w'))
+parser.add_argument("-o","--out",help="output fastq file, compressed (BGZF) if it ends in .gz, default (or -) is standard output",dest='outputFile',default=None)
+parser.add_argument("-t","--threads",help="number of threads for decompressing the input and compressing the output",dest='threads',default=1,type=int)
 
 parser.add_argument("-v","--verbose",help="verbose, more output",action='store_true',dest='verbose')
 ## =================================================================
@@ -88,7 +64,14 @@ def main(argv=None):
     sys.stderr.write("\n===========================================================\n")
     start_time = time.time()
 
-    seq_count = mergeFastq(args.fastqs[0], args.fastqs[1], args.outputFile)
+    fastq1 = gzio.open_input(args.fastqs[0], args.threads)
+    fastq2 = gzio.open_input(args.fastqs[1], args.threads)
+    out = gzio.open_output(args.outputFile, args.threads)
+    seq_count = mergeFastq(fastq1, fastq2, out)
+    fastq1.close()
+    fastq2.close()
+    if out is not sys.stdout:
+        out.close()
     if args.verbose:
         sys.stderr.write("Total number of reads: {}\n".format(seq_count))
 
@@ -10,6 +10,8 @@ Created on Wed, Aug 20, 14:06:18 2014
 import sys, os
 import argparse
 import metalrec_lib
+import array_cache
+import multiprocessing
 import numpy
 import time
 import re
@@ -28,17 +30,20 @@ parser = argparse.ArgumentParser(description="Error correction of a PacBio read
 
 ## input files and directories
 parser.add_argument("-i","--in",help="input ref sequence file",dest='seqFile',required=True)
-parser.add_argument("-s","--sam",help="input sam file",dest='samFile',required=True)
+parser.add_argument("-s","--sam",help="input sam or BAM file",dest='samFile',required=True)
+parser.add_argument("--ref",help="only use the alignments to this reference (PacBio read) name, for a big sam or BAM file sorted by reference; it is indexed the first time (see samindex)",dest='refName',default=None)
 
 ## output directory
 parser.add_argument("-o","--out",help="output corrected PacBio sequence file",dest='oSeqFile',default=None)
 parser.add_argument("-od","--outDir",help="directory for the intermediate files",dest='outDir',default = None)
+parser.add_argument("--cacheDir",help="directory to keep the arrays computed before gap filling, reruns with the same input and thresholds start at gap filling (not used in verbose mode)",dest='cacheDir',default = None)
 
 # options
 #parser.add_argument("-m",help="read mode, s(ingle) or p(air)",dest='rMode',default='p',choices=['s','p'])
 parser.add_argument("-v","--verbose",help="verbose, more output",action='store_true',dest='verbose')
 parser.add_argument("--width",help="print width for sequences in verbose output",dest='width', default = 100, type = int)
 parser.add_argument("--checkEnds",help="check the substitution errors at the ends",dest='checkEnds', action='store_false')
+parser.add_argument("-p","--processes",help="number of processes to correct the good regions in parallel",dest='region_proc',default=1, type=int)
 
 ## setting thresholds
 parser.add_argument("--minOverlap",help="minimum overlap length between reads",dest='minOverlap',default=10, type=int)
@@ -52,6 +57,145 @@ parser.add_argument("--minCV",help="minimum coverage depth",dest='minCV',default
 parser.add_argument("--minPacBioLen",help="minimum PacBio length to be considered",dest='minPacBioLen',default=1000, type=int)
 parser.add_argument("--minGoodLen",help="minimum contiguous well covered region length",dest='minGoodLen',default=400, type=int)
 ## =================================================================
+## error correction of one good region
+## =================================================================
+_region_data = None # read information of the PacBio read being corrected, set by correct_read and inherited by the forked region workers
+
+def correct_region(good_region_index):
+    ''' Error correct one good region of the PacBio read, the regions are independent of each other
+        Input:  good_region_index - index of the region in the list of good regions
+                _region_data - (args, rseq, ref_bps, ref_ins_dict, read_info, good_regions, seqName, cache) of the PacBio read, read only
+        Output: record - fasta record (header and sequence lines) of the corrected region, None if no good read covers the region
+    '''
+    args, rseq, ref_bps, ref_ins_dict, read_info, good_regions, seqName, cache = _region_data
+    sys.stderr.write("====\nworking on region {}\n".format(good_region_index))
+    if cache is not None and cache.has_region(good_region_index): # steps 1 to 5 were done by an earlier run
+        type_array, read_array, read_counts = cache.load_region(good_region_index)
+        sys.stderr.write("read array loaded from cache\n")
+    else:
+        # step 1 - find consensus, polymorphic positions, and coverage depths for the PacBio read
+        poly_bps, poly_ins, consensus_bps, consensus_ins, cvs = metalrec_lib.get_poly_pos(ref_bps, ref_ins_dict, good_regions[good_region_index])
+        # step 2 - extend the PacBio sequence to include the insertion positions, and find the correspondance between positions from original and extened sequences
+        newSeq, bp_pos_dict, ins_pos_dict = metalrec_lib.ref_extension(poly_bps, poly_ins, consensus_bps, consensus_ins, rseq, region=good_regions[good_region_index],print_width=args.width, verbose=args.verbose)
+        # step 3 - update consensus and polymorphic positions according to the new positons in the extended sequence
+        poly_bps_ext, poly_ins_ext, consensus_bps_ext, consensus_ins_ext = metalrec_lib.update_pos_info(poly_bps, poly_ins, consensus_bps, consensus_ins, bp_pos_dict, ins_pos_dict)
+        # step 4 - make array to indicate the type for each position on the extended PacBio sequence
+        type_array, coordinates = metalrec_lib.make_type_array(poly_bps_ext, poly_ins_ext, consensus_bps_ext, consensus_ins_ext,verbose=args.verbose)
+        # step 5 - construct array for all the reads that passed the specified threshold, and number of repeats for each unique read (single or paired)
+        read_array, read_counts = metalrec_lib.make_read_array(read_info, bp_pos_dict, ins_pos_dict, type_array, poly_bps_ext, poly_ins_ext, consensus_bps_ext, consensus_ins_ext, ext_region=coordinates, banded=True)
+        if cache is not None:
+            cache.save_region(good_region_index, type_array, read_array, read_counts)
+    if not read_array.any(): # if all read calls for 0
+        sys.stderr.write("PacBio read does not have any good reads covering the region.\n")
+        return None
+    else:
+        # step 6 - find error corrected sequence by filling the gaps in the greedy fashion
+        if args.verbose:
+            region_outdir = args.outDir+'region' + str(good_region_index)
+            fastaFile = args.outDir + 'goodreads.fasta'
+        else:
+            region_outdir = None
+            fastaFile = None
+        ref_new = metalrec_lib.fill_gap(read_array,args.minOverlap,args.minOverlapRatio, fastaFile, region_outdir, read_info, verbose=args.verbose)
+        # step 7 - convert the array for the new PacBio sequence to string of nucleotides
+        contiguous_seqs = metalrec_lib.split_at_gap(ref_new[2], ref_new[0])
+        contiguous_lengths = numpy.array(map(len, contiguous_seqs))
+        max_ind = numpy.argmax(contiguous_lengths)
+        # in verbose mode, print the comparison between the original sequence, the extended sequence, and the corrected sequence
+        ## write the newly corrected sequence to the output sequence file
+        # header format: >1 (0, 1048) gap length: 16
+        #refOut.write('>{}/{}_{}_M ({}, {}) length: {}\n{}\n'.format(seqName, good_region_index,max_ind, good_regions[good_region_index][0], good_regions[good_region_index][1], ref_new[1], contiguous_seqs[max_ind]))
+        record = '>{}/{} ({}, {}) scrub; length: {}\n'.format(seqName, good_region_index, good_regions[good_region_index][0], good_regions[good_region_index][1], ref_new[1])
+        start = 0
+        outString = contiguous_seqs[max_ind]
+        while start < contiguous_lengths[max_ind]:
+            record += outString[start:min(start+100, len(outString))] + "\n"
+            start = start + 100
+        return record
+        #if len(contiguous_seqs) > 1:
+        #    for i in xrange(len(contiguous_seqs)):
+        #        if i != max_ind:
+        #            shortOut.write('>{}/{}_{} ({}, {}) length: {}\n{}\n'.format(seqName, good_region_index, i,  good_regions[good_region_index][0], good_regions[good_region_index][1], contiguous_lengths[i], contiguous_seqs[i]))
+## =================================================================
+## error correction of one PacBio read
+## =================================================================
+def correct_read(args):
+    ''' Error correct one PacBio read, given the options parsed by parser (or the same attributes set some other way, e.g. by metalrec_batch)
+        Input:  args - seqFile, samFile, thresholds, verbose, outDir, width and checkEnds, optionally cacheDir and refName
+        Output: records - list of fasta records (header and sequence lines) of the corrected good regions
+    '''
+    records = []
+    # read the PacBio sequence into memory
+    rseq = metalrec_lib.read_single_seq(args.seqFile)
+    # arrays cached by an earlier run with the same input and thresholds
+    cache = None
+    sam_info = None
+    if getattr(args, 'cacheDir', None) is not None:
+        if args.verbose:
+            sys.stderr.write("array cache is not used in verbose mode\n")
+        else:
+            cache = array_cache.ArrayCache.for_args(args)
+            if cache.has_pileup():
+                ref_bps, ref_ins_dict = cache.load_pileup()
+                good_regions = metalrec_lib.get_good_regions(ref_bps, rseq, minGoodLen=args.minGoodLen, minCV=args.minCV)[0]
+                if all(cache.has_region(i) for i in xrange(len(good_regions))): # the reads are only needed for the regions that are not cached
+                    sam_info = (ref_bps, ref_ins_dict, None)
+                    sys.stderr.write("pileup and read arrays loaded from cache {}\n".format(cache.dir))
+    if sam_info is None:
+        # process sam file and save the read info
+        s_time = time.time()
+        sam_info = metalrec_lib.read_and_process_sam_samread(args.samFile, rseq, maxSub=args.maxSub, maxIns=args.maxIns, maxDel=args.maxDel,maxSubRate=args.maxSubRate, maxInDelRate=args.maxInDelRate, minPacBioLen=args.minPacBioLen, checkEnds=args.checkEnds, outDir=args.outDir, verbose=args.verbose, refName=getattr(args, 'refName', None))
+        e_time = time.time()
+        sys.stderr.write("processing sam file time :" + str(e_time - s_time) +  " second\n")
+        if sam_info == 0: # PacBio read is shorter than minPacBioLen
+            sys.stderr.write("PacBio read is shorter than {}\n".format(args.minPacBioLen))
+            return records
+        if cache is not None:
+            cache.save_pileup(sam_info[0], sam_info[1])
+    ref_bps, ref_ins_dict, read_info = sam_info
+
+    if len(ref_bps) == 0: # empty sam file, or nothing
+        sys.stderr.write("PacBio read does not have any coverage from Illumina reads\n")
+    else:
+        good_regions, cov_bps, avg_cov_depth = metalrec_lib.get_good_regions(ref_bps, rseq, minGoodLen=args.minGoodLen, minCV=args.minCV) # find good regions for the Good read
+        sys.stderr.write("covered bps: {}\naverage coverage depth: {}\n".format(cov_bps, avg_cov_depth))
+        if len(good_regions) == 0 :
+            sys.stderr.write("PacBio read does not have any good region covered by the Illumina reads")
+        else: # examine good regions one by one
+            # first print out all good regions
+            sys.stderr.write("Good regions:\n")
+            for i in good_regions:
+                sys.stderr.write('({}, {}): {}\t'.format(i[0], i[1], i[1] - i[0])) # (start_pos, end_pos): length of this good region
+            sys.stderr.write('\n')
+
+            seqName = os.path.basename(args.seqFile).split('.')[0] # e.g. m130828_041445_00123_c100564312550000001823090912221381_s1_p0__58103__7045_8127.fasta
+            seqName = re.sub('__','/',seqName) # change __ back to /
+            # try to correct PacBio sequence at each good region
+            global _region_data
+            _region_data = (args, rseq, ref_bps, ref_ins_dict, read_info, good_regions, seqName, cache)
+            nproc = min(args.region_proc, len(good_regions))
+            try:
+                if nproc > 1: # the workers are forked after _region_data is set, so they share it without copying
+                    region_order = sorted(xrange(len(good_regions)), key=lambda i: good_regions[i][0] - good_regions[i][1]) # longest regions first
+                    pool = multiprocessing.Pool(processes=nproc)
+                    try:
+                        region_records = dict(zip(region_order, pool.imap(correct_region, region_order)))
+                        pool.close()
+                    except:
+                        pool.terminate()
+                        raise
+                    finally:
+                        pool.join()
+                else:
+                    region_records = dict((i, correct_region(i)) for i in xrange(len(good_regions)))
+            finally:
+                _region_data = None
+            for good_region_index in xrange(len(good_regions)): # records are written in region order
+                if region_records[good_region_index] is not None:
+                    records.append(region_records[good_region_index])
+
+    return records
+## =================================================================
 ## main function
 ## =================================================================
 def main(argv=None):
@@ -103,78 +247,11 @@ def main(argv=None):
         sys.stderr.write("verbose mode: {}\n".format(args.verbose))
         sys.stderr.write("check substitution error rate at ends: {}\n".format(args.checkEnds))
 
-    # read the PacBio sequence into memory
-    rseq = metalrec_lib.read_single_seq(args.seqFile)
-    # process sam file and save the read info
-    s_time = time.time()
-    ref_bps, ref_ins_dict, read_info = metalrec_lib.read_and_process_sam_samread(args.samFile, rseq, maxSub=args.maxSub, maxIns=args.maxIns, maxDel=args.maxDel,maxSubRate=args.maxSubRate, maxInDelRate=args.maxInDelRate, minPacBioLen=args.minPacBioLen, checkEnds=args.checkEnds, outDir=args.outDir, verbose=args.verbose)
-    e_time = time.time()
-    sys.stderr.write("processing sam file time :" + str(e_time - s_time) +  " second\n")
-
-    if len(ref_bps) == 0: # empty sam file, or nothing
-        sys.stderr.write("PacBio read does not have any coverage from Illumina reads\n")
-    else:
-        good_regions, cov_bps, avg_cov_depth = metalrec_lib.get_good_regions(ref_bps, rseq, minGoodLen=args.minGoodLen, minCV=args.minCV) # find good regions for the Good read
-        sys.stderr.write("covered bps: {}\naverage coverage depth: {}\n".format(cov_bps, avg_cov_depth))
-        if len(good_regions) == 0 :
-            sys.stderr.write("PacBio read does not have any good region covered by the Illumina reads")
-        else: # examine good regions one by one
-            # first print out all good regions
-            sys.stderr.write("Good regions:\n")
-            for i in good_regions:
-                sys.stderr.write('({}, {}): {}\t'.format(i[0], i[1], i[1] - i[0])) # (start_pos, end_pos): length of this good region
-            sys.stderr.write('\n')
-
-            seqName = os.path.basename(args.seqFile).split('.')[0] # e.g. m130828_041445_00123_c100564312550000001823090912221381_s1_p0__58103__7045_8127.fasta
-            seqName = re.sub('__','/',seqName) # change __ back to /
-            # try to correct PacBio sequence at each good region
-            for good_region_index in xrange(len(good_regions)):
-                sys.stderr.write("====\nworking on region {}\n".format(good_region_index))
-                # step 1 - find consensus, polymorphic positions, and coverage depths for the PacBio read
-                poly_bps, poly_ins, consensus_bps, consensus_ins, cvs = metalrec_lib.get_poly_pos(ref_bps, ref_ins_dict, good_regions[good_region_index])
-                # step 2 - extend the PacBio sequence to include the insertion positions, and find the correspondance between positions from original and extened sequences
-                newSeq, bp_pos_dict, ins_pos_dict = metalrec_lib.ref_extension(poly_bps, poly_ins, consensus_bps, consensus_ins, rseq, region=good_regions[good_region_index],print_width=args.width, verbose=args.verbose)
-                # step 3 - update consensus and polymorphic positions according to the new positons in the extended sequence
-                poly_bps_ext, poly_ins_ext, consensus_bps_ext, consensus_ins_ext = metalrec_lib.update_pos_info(poly_bps, poly_ins, consensus_bps, consensus_ins, bp_pos_dict, ins_pos_dict)
-                # step 4 - make array to indicate the type for each position on the extended PacBio sequence
-                type_array, coordinates = metalrec_lib.make_type_array(poly_bps_ext, poly_ins_ext, consensus_bps_ext, consensus_ins_ext,verbose=args.verbose)
-                # step 5 - construct array for all the reads that passed the specified threshold, and number of repeats for each unique read (single or paired)
-                read_array, read_counts = metalrec_lib.make_read_array(read_info, bp_pos_dict, ins_pos_dict, type_array, poly_bps_ext, poly_ins_ext, consensus_bps_ext, consensus_ins_ext, ext_region=coordinates)
-                if not numpy.any(read_array != 0): # if all read calls for 0
-                    sys.stderr.write("PacBio read does not have any good reads covering the region.\n")
-                else:
-                    refOut = open(args.oSeqFile, 'a') # output file for the corrected PacBio sequence (contigs if it is split)
-                    #shortOut = open(shortSeqFile,'a')
-
-                    # step 6 - find error corrected sequence by filling the gaps in the greedy fashion
-                    if args.verbose:
-                        region_outdir = args.outDir+'region' + str(good_region_index)
-                        fastaFile = args.outDir + 'goodreads.fasta'
-                    else:
-                        region_outdir = None
-                        fastaFile = None
-                    ref_new = metalrec_lib.fill_gap(read_array,args.minOverlap,args.minOverlapRatio, fastaFile, region_outdir, read_info, verbose=args.verbose)
-                    # step 7 - convert the array for the new PacBio sequence to string of nucleotides
-                    contiguous_seqs = metalrec_lib.split_at_gap(ref_new[2], ref_new[0])
-                    contiguous_lengths = numpy.array(map(len, contiguous_seqs))
-                    max_ind = numpy.argmax(contiguous_lengths)
-                    # in verbose mode, print the comparison between the original sequence, the extended sequence, and the corrected sequence
-                    ## write the newly corrected sequence to the output sequence file
-                    # header format: >1 (0, 1048) gap length: 16
-                    #refOut.write('>{}/{}_{}_M ({}, {}) length: {}\n{}\n'.format(seqName, good_region_index,max_ind, good_regions[good_region_index][0], good_regions[good_region_index][1], ref_new[1], contiguous_seqs[max_ind]))
-                    refOut.write('>{}/{} ({}, {}) scrub; length: {}\n'.format(seqName, good_region_index, good_regions[good_region_index][0], good_regions[good_region_index][1], ref_new[1]))
-                    start = 0
-                    outString = contiguous_seqs[max_ind]
-                    while start < contiguous_lengths[max_ind]:
-                        refOut.write(outString[start:min(start+100, len(outString))] + "\n")
-                        start = start + 100
-                    #if len(contiguous_seqs) > 1:
-                    #    for i in xrange(len(contiguous_seqs)):
-                    #        if i != max_ind:
-                    #            shortOut.write('>{}/{}_{} ({}, {}) length: {}\n{}\n'.format(seqName, good_region_index, i,  good_regions[good_region_index][0], good_regions[good_region_index][1], contiguous_lengths[i], contiguous_seqs[i]))
-
-                    refOut.close()
-                    #shortOut.close()
+    records = correct_read(args)
+    if len(records) > 0:
+        refOut = open(args.oSeqFile, 'w') # output file for the corrected PacBio sequence (contigs if it is split)
+        refOut.write(''.join(records))
+        refOut.close()
     sys.stderr.write("total time :" + str(time.time() - start_time) +  " seconds")
     sys.stderr.write("\n===========================================================\nDone\n")
 ##==============================================================
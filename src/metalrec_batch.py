@@ -0,0 +1,200 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+"""
+metalrec_batch
+
+Error correction of many PacBio reads on one node, with a number of worker processes instead of one job per read.
+Every read is corrected in its own process, so a worker killed by the system (e.g. out of memory) only loses its read,
+which is logged as failed and can be corrected again by a rerun.
+Input directory has one sub-directory per PacBio read, with the read's fasta file and bbmap.sam (same layout as for correct_PBReads.py).
+"""
+import sys, os
+import argparse
+import copy
+import glob
+import multiprocessing
+import time
+import traceback
+import metalrec
+
+POLL_INTERVAL = 0.5 # seconds between checks of the running workers
+
+EC_NAME = 'EC.fasta' # corrected sequences of a read, written in its directory once it is done
+LOG_NAME = 'metalrec.log' # output of metalrec for a read, in its directory
+CACHE_NAME = 'metalrec_cache' # array cache of a read, in its directory
+
+## =================================================================
+## argument parser
+## =================================================================
+parser = argparse.ArgumentParser(description="Error correction of all PacBio reads in a directory with a pool of processes",
+                                 prog = 'metalrec_batch', #program name
+                                 prefix_chars='-', # prefix for options
+                                 fromfile_prefix_chars='@', # if options are read from file, '@args.txt'
+                                 conflict_handler='resolve', # for handling conflict options
+                                 add_help=True, # include help in the options
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter # print default values for options in help message
+                                 )
+
+## input files and directories
+parser.add_argument("-i","--in",help="input directory, one sub-directory for each PacBio read",dest='inputDir',required=True)
+
+## output
+parser.add_argument("-o","--out",help="output fasta file with the corrected sequences of all reads, appended to if it exists (default: EC_all.fasta in the input directory)",dest='oSeqFile',default=None)
+
+# options
+parser.add_argument("-p","--processes",help="number of worker processes running at the same time",dest='num_proc',default=multiprocessing.cpu_count(), type=int)
+parser.add_argument("--cache",help="keep the arrays computed before gap filling in each read's directory, so a rerun after a failure (or with other minOverlap/minOverlapRatio) starts at gap filling",dest='cache', action='store_true')
+parser.add_argument("--checkEnds",help="check the substitution errors at the ends",dest='checkEnds', action='store_false')
+
+## setting thresholds, same as metalrec
+parser.add_argument("--minOverlap",help="minimum overlap length between reads",dest='minOverlap',default=10, type=int)
+parser.add_argument("--minOverlapRatio",help="minimum ratio of average overlap length between reads",dest='minOverlapRatio',default=0.1, type=float)
+parser.add_argument("--maxSub",help="maximum stretch of substitution",dest='maxSub',default=-1, type=int)
+parser.add_argument("--maxIns",help="maximum stretch of insertion",dest='maxIns',default=-1, type=int)
+parser.add_argument("--maxDel",help="maximum stretch of deletion",dest='maxDel',default=-1, type=int)
+parser.add_argument("--subRate",help="maximum substitution rate allowed",dest='maxSubRate',default=0.05, type=float)
+parser.add_argument("--indelRate",help="maximum insertion rate allowed",dest='maxInDelRate',default=0.30, type=float)
+parser.add_argument("--minCV",help="minimum coverage depth",dest='minCV',default=1, type=int)
+parser.add_argument("--minPacBioLen",help="minimum PacBio length to be considered",dest='minPacBioLen',default=1000, type=int)
+parser.add_argument("--minGoodLen",help="minimum contiguous well covered region length",dest='minGoodLen',default=400, type=int)
+## =================================================================
+## worker: correct one PacBio read
+## =================================================================
+def correct_dir(task):
+    ''' Error correct the PacBio read in one directory, output of metalrec goes to the log file in the directory.
+        Input:  task - (seqDir, args), args has the thresholds for metalrec.correct_read
+        Output: (seqDir, records, error) - records is the list of corrected fasta records, error is None or the error message
+    '''
+    seqDir, args = task
+    seqFiles = [f for f in glob.glob(seqDir + '/*.fasta') if os.path.basename(f) != EC_NAME]
+    samFiles = glob.glob(seqDir + '/bbmap.sam')
+    if len(seqFiles) == 0 or len(samFiles) == 0:
+        return seqDir, None, "fasta file or bbmap.sam not found"
+    args = copy.copy(args)
+    args.seqFile = seqFiles[0]
+    args.samFile = samFiles[0]
+    args.verbose = False
+    args.outDir = None
+    args.width = 100
+    args.region_proc = 1 # regions of a read are corrected in this worker, pool workers cannot start their own pools
+    args.cacheDir = seqDir + '/' + CACHE_NAME if args.cache else None
+    log = open(seqDir + '/' + LOG_NAME, 'w')
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = sys.stderr = log
+    records = None
+    error = None
+    try:
+        records = metalrec.correct_read(args)
+    except Exception as e:
+        traceback.print_exc(file=log)
+        error = "{}: {}".format(type(e).__name__, e)
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+        log.close()
+    return seqDir, records, error
+## ======================================================================
+def run_dir(task, conn):
+    ''' Worker process: correct the PacBio read in one directory and send the result of correct_dir through the pipe conn '''
+    conn.send(correct_dir(task))
+    conn.close()
+## ======================================================================
+def finished_workers(running):
+    ''' Generator of the results of the workers that are done, which are removed from running.
+        Input:  running - dictionary seqDir => (process, receiving end of its pipe)
+        Output: (seqDir, records, error) of each finished worker, error is the exit status if the worker died without a result
+    '''
+    for seqDir, (proc, conn) in running.items():
+        if not conn.poll() and proc.is_alive(): # still working
+            continue
+        try:
+            result = conn.recv()
+        except EOFError: # pipe closed without a result: killed (e.g. out of memory) or crashed
+            result = None
+        proc.join()
+        conn.close()
+        if result is None:
+            result = (seqDir, None, "worker exited with status {} without a result".format(proc.exitcode))
+        del running[seqDir]
+        yield result
+## =================================================================
+## main function
+## =================================================================
+def main(argv=None):
+    # parse command line arguments
+    if argv is None:
+        args = parser.parse_args()
+    else:
+        args = parser.parse_args(argv)
+
+    start_time = time.time()
+    # check input and output file settings
+    if not os.path.exists(args.inputDir):
+        sys.exit("input directory {} does not exist!\n".format(args.inputDir))
+    if args.inputDir[-1] != '/':
+        args.inputDir = args.inputDir + '/'
+    if args.oSeqFile is None:
+        args.oSeqFile = args.inputDir + 'EC_all.fasta'
+    if args.num_proc < 1:
+        sys.exit("number of processes has to be at least 1!\n")
+
+    # directories that are not done yet
+    seqDirs = []
+    doneCount = 0
+    for seqDir in sorted(glob.glob(args.inputDir + '*')): # for every PacBio sequence (directory with alignments)
+        if not os.path.isdir(seqDir):
+            continue
+        seqDir = os.path.abspath(seqDir)
+        if os.path.exists(seqDir + '/' + EC_NAME):
+            doneCount += 1
+        else:
+            seqDirs.append(seqDir)
+    sys.stderr.write("{} directories already done, {} to correct with {} processes\n".format(doneCount, len(seqDirs), args.num_proc))
+
+    refOut = open(args.oSeqFile, 'a') # corrected sequences of all reads, written as soon as a read is done
+    running = dict() # seqDir => (worker process, receiving end of its pipe)
+    todo = list(reversed(seqDirs)) # directories not started yet, popped from the end
+    finished = 0
+    failed = 0
+    try:
+        while len(todo) > 0 or len(running) > 0:
+            while len(todo) > 0 and len(running) < args.num_proc: # start workers
+                seqDir = todo.pop()
+                recv_conn, send_conn = multiprocessing.Pipe(duplex=False)
+                proc = multiprocessing.Process(target=run_dir, args=((seqDir, args), send_conn))
+                proc.start()
+                send_conn.close() # only the worker writes to the pipe
+                running[seqDir] = (proc, recv_conn)
+            done = False
+            for seqDir, records, error in finished_workers(running):
+                done = True
+                if error is not None:
+                    failed += 1
+                    sys.stderr.write("{} failed: {}\n".format(seqDir, error))
+                    continue
+                refOut.write(''.join(records))
+                refOut.flush()
+                # mark the directory as done only after its sequences are in the output file
+                ecOut = open(seqDir + '/' + EC_NAME, 'w')
+                ecOut.write(''.join(records))
+                ecOut.close()
+                finished += 1
+                if finished % 100 == 0:
+                    sys.stderr.write("  corrected {} reads in {} seconds\n".format(finished, time.time() - start_time))
+            if not done:
+                time.sleep(POLL_INTERVAL)
+    except KeyboardInterrupt:
+        for proc, conn in running.values():
+            proc.terminate()
+        raise
+    finally:
+        for proc, conn in running.values():
+            proc.join()
+        refOut.close()
+    sys.stderr.write("corrected {} reads, {} failed, total time: {} seconds\n".format(finished, failed, time.time() - start_time))
+##==============================================================
+## call from command line (instead of interactively)
+##==============================================================
+
+if __name__ == '__main__':
+    sys.exit(main())
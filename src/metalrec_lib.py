@@ -10,7 +10,14 @@ from Bio import pairwise2 # pairwise alignment using dynamic programming
 from Bio.pairwise2 import format_alignment
 # import local module
 import mycolor # print with color in terminal
+import cigar_parser # single-pass cached CIGAR parsing
 import samread # for manipulating sam record
+import samrecord # streaming sam reader
+import samindex # alignments of one reference in a big sorted sam file
+import banded_array # compact read array
+import pileup # base call counts of the aligned reads
+import gap_engine # incremental gap evaluation for greedy_fill_gap
+import read_signatures # array signatures of the unique reads
 alphabet = 'ACGTD'
 def minCover(cv):
     ''' Get minimum read support for a base call to be considered correct
@@ -33,50 +40,9 @@ def dict_to_string(dictionary):
 def cigar(cigar_string):
     """ parse CIGAR string from .sam file, find number of matches, mismatches, insertion (to ref), deletion,
         soft clipping, hard clipping, padding, maximum continuous substitution/insertion/deletion length
-        return: 1-level dictionary
+        return: CigarInfo object (cached by CIGAR string, read-only), fields accessible as a 1-level dictionary
     """
-    char = re.findall('\D',cigar_string) # operation characters, MIDNSHP=X
-    char = [x.upper() for x in char]  # convert to upper case
-    count = map(int,re.findall('\d+',cigar_string))
-    read_len = sum(count[i] for i in xrange(len(char)) if char[i] in 'MIS=XH') # length of the mapped read (including clipped part)
-    seq_len = sum(count[i] for i in xrange(len(char)) if char[i] in 'MI=X') # length of the mapped read (excluding clipped part)
-    ref_region_len = sum(count[i] for i in xrange(len(char)) if char[i] in 'MD=X') # length of the region on the reference sequence corresponding to the read
-    ins_len = sum(count[i] for i in xrange(len(char)) if char[i] == 'I') # insert bps
-    del_len = sum(count[i] for i in xrange(len(char)) if char[i] == 'D') # deletion bps
-    pad_len = sum(count[i] for i in xrange(len(char)) if char[i] == 'P') # padded bps, inserted both in reference sequence and the read sequence)
-    left_clip_len = 0
-    right_clip_len = 0
-    if char[0] in 'SH':
-        left_clip_len = count[0]
-    if char[-1] in 'SH':
-        right_clip_len = count[-1]
-    clip_len = left_clip_len + right_clip_len # clipped bps, including hard and soft clipping, on both end of the reads
-
-    try:
-        max_ins_len = max(count[i] for i in xrange(len(char)) if char[i] == 'I') #  maximum insertion stretch
-    except ValueError:
-        max_ins_len = 0
-
-    try:
-        max_del_len = max(count[i] for i in xrange(len(char)) if char[i] == 'D') #  maximum deletion stretch
-    except ValueError:
-        max_del_len = 0
-
-    match_len = None # these are only available with X= in the cigar string, sam 1.4 and after
-    sub_len = None
-    max_sub_len = 0
-    if '=' in char or 'X' in char: # if either '=' or 'X' is detected, indicating sam 1.4 format for CIGAR string
-        match_len = sum(count[i] for i in xrange(len(char)) if char[i] == '=') # matched bps
-        sub_len = sum(count[i] for i in xrange(len(char)) if char[i] == 'X') # substitution bps
-        try:
-            max_sub_len = max(count[i] for i in xrange(len(char)) if char[i] == 'X') # maximum substitution stretch
-        except ValueError:
-            max_sub_len = 0
-        align_len = match_len + sub_len # aligned bps(including matching and substitution)
-    else:   # sam 1.3, aligned bps from 'M'
-        align_len = sum(count[i] for i in xrange(len(char)) if char[i] == 'M') # aligned bps(including matching and substitution)
-
-    return {'read_len':read_len, 'seq_len': seq_len, 'ref_len':ref_region_len, 'ins_len':ins_len, 'del_len':del_len, 'match_len':match_len, 'sub_len':sub_len, 'align_len':align_len, 'pad_len':pad_len, 'max_ins': max_ins_len, 'max_del': max_del_len, 'max_sub': max_sub_len, 'left_clip_len':left_clip_len, 'right_clip_len':right_clip_len}
+    return cigar_parser.cigar_info(cigar_string)
 ## ======================================================================
 def md(MD_tag):
     """
@@ -168,7 +134,15 @@ def is_record_bad(alignRecord, maxSub=-1, maxIns=-1, maxDel=-1,maxSubRate=0.05,
     except IndexError:
         sys.stderr.write('alignRecord is bad: \n {} \n'.format(alignRecord))
         return True
-
+    return is_alignment_bad(flag, cigarstring, maxSub, maxIns, maxDel, maxSubRate, maxInDelRate)
+## ======================================================================
+def is_alignment_bad(flag, cigarstring, maxSub=-1, maxIns=-1, maxDel=-1,maxSubRate=0.05, maxInDelRate=0.3):
+    ''' Same test as is_record_bad, from the flag and the CIGAR string that were already taken out of the record.
+        Input:  flag - bitwise flag as an integer
+                cigarstring - CIGAR string
+                maxSub, maxIns, maxDel, maxSubRate, maxInDelRate - thresholds, see is_record_bad
+        Output: boolean value, True if bad else False
+    '''
     if flag & 0x4 == 0x4: # read is unmapped (most reliable place to tell if a read is unmapped)
         return True
     elif cigarstring == '*': # if cigar string is not available, treat as bad 
@@ -209,9 +183,9 @@ def get_bases(cigar_string, qseq='', start_pos=None):
         qseq = fields[9]
         start_pos = int(fields[3])
     # cigar operations and the corresponding counts
-    char = re.findall('\D',cigar_string) # operation characters, MIDNSHP=X
-    char = [x.upper() for x in char]  # convert to upper case
-    count = map(int,re.findall('\d+',cigar_string)) # corresponding count for each operation
+    ops = cigar_parser.cigar_info(cigar_string).ops
+    char = [op for n, op in ops] # operation characters, MIDNSHP=X
+    count = [n for n, op in ops] # corresponding count for each operation
 
     # output dictionaries
     pos_dict = dict() # ref_pos (1-based) => base call
@@ -287,20 +261,21 @@ def get_bases_from_align(align, start_pos):
 
     return pos_dict, ins_dict
 ## ======================================================================
-def read_and_process_sam_samread(samFile,rseq, maxSub=-1, maxIns=-1, maxDel=-1,maxSubRate=0.05, maxInDelRate=0.3, minPacBioLen=1000, checkEnds = True, outDir=None, verbose=False):
+def read_and_process_sam_samread(samFile,rseq, maxSub=-1, maxIns=-1, maxDel=-1,maxSubRate=0.05, maxInDelRate=0.3, minPacBioLen=1000, checkEnds = True, outDir=None, verbose=False, refName=None):
     ''' Get consensus sequence from alignments of short reads to a long read, in the process, filter out bad reads and improve mapping
         Uses SamRead class instead of calling all the functions
 
-        Input:  samFile - sam file generated by mapping
+        Input:  samFile - sam (or BAM) file generated by mapping
                 rseq - reference sequence as a string
                 maxSub, maxIns, maxDel, maxSubRate, maxInsRate, maxDelRate are used to filter out badly mapped reads
                 minPacBioLen - contiguous region length threshold to be a good region
                 outDir - output directory where the fasta file including good Illumina reads and cleaner sam file will be stored, only in verbose mode
                 verbose - switch of verbosity
+                refName - only use the alignments to this reference, samFile has to be sorted (see samindex), None to use all the alignments
 
-        Output: ref_bps - list of lists, one for each position on the reference sequence (without padding)
-                ref_ins_dict - dictionary of insertions, one for each insertion position found in the alignments.
-                readinfo - dictionary of read information, info_string => list of names of reads whose mapped segment corresponds to this info_string
+        Output: ref_bps - (rLen x 5) uint32 array, ACGTD base call counts for each position on the reference sequence (without padding)
+                ref_ins_dict - pileup.InsertionTable of insertions, ref_ins_dict[pos] is the (inserted length x 4) ACGT counts array of an insertion position
+                readinfo - read_signatures.ReadSignatures, base calls of the unique reads and names of the reads with each of them
     '''
     alphabet = 'ACGTD' # all the possible base pairs at a position
     keepRec = 0
@@ -326,80 +301,97 @@ def read_and_process_sam_samread(samFile,rseq, maxSub=-1, maxIns=-1, maxDel=-1,m
         newsam = open(outsamFile,'w')
         outFasta = open(outFastaFile, 'w')
 
-    ref_bps = []
-    ref_ins_dict = dict() # global insertion dictionary for the reference sequence
-    readinfo = dict() # dictionary storing read information (base call for the mapped read)
+    readinfo = read_signatures.ReadSignatures() # read information (base calls for the mapped reads)
     rLen = len(rseq)
-    ref_bps = [ [0] * 5 for x in xrange(rLen) ]  # list of lists, one list(length 5) corresponding to each position on the reference sequence
+    ref_pileup = pileup.Pileup(rLen) # base call counts for each position on the reference sequence, and the inserted bases
     header_written = False
-    with open(samFile, 'r') as mysam:
-        for line in mysam:
-            lineNum += 1 
-            #####################################
-            # header line
-            if line[0] == '@': 
+    realigned = dict() # (rstart, CIGAR, read sequence) => re-alignment result, identical alignments are only re-aligned once
+    with (samrecord.open_sam(samFile) if refName is None else samindex.ReferenceReader(samFile, refName)) as mysam:
+        #####################################
+        # header lines
+        for line in mysam.header_lines:
+            if verbose:
+                newsam.write(line) # if new reduced sam file is required, write the head lines into the new sam file
+        for rname, rLen in zip(mysam.ref_names, mysam.ref_lens): # reference sequence dictionary, in the order of the @SQ lines
+            sys.stdout.write("Sequence name: {} \nLength: {}\n".format(rname, rLen))
+            if rLen < minPacBioLen:
                 if verbose:
-                    newsam.write(line) # if new reduced sam file is required, write the head lines into the new sam file
-                if line[1:3] == 'SQ': # reference sequence dictionary
-                    rname = line[(line.find('SN:') + len('SN:')) : line.find('\t',line.find('SN:'))] # reference sequence name
-                    rLen = int(line[(line.find('LN:') + len('LN:')) : line.find('\t',line.find('LN:'))]) # reference sequence length
-                    sys.stdout.write("Sequence name: {} \nLength: {}\n".format(rname, rLen))
-                    if rLen < minPacBioLen:
-                        if verbose:
-                            sys.stdout.write("Reference is shorter than threshold {}.\n".format(minPacBioLen))
-                        return 0 
-            #####################################
-            # mapping record lines
+                    sys.stdout.write("Reference is shorter than threshold {}.\n".format(minPacBioLen))
+                return 0 
+        #####################################
+        # mapping record lines
+        for record in mysam:
+            lineNum += 1 
+            align_key = None
+            if not record.binary and ' ' in record.line: # blasr output
+                myread = samread.BlasrRead(record.line)
+                if rname == '':
+                    rname = myread.rName
+                is_bad = myread.is_read_bad(maxSub, maxIns, maxDel, maxSubRate, maxInDelRate)
+            else:
+                # filter on the flag and CIGAR columns first, only good records are fully parsed into SamRead
+                try:
+                    if not record.binary and record.line.count('\t') < 10: # sam record has at least 11 mandatory fields
+                        raise IndexError
+                    is_bad = is_alignment_bad(record.flag, record.cigar, maxSub, maxIns, maxDel, maxSubRate, maxInDelRate)
+                except (ValueError, IndexError):
+                    sys.stderr.write('alignRecord is bad: \n {} \n'.format(record.line))
+                    is_bad = True
+                if not is_bad:
+                    align_key = (record.pos, record.cigar, record.seq)
+                    myread = None # only parsed if needed
+                if rname == '':
+                    rname = record.rname
+            if verbose and not header_written: # write header lines for the scrubbed sam file
+                newsam.write("@HD\tVN:1.4\tSO:unsorted\n")
+                newsam.write("@SQ\tSN:{}\tLN:{}\n".format(rname, rLen))
+                newsam.write("@RG\tID:1\n")
+                newsam.write("@PG\tID:metalrec\n")
+                header_written = True
+            if is_bad:
+                discardRec += 1
+                continue
+            #sys.stdout.write("realign\n") # DEBUG
+            if align_key is None: # blasr record
+                pos_dict, ins_dict = myread.re_align(maxSub, maxIns, maxDel, maxSubRate, maxInDelRate) # realign read to PacBio sequence
+                read_sig = None
+                qname = myread.qname
             else:
-                record = line
-                if ' ' in line:
-                    myread = samread.BlasrRead(record)
+                qname = record.qname
+                if align_key in realigned: # same alignment was re-aligned before, reuse the result
+                    pos_dict, ins_dict, read_sig, new_rstart, new_cigarstring = realigned[align_key]
+                    if verbose and len(pos_dict) + len(ins_dict) > 0: # sam record needs the new alignment of this read
+                        myread = samread.SamRead(record.line)
+                        myread.rstart = new_rstart
+                        myread.cigarstring = new_cigarstring
+                        myread.fields[3] = str(new_rstart)
+                        myread.fields[5] = new_cigarstring
+                        myread.alignRecord = '\t'.join(myread.fields)
                 else:
-                    myread = samread.SamRead(record)
+                    myread = samread.SamRead(record.line)
                     #print myread.qname # DEBUG
-                if rname == '':
-                    rname = myread.rName
-                if verbose and not header_written: # write header lines for the scrubbed sam file
-                    newsam.write("@HD\tVN:1.4\tSO:unsorted\n")
-                    newsam.write("@SQ\tSN:{}\tLN:{}\n".format(rname, rLen))
-                    newsam.write("@RG\tID:1\n")
-                    newsam.write("@PG\tID:metalrec\n")
-                    header_written = True
-                if not myread.is_read_bad(maxSub, maxIns, maxDel, maxSubRate, maxInDelRate): # if this alignment is good
-                    #sys.stdout.write("realign\n") # DEBUG
-                    pos_dict, ins_dict = myread.re_align(maxSub, maxIns, maxDel, maxSubRate, maxInDelRate) # realign read to PacBio sequence
+                    pos_dict, ins_dict = myread.re_align(rseq, maxSub, maxIns, maxDel, maxSubRate, maxInDelRate, checkEnds=checkEnds) # realign read to PacBio sequence
+                    read_sig = None
                     if len(pos_dict) + len(ins_dict) > 0:
-                        keepRec += 1
-                        if verbose:
-                            newsam.write(myread.generate_sam_record())
-                            outFasta.write('>{}\n{}\n'.format(myread.qname, re.sub('-', '', myread.qSeq)))
-
-                        # update string dictionary for the read information
-                        # TODO: currently, exactly same reads are processed multiple times, computation can be reduced
-                        read_string = dict_to_string(pos_dict) + ':' +  dict_to_string(ins_dict)
-                        # single end reads, different reads don't have same names
-                        if read_string not in readinfo: # new read_string(key) in the dictionary
-                            readinfo[read_string] = []
-                        readinfo[read_string].append(myread.qname)
-
-                        for pos in pos_dict: # all the matching/mismatching/deletion positions
-                            ref_bps[pos][alphabet.find(pos_dict[pos])] += 1 # update the corresponding base call frequencies at the position
-
-                        for ins in ins_dict: # all the insertion positions
-                            ins_chars = ins_dict[ins]
-                            if ins not in ref_ins_dict: # if this position has not appeared in the big insertion dictionary, initialize it
-                                ref_ins_dict[ins] = [[0,0,0,0] for ii in xrange(len(ins_chars))] # length is 4 because there is no 'D' at insertion position
-                            elif len(ins_chars) > len(ref_ins_dict[ins]): # if the inserted bps is longer than the list corresponding to this position, make it longer
-                                ref_ins_dict[ins] += [[0,0,0,0] for ii in xrange(len(ref_ins_dict[ins]),len(ins_chars))]
-                            for i in xrange(len(ins_chars)):
-                                ref_ins_dict[ins][i][alphabet.find(ins_chars[i])] += 1
-
-                        if verbose and keepRec % 1000 == 0:
-                            sys.stdout.write('  processed {} good records\n'.format(keepRec))
-                    else:
-                        discardRec += 1
-                else:
-                    discardRec += 1
+                        read_sig = read_signatures.signature(pos_dict, ins_dict)
+                    realigned[align_key] = (pos_dict, ins_dict, read_sig, myread.rstart, myread.cigarstring)
+            if len(pos_dict) + len(ins_dict) > 0:
+                keepRec += 1
+                if verbose:
+                    newsam.write(myread.generate_sam_record())
+                    outFasta.write('>{}\n{}\n'.format(qname, re.sub('-', '', myread.qSeq)))
+
+                # update the read information, single end reads, different reads don't have same names
+                if read_sig is None:
+                    read_sig = read_signatures.signature(pos_dict, ins_dict)
+                readinfo.add(read_sig, qname)
+
+                ref_pileup.add_read(pos_dict, ins_dict) # update the base call frequencies at the matching/mismatching/deletion and insertion positions
+
+                if verbose and keepRec % 1000 == 0:
+                    sys.stdout.write('  processed {} good records\n'.format(keepRec))
+            else:
+                discardRec += 1
     
     if verbose:
         newsam.close()
@@ -407,7 +399,7 @@ def read_and_process_sam_samread(samFile,rseq, maxSub=-1, maxIns=-1, maxDel=-1,m
         sys.stdout.write("discarded {} reads, kept {} reads.\n".format(discardRec, keepRec))
         sys.stdout.write("number of unique reads: {}\n".format(len(readinfo)))
     
-    return ref_bps, ref_ins_dict, readinfo
+    return ref_pileup.bps, ref_pileup.insertions(), readinfo
 ## ======================================================================
 def shift_to_left(align):
     ''' Take the result from Bio.pairwise2.align.global**, shift the indels in the homopolymer to the leftmost positions.
@@ -660,7 +652,7 @@ def get_good_regions(ref_bps, rSeq, minGoodLen=1000, minCV=1):
         1.  Every base pair in the region is covered by at least minCV reads
         2.  The contiguous region has length >= minGoodLen
         
-        Input:  ref_bps - dictionary for the match/mismatch and the deletion positions
+        Input:  ref_bps - (rLen x 5) array of base call counts for the match/mismatch and the deletion positions
                 rSeq - PacBio sequence
                 minGoodLen - length threshold for the region contiguously covered by minCV 
                 minCV - minimum coverage depth for a base pair to be considered "covered"
@@ -673,19 +665,15 @@ def get_good_regions(ref_bps, rSeq, minGoodLen=1000, minCV=1):
     if rLen < minGoodLen:
         return [], [], None
 
-    cov_depths = []
-    good_regions = []
-    # loop through all the positions of the reference sequence
-    for i in xrange(rLen):
-        non_ins_bps = ref_bps[i] # non-insertion base calls
-        cov_depth = sum(non_ins_bps) # coverage depth at this position
-        cov_depths.append(cov_depth) # append the new coverage depth to the vector
-    cov_bps = sum([1 for cv in cov_depths if cv > 0]) # number of bases that are covered 
-    avg_cov_depth = sum(cov_depths) / float(cov_bps) if cov_bps != 0 else 0 # average coverage depth for the covered bases
-    low_CV_pos = [-1] + [ i for i in xrange(rLen) if cov_depths[i] < minCV ] + [rLen] # indices of the lower coverage bases (coverage depth lower than the specified minCV)
-    for i in xrange(1, len(low_CV_pos)):
-        if low_CV_pos[i] - low_CV_pos[i-1] >= minGoodLen:
-            good_regions.append((low_CV_pos[i-1]+1, low_CV_pos[i])) # found a good region (begin, end) where rSeq[begin:end] is long enough and covered well
+    cov_depths = asarray(ref_bps)[:rLen].sum(axis=1, dtype=int64) # coverage depth at each position of the reference sequence
+    cov_bps = int(count_nonzero(cov_depths)) # number of bases that are covered 
+    avg_cov_depth = cov_depths.sum() / float(cov_bps) if cov_bps != 0 else 0 # average coverage depth for the covered bases
+    # run-length encode the stretches of well covered bases (coverage depth at least minCV)
+    covered = concatenate(([0], (cov_depths >= minCV).astype(int8), [0]))
+    run_starts = flatnonzero(diff(covered) == 1)
+    run_ends = flatnonzero(diff(covered) == -1)
+    is_long = run_ends - run_starts + 1 >= minGoodLen # stretch plus one flanking low coverage base is long enough, same threshold as the distance between low coverage bases before
+    good_regions = zip(run_starts[is_long].tolist(), run_ends[is_long].tolist()) # good regions (begin, end) where rSeq[begin:end] is long enough and covered well
     return good_regions, cov_bps, avg_cov_depth
 ## ======================================================================
 def get_poly_pos(ref_bps, ref_ins_dict, region=None):
@@ -698,45 +686,11 @@ def get_poly_pos(ref_bps, ref_ins_dict, region=None):
                 consensus_ins - nonpolymorphic insertion positions, get the consensus
                 * note: all the above four objects are dictionaries. Dictionaries for the insertion positions use tuple (insert position, index of inserted base) as key, since list cannot be used as dictionary key.
                 cvs - coverage depths across all the base pairs
+        The calls are made on the arrays by pileup.call_positions, see pileup.PositionCalls for the compact form.
     '''
     if region is None: # region to consider, 0-based index
         region = (0, len(ref_bps))
-    poly_bps = dict() # list of tuples
-    poly_ins = dict()
-    consensus_bps = dict()
-    consensus_ins = dict()
-    alphabet = 'ACGTD' # all the possible base pairs at a position
-    cvs = [] # list of coverage depths
-
-    # consider all the positions in the specified region
-    for pos in xrange(region[0], region[1]):
-        # check the match/mismatch/deletion first
-        cv = sum(ref_bps[pos]) # coverage depth
-        cvs.append(cv) # vector of coverage depths, for each position in the region
-        base_calls = [ alphabet[i] for i in xrange(5) if ref_bps[pos][i] >= minCover(cv) ]
-        if len(base_calls) > 1: # more than 1 base call with enough read support
-            poly_bps[pos] =  base_calls
-        elif len(base_calls) == 1:
-            consensus_bps[pos] = base_calls[0]
-        else: # no base has more than required number of coverage, treat base call with 1 read support as valid
-            base_calls = [ alphabet[i] for i in xrange(5) if ref_bps[pos][i] > 0 ]
-            if len(base_calls) == 1: # if they all agree (low CV region) then use the consensus base
-                consensus_bps[pos]= base_calls[0]
-            else: # if they do not agree, treat each one as possible/valid. because all of them should have very low read support now passing 
-                poly_bps[pos] = base_calls
-                #consensus_bps.append((pos, alphabet[ref_bps[pos].index(max(ref_bps[pos]))]))
-
-        # check the insertion positions now
-        if pos in ref_ins_dict: 
-            for i in xrange(len(ref_ins_dict[pos])): # look at all the bases inserted at this position
-                pos_list = ref_ins_dict[pos][i]
-                base_calls = [ alphabet[j] for j in xrange(4) if pos_list[j] >= minCover(cv) ]
-                if len(base_calls) > 1: # polymorphic insertion position
-                    poly_ins[ (pos,i) ] =  base_calls
-                elif len(base_calls) == 1: # consensus insertion position
-                    consensus_ins[ (pos,i) ] =  base_calls[0]
-                # if none of them passes the threshold, the insertion position won't be considered existent
-    return poly_bps, poly_ins, consensus_bps, consensus_ins, cvs
+    return pileup.call_positions(ref_bps, ref_ins_dict, region).as_dicts()
 ## ======================================================================
 def ref_extension(poly_bps, poly_ins, consensus_bps, consensus_ins, rseq, region=None, print_width = 100, verbose=False):
     ''' Extend the reference sequence, insert the insertion positions in the reference sequence, and return correspondence between old positions and their new positions in the extended sequence
@@ -935,131 +889,65 @@ def print_seqs(seq1, seq2, print_width = 100):
         sys.stdout.write('{:>5}\t{}\t{:<5}\n'.format(' ', matching_string[i*print_width:(i+1)*print_width],' ' ))
         sys.stdout.write('{:>5}\t{}\t{:<5}\n\n'.format(i*print_width - seq2[:(i*print_width)].count('-'), seq2[i*print_width:(i+1)*print_width], min((i+1)*print_width,len(seq1) ) - seq2[:min((i+1)*print_width,len(seq1) )].count('-') ))
 ## ======================================================================
-def make_read_array1d(read_string, bp_pos_dict, ins_pos_dict, type_array, poly_bps_ext, poly_ins_ext, consensus_bps_ext, consensus_ins_ext, ext_region=None):
-    ''' Make 1d array for a particular read from its string (key of dictionary readinfo).
+def make_read_array1d(read_string, bp_pos_dict, ins_pos_dict, type_array, poly_bps_ext, poly_ins_ext, consensus_bps_ext, consensus_ins_ext, ext_region=None, tables=None):
+    ''' Make 1d array for a particular read from its read string, dict_to_string(pos_dict) + ':' + dict_to_string(ins_dict).
         Incorporate the base calling from other reads at the same position.
         Considering how many bases a read need to change to comply with the consensus calls, if too many, keep its own base calls (or discard it)
 
-        Input:  read_string - read string (key of dictionary readinfo)
+        Input:  read_string - read string
                 bp_pos_dict, ins_pos_dict - correspondence between positions from original to extended ref sequence
                 length - length of the reference sequence ( good region )
                 poly_bps_ext, poly_ins_ext, consensus_bps_ext, consensus_ins_ext - base calling information for all the positions
                 ext_region - (start, end) of the region on the extended sequence
+                tables - read_signatures.RegionTables of the region, built from the other inputs if not given.
+                         Build it once and pass it when making the arrays of many reads in the same region
 
         Output: read_array1d - 1d array for this particular read string
     '''
-    if ext_region is None:
-        all_pos = bp_pos_dict.values() + ins_pos_dict.values() # values instead of keys, since it's the "extended" region
-        ext_region = (min(all_pos), max(all_pos)+1 ) # the end is one bigger than the 0-based end
-    start, end = ext_region
-
-    read_array1d = zeros( len(type_array) * 5, dtype=int32 ) # initialization
-    bpstring = read_string.split(":")[0] # non-insertion base calls
-    insstring = read_string.split(":")[1] # insertion position's base calls
-
-    # all the positions of a read that lay in the specified region (covered by the dicts)
-    bp_positions = []
-    ins_positions = []
-    for pos in map(int, re.findall('\d+',bpstring)):
-        if pos in bp_pos_dict:
-            bp_positions.append(bp_pos_dict[pos])
-    ins_chars = re.findall('\D+',insstring)
-    ins_pos = re.findall('\d+',insstring)
-    for i in xrange(len(ins_pos)):
-        for j in xrange(len(ins_chars)):
-            if (ins_pos[i], j) in ins_pos_dict:
-                ins_positions.append(ins_pos_dict[(ins_pos[i], j)])
-    map_positions = bp_positions + ins_positions
-    #print len(map_positions), " covered positions: ", map_positions
-
-    if len(map_positions) == 0: # the read does not cover any (non-insertion and insertion) of the positions in the region
-        return read_array1d
-    else:
-        start_pos = min(map_positions) # start and end positions of the covered region for this read
-        end_pos = max(map_positions)
-
-        changed_bases = 0
-
-        # If this read covers some non-insertion positions, do the following:
-        if len(bpstring) > 0:
-            positions = map(int, re.findall('\d+',bpstring)) # positions
-            bases = re.findall('\D+',bpstring) # base calling
-            for i in xrange(len(positions)):
-                if positions[i] in bp_pos_dict:
-                    position = bp_pos_dict[positions[i]] # position in the extended sequence
-                    ## note: type_array's index starts with 0, instead of "start", so does read_array1d
-                    relative_pos = position - start
-                    if type_array[relative_pos] == 0: # consensus non-inseriton position, read's call should be the same as the consensus call
-                        c_bp = consensus_bps_ext[position] # consensus base
-                        read_array1d[ (relative_pos)*5 + alphabet.index(c_bp) ] = 1
-                        if bases[i] != c_bp:
-                            #sys.stdout.write("{} is not {}, changed_bases plus 1\n".format(bases[i], c_bp))
-                            changed_bases += 1
-                    if type_array[relative_pos] == 2: # polymorphic non-insertion position, check if read's call is one of the possible calls
-                        p_bps = poly_bps_ext[position] # polymorphic base
-                        if bases[i] in p_bps: # if read's call is one of the possible calls, do not change it
-                            read_array1d[ (position-start)*5 + alphabet.index(bases[i]) ] = 1
-                        else: # if read's call is not among the possible calls, it's considered as an error, so it could be either of the possible calls
-                            for p_bp in p_bps:
-                                read_array1d[ (position-start)*5 + alphabet.index(p_bp) ] = 1
-                            #sys.stdout.write("{} is not in {}, changed_bases plus 1\n".format(bases[i], ''.join(p_bps)))
-                            changed_bases += 1
-                            
-        # If this read covers some insertion positions, do the following:            
-        if len(insstring) > 0:
-            positions = map(int, re.findall('\d+',insstring))
-            ins_positions = [] # insert positions, starting from 0
-            bases = re.findall('\D+',insstring)
-            for i in xrange(len(positions)): # for each insertion position in this read
-                for j in xrange(len(bases[i])):
-                    if (positions[i],j) in ins_pos_dict:
-                        ins_position = ins_pos_dict[(positions[i],j)]
-                        ins_positions.append(ins_position - start) # all the insertion positions the read covers
-                        if (ins_position - start) < len(type_array): # in some cases, when there is more than 1 base pair inserted, the index could go out of range
-                            if type_array[ins_position - start] == 1: # consensus insertion position
-                                c_bp = consensus_ins_ext[ins_position]
-                                read_array1d[ (ins_position-start)*5 + alphabet.index(c_bp) ] = 1
-                                if bases[i][j] != c_bp:
-                                    #sys.stdout.write("{} is not {}, changed_bases plus 1\n".format(bases[i][j], c_bp))
-                                    changed_bases += 1
-
-                            if type_array[ins_position - start] == 3: # polymorphic insertion position
-                                p_bps = poly_ins_ext[ins_position]
-                                if bases[i][j] in p_bps:
-                                    read_array1d[ (ins_position-start)*5 + alphabet.index(bases[i][j]) ] = 1
-                                else:
-                                    for p_bp in p_bps:
-                                        read_array1d[ (ins_position-start)*5 + alphabet.index(p_bp) ] = 1
-                                    changed_bases += 1
-        #print changed_bases
-
-        if changed_bases >= 5: # if this read has at least 5 disagreements with the consensus/polymorphic calls, discard it (set the coverage to nothing)
-            return zeros( len(type_array) * 5, dtype=int32 )
-        else:
-            # check if this read missed any insertion position
-            for ins_pos in hstack((where(type_array==3)[0], where(type_array==1)[0])):
-                if ins_pos >= start_pos-start and ins_pos <= end_pos-start and ins_pos not in ins_positions: # if there is no insertion for this read at the insertion position, put a deletion
-                    read_array1d[ins_pos * 5 + 4 ] = 1
-            return read_array1d
+    if tables is None:
+        tables = read_signatures.RegionTables(bp_pos_dict, ins_pos_dict, type_array, poly_bps_ext, poly_ins_ext, consensus_bps_ext, consensus_ins_ext, ext_region)
+    bpstring, insstring = read_string.split(":")[:2] # non-insertion base calls, insertion position's base calls
+    pos_dict = dict((int(pos), base) for pos, base in re.findall('(\d+)(\D+)', bpstring))
+    ins_dict = dict((int(pos), bases) for pos, bases in re.findall('(\d+)(\D+)', insstring))
+    readinfo = read_signatures.ReadSignatures()
+    readinfo.add(read_signatures.signature(pos_dict, ins_dict), None)
+    rows, read_array = read_signatures.region_bands(readinfo, tables)
+    if len(rows) == 0: # the read does not cover any of the positions in the region, or it is discarded
+        return zeros( len(type_array) * 5, dtype=int32 )
+    return read_array.row(0)
 ## ======================================================================
-def make_read_array(readinfo, bp_pos_dict, ins_pos_dict, type_array,  poly_bps_ext, poly_ins_ext, consensus_bps_ext, consensus_ins_ext, ext_region=None):
-    ''' Make 2d array for all reads from readinfo dictionary, dim1 of the array is equal to the length of the dictionary
-        Input:  readinfo - dictionary (read string => count of the same read string)
-                bp_pos_dict, ... - same as function make_read_array1d's input for each read string
-        Output: read_array - 2d array that include all reads' base call information
-                read_counts - 1d array that stores the counts of reads corresponding to each row of read_array
+def make_read_array(readinfo, bp_pos_dict, ins_pos_dict, type_array,  poly_bps_ext, poly_ins_ext, consensus_bps_ext, consensus_ins_ext, ext_region=None, banded=False):
+    ''' Make 2d array for all reads from readinfo, the rows are in the row order of readinfo
+        Input:  readinfo - read_signatures.ReadSignatures
+                bp_pos_dict, ... - same as function make_read_array1d's input for each read
+                banded - if True, return a banded_array.BandedReadArray that only keeps the covered band of each read instead of the dense array
+        Output: read_array - 2d array that include all reads' base call information, only the reads that cover some bases of the region
+                read_counts - 1d array that stores the counts of reads corresponding to each row of readinfo
     '''
-    read_array = zeros( (len(readinfo), len(type_array)*5), dtype = int32 ) # initialize the 2d array to return
-    read_counts = zeros( len(readinfo), dtype = int32)
-    i = 0
-    for read_string in sorted(readinfo): # the rows in the array are ordered by the corresponding read_string
-        read_array[i,:] = make_read_array1d(read_string, bp_pos_dict, ins_pos_dict, type_array, poly_bps_ext, poly_ins_ext, consensus_bps_ext, consensus_ins_ext, ext_region)
-        read_counts[i] = len(readinfo[read_string])
-        i += 1
-    read_array = read_array[where(read_array.sum(axis=1) !=0)[0],:] # only the reads that cover some bases of the region
-    base_count = read_array.sum(axis=0).reshape(-1,5)
-    covered_bases = where(base_count.sum(axis=1) != 0)[0]
-    return read_array[where(read_array.sum(axis=1) !=0)[0],amin(covered_bases)*5:amax(covered_bases+1)*5], read_counts
+    read_array, read_counts = make_banded_read_array(readinfo, bp_pos_dict, ins_pos_dict, type_array, poly_bps_ext, poly_ins_ext, consensus_bps_ext, consensus_ins_ext, ext_region)
+    if banded:
+        return read_array, read_counts
+    return read_array.toarray(), read_counts
+## ======================================================================
+def make_banded_read_array(readinfo, bp_pos_dict, ins_pos_dict, type_array,  poly_bps_ext, poly_ins_ext, consensus_bps_ext, consensus_ins_ext, ext_region=None):
+    ''' Same as make_read_array, but only the band between the first and last covered positions of each read is kept, with packed base calls.
+        The base calls of all the reads are made from the signature arrays at once (read_signatures.region_bands), with lookup tables built once for the region.
+        Output: read_array - banded_array.BandedReadArray, equivalent to the dense array from make_read_array
+                read_counts - 1d array that stores the counts of reads corresponding to each row of readinfo
+    '''
+    tables = read_signatures.RegionTables(bp_pos_dict, ins_pos_dict, type_array, poly_bps_ext, poly_ins_ext, consensus_bps_ext, consensus_ins_ext, ext_region) # lookup tables shared by all the reads
+    rows, read_array = read_signatures.region_bands(readinfo, tables)
+    return read_array.trimmed(), readinfo.counts()
+## ======================================================================
+def is_banded(read_array):
+    ''' True if the read array is a banded_array.BandedReadArray instead of a dense 2d array '''
+    return isinstance(read_array, banded_array.BandedReadArray)
+## ======================================================================
+def read_row(read_array, i):
+    ''' Dense 1d array of the i-th read, for both dense and banded read arrays '''
+    if is_banded(read_array):
+        return read_array.row(i)
+    return read_array[i,:]
 ## ======================================================================
 def is_compatible(array1, array2):
     ''' Find out if the base calls of 2 reads at a certain position are compatible or not, given the 0-1 vectors representing the base calls. For now, the length of the vectors is the same (5 for ACGTD).
@@ -1090,18 +978,61 @@ def are_reads_compatible(read_array1d1, read_array1d2):
                 return False
     return True
 ## ======================================================================
-def compatible_mat(read_array):
+def pack_read_array(read_array):
+    ''' Pack the 5 0-1 entries (ACGTD) of every position of the reads into one byte, bit k set for base call alphabet[k]
+        Input:  read_array - 2d array from all the reads, 5 columns per position
+        Output: packed - 2d uint8 array (number of reads x number of positions), 0 where the read does not cover the position
+    '''
+    return banded_array.pack_calls(read_array)
+## ======================================================================
+def compatible_mat(read_array, tile_reads=64, tile_bytes=4194304):
     ''' Construct (upper triangular) compatibility matrix for pairwise compatibility of the reads whose info is stored in the read_array.
-        Input:  read_array- 2d array from all the reads 
+        Base calls are packed into one byte per position, and blocks of read pairs are compared at once with bitwise AND,
+        restricted to the positions covered by both blocks. Two reads are incompatible if at some position both cover, they share no base call.
+        Input:  read_array- 2d array from all the reads
+                tile_reads - number of reads in a block
+                tile_bytes - maximum size of the (reads x reads x positions) temporary arrays for one block pair
         Output: Cmat - compatibility array for all the reads in the 2d array
     '''
-    nread = read_array.shape[0] # number of rows, which is number of the reads 
+    nread = read_array.shape[0] # number of rows, which is number of the reads
     Cmat = zeros((nread, nread),dtype=int32) # initialize to be all 0 - incompatible
-    for i in xrange(nread):
-        for j in xrange(i+1, nread):
-            if are_reads_compatible(read_array[i],read_array[j]): # set the entry for compatible pairs to 1
-                Cmat[i,j] = 1
-    return array(Cmat) # conver to array
+    if nread < 2:
+        return Cmat
+    packed = pack_read_array(read_array)
+    covered = packed != 0
+    has_cov = covered.any(axis=1)
+    first_pos = where(has_cov, covered.argmax(axis=1), packed.shape[1]) # first covered position of each read
+    last_pos = where(has_cov, packed.shape[1] - 1 - covered[:,::-1].argmax(axis=1), -1) # last covered position of each read
+    order = argsort(first_pos, kind='mergesort') # reads sorted by starting position, so that blocks cover short stretches
+    packed = packed[order]
+    first_pos = first_pos[order]
+    last_pos = last_pos[order]
+    compat = ones((nread, nread), dtype=bool) # compatibility in sorted order
+    for i0 in xrange(0, nread, tile_reads):
+        i1 = min(i0 + tile_reads, nread)
+        i_start = first_pos[i0:i1].min()
+        i_end = last_pos[i0:i1].max() + 1
+        for j0 in xrange(i0, nread, tile_reads):
+            j1 = min(j0 + tile_reads, nread)
+            start = max(i_start, first_pos[j0:j1].min())
+            end = min(i_end, last_pos[j0:j1].max() + 1)
+            if start >= end: # blocks do not overlap, all pairs are compatible
+                continue
+            step = max(1, tile_bytes / ((i1 - i0) * (j1 - j0))) # positions per chunk
+            bad = zeros((i1 - i0, j1 - j0), dtype=bool)
+            for p0 in xrange(start, end, step):
+                p1 = min(p0 + step, end)
+                a = packed[i0:i1, newaxis, p0:p1]
+                b = packed[newaxis, j0:j1, p0:p1]
+                # both reads cover the position, but no common base call
+                bad |= (((a & b) == 0) & (a != 0) & (b != 0)).any(axis=2)
+            compat[i0:i1, j0:j1] = ~bad
+            compat[j0:j1, i0:i1] = ~bad.T
+    inverse = empty(nread, dtype=intp)
+    inverse[order] = arange(nread)
+    compat = compat[inverse][:, inverse] # back to the original order of the reads
+    Cmat[triu_indices(nread, 1)] = compat[triu_indices(nread, 1)] # set the entry for compatible pairs to 1
+    return Cmat
 ## ======================================================================
 def cov_bps(read_array1d):
     ''' Find number of bases covered by an array 
@@ -1132,14 +1063,33 @@ def get_compatible_reads(ref_array, read_array):
                 read_array - 2d array from all the reads
         Output: compatible_ind - array of indices for compatible reads, corresponding to the read_array
     '''
+    if is_banded(read_array): # count base calls shared with the reference and covered positions of all reads at once
+        ref_codes = banded_array.pack_calls(ref_array)
+        rows = read_array.row_ids()
+        shared = bincount(rows, weights=banded_array.POPCOUNT[read_array.codes & ref_codes[read_array.positions()]], minlength=read_array.nreads)
+        covered = bincount(rows[read_array.codes != 0], minlength=read_array.nreads)
+        return array(where((covered > 0) & (shared == covered))[0], dtype=int32)
     compatible_ind = []
     for i in xrange(read_array.shape[0]): # check every read
         if sum(read_array[i,:]) > 0 and is_read_compatible(ref_array, read_array[i,:]): # ignore reads that have all 0 vector
             compatible_ind.append(i)
     return array(compatible_ind, dtype=int32)
 ## ======================================================================
+def read_span(read_array):
+    ''' Starting and ending (covered) positions of each read in the read array
+        Input:  read_array - 2d array with read information, 5 columns per position
+        Output: start_pos_vec, end_pos_vec - int32 vectors, first and last covered position of each read (0 and -1 if the read covers nothing)
+    '''
+    covered = read_array.reshape(read_array.shape[0], -1, 5).max(axis=2) > 0 # positions covered by each read
+    npos = covered.shape[1]
+    has_cov = covered.any(axis=1)
+    start_pos_vec = where(has_cov, covered.argmax(axis=1), 0).astype(int32)
+    end_pos_vec = where(has_cov, npos - 1 - covered[:,::-1].argmax(axis=1), -1).astype(int32)
+    return start_pos_vec, end_pos_vec
+## ======================================================================
 def get_overlapLen(ref_array, read_array, Cvec=None):
     ''' Given read array, current reference array, and the indices of compatible reads, get the overlap length matrix.
+        Overlap lengths of all pairs come from one matrix product, the direction from comparing starting and ending positions of all pairs at once.
          Input: ref_array - array for the currently proposed PacBio sequence
                 read_array - array with read information
                 Cvec - indices for the compatible reads with the PacBio sequence, doesn't have to be given
@@ -1149,63 +1099,50 @@ def get_overlapLen(ref_array, read_array, Cvec=None):
         Cvec = get_compatible_reads(ref_array, read_array)
     if len(Cvec) == 0:
         return None
-    nreads = len(Cvec)
-    new_array = read_array[ Cvec, : ] # get only the compatible reads
-    overlap_mat = zeros(shape=(nreads,nreads),dtype=int32) # initialize the overlap length matrix, with each compatible read having one row and one column
-    zero_columns = where(ref_array==0)[0] # force only 1 base call for the reads that have ambiguous (or error) base calls, and they agree with the reference's base call
-    new_array[ : , zero_columns] = 0
-    start_pos_vec = zeros(nreads,dtype=int32)
-    end_pos_vec = zeros(nreads,dtype=int32)
-    for i in xrange(nreads): # starting position of the read
-        start_pos_vec[i] = where(new_array[i,:] > 0)[0][0]/5
-        end_pos_vec[i] = where(new_array[i,:] > 0)[0][-1]/5
-    for i in xrange(nreads - 1):
-        for j in xrange(i + 1, nreads):
-            overlap_len = dot(new_array[i,:], new_array[j,:])
-            if start_pos_vec[i] < start_pos_vec[j] and end_pos_vec[i] < end_pos_vec[j]: # positive if the first read's starting position is smaller than the second read's starting position
-                overlap_mat[i,j] = overlap_len
-                overlap_mat[j,i] = - overlap_mat[i,j]
-            elif start_pos_vec[i] > start_pos_vec[j] and end_pos_vec[i] > end_pos_vec[j]:
-                overlap_mat[i,j] = -overlap_len
-                overlap_mat[j,i] = - overlap_mat[i,j]
-    return overlap_mat
+    if is_banded(read_array):
+        new_array = read_array.take(Cvec).masked(banded_array.pack_calls(ref_array)) # compatible reads, only base calls agreeing with the reference
+        start_pos_vec, end_pos_vec = new_array.span() # starting and ending positions of the reads
+        overlap_len = banded_array.overlap_lengths(new_array) # overlap lengths between all pairs of reads
+    else:
+        new_array = read_array[ Cvec, : ] # get only the compatible reads
+        zero_columns = where(ref_array==0)[0] # force only 1 base call for the reads that have ambiguous (or error) base calls, and they agree with the reference's base call
+        new_array[ : , zero_columns] = 0
+        start_pos_vec, end_pos_vec = read_span(new_array) # starting and ending positions of the reads
+        new_array = new_array.astype(float32) # exact for 0-1 entries, and the product goes through BLAS
+        overlap_len = dot(new_array, new_array.T).astype(int32) # overlap lengths between all pairs of reads
+    # positive if the first read's starting and ending positions are smaller than the second read's, negative if both are larger, 0 otherwise
+    left_of = logical_and(start_pos_vec[:,newaxis] < start_pos_vec[newaxis,:], end_pos_vec[:,newaxis] < end_pos_vec[newaxis,:])
+    overlap_mat = where(left_of, overlap_len, 0) # initialize the overlap length matrix, with each compatible read having one row and one column
+    overlap_mat -= overlap_mat.T
+    return overlap_mat.astype(int32)
 ## ======================================================================
 def cov_vec(read_array1d):
     return apply_along_axis(max, 1, read_array1d.reshape(-1,5))
 ## ======================================================================
 def get_overlapMat(read_array):
     ''' Given read array, get the overlap length matrix between all the reads. If two reads are not compatible, their overlap length will be set to 0
-        Too slow...
+        Overlap lengths of all pairs come from one product of the coverage matrix with itself.
         Input: read_array - array with read information
         Output: overlap_Mat - matrix with overlap lengths between all reads
     '''
     nreads = read_array.shape[0] # number of reads in the read_array
     overlap_Mat = zeros(shape=(nreads,nreads),dtype=int32) # initialize the overlap length matrix, with each read having one row and one column
-    cov_mat = apply_along_axis(cov_vec, 1, read_array) # coverage matrix
-
     # reads that cover at least 1 bp
     cov_reads = where(sum(read_array,1) != 0)[0]
+    if len(cov_reads) == 0:
+        return overlap_Mat
+    cov_mat = (read_array[cov_reads].reshape(len(cov_reads), -1, 5).max(axis=2) > 0).astype(float32) # coverage matrix
     # start and end positions of each read
-    start_pos_vec = zeros(len(cov_reads),dtype=int32)
-    end_pos_vec = zeros(len(cov_reads),dtype=int32)
-    for i in xrange(len(cov_reads)): # starting and ending positions of the read
-        start_pos_vec[i] = where(cov_mat[cov_reads[i],:] > 0)[0][0]
-        end_pos_vec[i] = where(cov_mat[cov_reads[i],:] > 0)[0][-1]
+    start_pos_vec, end_pos_vec = read_span(read_array[cov_reads])
     start_sort = argsort(start_pos_vec) # indices when sorted by start of covered positions
-    # put the corresponding vectors in this order
-    start_pos_vec = start_pos_vec[start_sort]
-    end_pos_vec = end_pos_vec[start_sort]
-    cov_reads = cov_reads[start_sort]
-    for i in xrange(len(start_sort) - 1):
-        for j in xrange( i+1, len(start_sort)):
-            overlap_len = sum(logical_and(cov_mat[cov_reads[i],], cov_mat[cov_reads[j],])) # overlap length
-            agree_len = len(unique(where(logical_and(cov_mat[cov_reads[i],], cov_mat[cov_reads[j],]))[0])) # number of bps where they agree
-            if overlap_len == 0:
-                continue
-            else:
-                if end_pos_vec[j] > start_pos_vec[i] and overlap_len == agree_len: # only when one is not included in the other and they are compatible
-                    overlap_Mat[cov_reads[i],cov_reads[j]] = overlap_len
-                    overlap_Mat[cov_reads[j],cov_reads[i]] = -overlap_len
+    rank = empty(len(cov_reads), dtype=intp) # position of each read in the sorted order
+    rank[start_sort] = arange(len(cov_reads))
+    overlap_len = dot(cov_mat, cov_mat.T).astype(int32) # overlap length
+    # only when the first read comes first in the sorted order, and one is not included in the other
+    keep = (rank[:,newaxis] < rank[newaxis,:]) & (end_pos_vec[newaxis,:] > start_pos_vec[:,newaxis]) & (overlap_len > 0)
+    sub_Mat = where(keep, overlap_len, 0)
+    sub_Mat -= sub_Mat.T
+    overlap_Mat[ix_(cov_reads, cov_reads)] = sub_Mat
     #sys.stdout.write("average overlap length is {}\n".format(mean(abs(overlap_Mat)[where(abs(overlap_Mat)>0)]))) ## DEBUG, for soft minOverlap cutoff shortly
     return overlap_Mat
 ## ======================================================================
@@ -1238,8 +1175,8 @@ def find_maxOverlap(overlap_mat):
     return maxOverlap_mat
 ## ======================================================================
 def get_reads_name(readinfo, compatible_ind):
-    ''' Find the names of reads that are compatible with a given PacBio sequence, given the readinfo dictionary and the compatible array row indices.
-        Input:  readinfo - dictionary with read information read_string => list of read names that have this read_string
+    ''' Find the names of reads that are compatible with a given PacBio sequence, given the readinfo and the compatible array row indices.
+        Input:  readinfo - read_signatures.ReadSignatures, with the list of read names of each row
                 compatible_ind - row indices of the array compatible with the PacBio sequence
         Output: reads_name_list - list of names of reads corresponding to the compatible_ind
     '''
@@ -1247,9 +1184,9 @@ def get_reads_name(readinfo, compatible_ind):
         return []
     else:
         reads_name_list = [] # initialize an empty list
-        info_keys = sorted(readinfo.keys()) # sort the keys of readinfo
+        read_names = readinfo.read_names()
         for ind in compatible_ind:
-            reads_name_list += readinfo[ info_keys[ind] ]
+            reads_name_list += read_names[ind]
         return reads_name_list
 ## ======================================================================
 def gap_pos(ref_array, read_array, compatible_ind, minOverlap = 10, minOverlapRatio=0.1):
@@ -1264,7 +1201,11 @@ def gap_pos(ref_array, read_array, compatible_ind, minOverlap = 10, minOverlapRa
     if len(compatible_ind) == 0: # no compatible reads, all positions are gap positions
         return arange(ref_array.shape[0]/5)
     else:
-        sub_read_array = copy(read_array[compatible_ind,:]) # read array with only the compatible reads
+        banded = is_banded(read_array)
+        if banded:
+            sub_read_array = read_array.take(compatible_ind)
+        else:
+            sub_read_array = copy(read_array[compatible_ind,:]) # read array with only the compatible reads
         cvec = arange(len(compatible_ind),dtype=int32)
         if minOverlap != -1 or minOverlapRatio != 0: # check minOverlap if at least one of the minOverlap and minOverlapRatio is specified
             iter_count = 1
@@ -1294,7 +1235,12 @@ def gap_pos(ref_array, read_array, compatible_ind, minOverlap = 10, minOverlapRa
                         #print i, "==>", small_ind[0][i], ",", small_ind[1][i]
                         if small_ind[1][i] == 0 and trimmed_reads[small_ind[0][i],0] == 0: # left overlap problem
                             trimmed_reads[small_ind[0][i],0] = 1 # mark that this read has been trimmed for the overlap checking
-                            if len(where(sub_read_array[small_ind[0][i],:] != 0)[0]) > 0: # if the positions where there are base calls in this read is greater than 0
+                            if banded:
+                                covered_span = sub_read_array.first_last(small_ind[0][i])
+                                if covered_span is not None and covered_span[0] > 0:
+                                    length = maxOverlap_mat[small_ind[0][i], small_ind[1][i]]
+                                    sub_read_array.clear(small_ind[0][i], covered_span[0], covered_span[0] + length + 1)
+                            elif len(where(sub_read_array[small_ind[0][i],:] != 0)[0]) > 0: # if the positions where there are base calls in this read is greater than 0
                                 first_pos = where(sub_read_array[small_ind[0][i],:] != 0)[0][0]/5 # first covered position of this read
                                 if first_pos > 0 : # if the read is not mapped to the beginning of the region, decrease its coverage accordingly
                                     length = maxOverlap_mat[small_ind[0][i], small_ind[1][i]]
@@ -1303,14 +1249,22 @@ def gap_pos(ref_array, read_array, compatible_ind, minOverlap = 10, minOverlapRa
 
                         if small_ind[1][i] == 1 and trimmed_reads[small_ind[0][i],1] == 0: # right overlap problem
                             trimmed_reads[small_ind[0][i],1] = 1
-                            if len(where(sub_read_array[small_ind[0][i],:] != 0)[0]) > 0:
+                            if banded:
+                                covered_span = sub_read_array.first_last(small_ind[0][i])
+                                if covered_span is not None and covered_span[1] < (len(ref_array)/5 - 1):
+                                    length = maxOverlap_mat[small_ind[0][i], small_ind[1][i]]
+                                    sub_read_array.clear(small_ind[0][i], covered_span[1] - length, covered_span[1] + 1)
+                            elif len(where(sub_read_array[small_ind[0][i],:] != 0)[0]) > 0:
                                 last_pos = where(sub_read_array[small_ind[0][i],:] != 0)[0][-1]/5 # last covered position of this read
                                 if last_pos < (len(ref_array)/5 - 1) : # if the read is not mapped to the end of the region, decrease its coverage accordingly
                                     length = maxOverlap_mat[small_ind[0][i], small_ind[1][i]]
                                     #sys.stdout.write("right: index {} has maximum overlap length {}\n".format(i, length))
                                     sub_read_array[small_ind[0][i],(last_pos - length)*5 : (last_pos + 1)*5] = 0 
-        base_cov = sub_read_array[ : , base_pos]
-        base_cov = base_cov.sum(axis=0) # pick the compatible rows and the correct columns, sum over the columns
+        if banded:
+            base_cov = sub_read_array.call_sums().reshape(-1)[base_pos] # column sums of the compatible rows at the correct columns
+        else:
+            base_cov = sub_read_array[ : , base_pos]
+            base_cov = base_cov.sum(axis=0) # pick the compatible rows and the correct columns, sum over the columns
         #print "gap positions: ", where(base_cov == 0)[0]
         return where(base_cov == 0)[0]
 ## ======================================================================
@@ -1319,8 +1273,11 @@ def get_consensus_from_array(read_array):
         Input:  read_array - 2d array from all the reads
         Output: ref_consensus - consensus 0-1 array for the reference
     '''
-    pos_sum = read_array.sum(axis=0) # take the column sum
-    pos_sum_array = pos_sum.reshape(-1,5) # convert to 2d array, with 5 columns
+    if is_banded(read_array):
+        pos_sum_array = read_array.call_sums() # column sums, as 2d array with 5 columns
+    else:
+        pos_sum = read_array.sum(axis=0) # take the column sum
+        pos_sum_array = pos_sum.reshape(-1,5) # convert to 2d array, with 5 columns
     pos_max = argmax(pos_sum_array, axis=1) # find the index of the base with maximum coverage
     consensus_array = zeros(pos_sum_array.shape,dtype = int32) # initialize the consensus_array to all 0
     consensus_array[ arange(pos_sum_array.shape[0]), pos_max ] = 1 # fill the consensus base coordinates with 1
@@ -1399,7 +1356,8 @@ def get_reads_for_gap(read_array, gap, skip_reads=[]):
     '''
     if len(skip_reads) > 0:
         keep_reads = array( [ i for i in arange(read_array.shape[0]) if i not in skip_reads ], dtype=int32 ) # indices of the reads that are kept (not skipped)
-        read_array = read_array[keep_reads,:] # slicing the read_array
+        if not is_banded(read_array):
+            read_array = read_array[keep_reads,:] # slicing the read_array
     else:
         keep_reads = arange(read_array.shape[0])
 
@@ -1408,8 +1366,11 @@ def get_reads_for_gap(read_array, gap, skip_reads=[]):
     else:
         gap_start = gap[0]
         gap_end = gap[1] + 1
-        read_array = read_array[:, gap_start*5:gap_end*5 ] # only look at the particular positions
-        coverages = apply_along_axis(cov_bps, axis=1, arr=read_array) # apply function cov_bps to find the coverage of all the other reads
+        if is_banded(read_array):
+            coverages = read_array.coverage(gap_start, gap_end)[keep_reads] # coverage of the gap region by all the other reads
+        else:
+            read_array = read_array[:, gap_start*5:gap_end*5 ] # only look at the particular positions
+            coverages = apply_along_axis(cov_bps, axis=1, arr=read_array) # apply function cov_bps to find the coverage of all the other reads
         reads_ind = keep_reads[ where(coverages!=0)[0] ] # indices of reads that have nonzero coverage in this region
         reads_cov = coverages[ where(coverages!=0)[0] ] # their corresponding coverage
         return reads_ind, reads_cov # return both the indices and the corresponding coverage of the specified region
@@ -1421,8 +1382,16 @@ def get_new_ref(ref_array, read_ind, read_array):
         Output: ref1 - new ref_array with the newly added read incorporated
     '''
     ref1 = ref_array.copy()
-    r_array= read_array[read_ind].reshape(-1,5) # convert the read's information to a 2d array with 5 columns
-    cov_pos = unique( where( r_array == 1) [0] ) # find the positions covered by this read
+    banded = is_banded(read_array)
+    if banded:
+        start, codes = read_array.band(read_ind)
+        r_array = zeros((read_array.npos, 5), dtype=int32)
+        r_array[start:(start + len(codes))] = banded_array.unpack_codes(codes).reshape(-1,5) # only the band of this read is filled
+        cov_pos = start + flatnonzero(codes) # find the positions covered by this read
+        call_sums = None
+    else:
+        r_array= read_array[read_ind].reshape(-1,5) # convert the read's information to a 2d array with 5 columns
+        cov_pos = unique( where( r_array == 1) [0] ) # find the positions covered by this read
     #print cov_pos
     # check each position: TODO now it's done with a loop, maybe should modify to a better way later TODO
     for pos in cov_pos: #TODO: actually, is it better to check only the region of the gap to be filled?
@@ -1437,7 +1406,12 @@ def get_new_ref(ref_array, read_ind, read_array):
                 ref1[pos*5 + read_calls] = 1
             else: # if there are more than 1 option, pick the one with more read support
                 #print "more than 1 options!!"
-                pos_sum = read_array[ :, (pos*5 + read_calls)].sum(axis=0) # find the column sum for those calls
+                if banded:
+                    if call_sums is None:
+                        call_sums = read_array.call_sums()
+                    pos_sum = call_sums[pos, read_calls] # find the column sum for those calls
+                else:
+                    pos_sum = read_array[ :, (pos*5 + read_calls)].sum(axis=0) # find the column sum for those calls
                 pos_max = argmax(pos_sum)
                 ref1[pos*5 + pos_max] = 1
             # sys.stdout.write(" {}\n".format(str(ref1[pos*5:(pos+1)*5]))) # for DEBUG
@@ -1446,7 +1420,7 @@ def get_new_ref(ref_array, read_ind, read_array):
 def write_compatible_reads(readsFasta, readinfo, compatible_ind, outDir):
     ''' Write read sequences in a fasta file.
         Input:  readsFasta - dictionary with read sequence information read_name => read_sequence
-                readinfo - dictionary read_string => names of reads that have the read string
+                readinfo - read_signatures.ReadSignatures, names of the reads of each row
                 compatible_ind - indices of reads that are compatible with some ref sequence
                 outDir - output directory
         Output: fasta file in the output directory with read sequences
@@ -1631,11 +1605,15 @@ def greedy_fill_gap_1(read_array, ref0=None, minOverlap=10,minOverlapRatio=0.1,
     #sys.stdout.write("\n")
         return best_ref, Min_tot_gap, best_Cvec
 ## ======================================================================
-def greedy_fill_gap(read_array, ref0=None, minOverlap=10, minOverlapRatio=0.1, verbose=False):
+def greedy_fill_gap(read_array, ref0=None, minOverlap=10, minOverlapRatio=0.1, verbose=False, engine=None, queue=None):
     ''' Try to fill THE widest gap(just one gap, not all gaps) resulted from ref0 and maximize the length of the longest segment in the resutled PacBio sequence using greedy algorithm
         If in verbose mode, write the newly proposed sequence and its compatible reads to files in a directory
+        Compatible reads, gaps and the longest segment of each proposed sequence are updated from those of ref0 by gap_engine, only around the changed positions.
         Input:  read_array - array including read information
                 ref0 - ref_array to start with, if not specified, call the consensus sequence instead
+                engine - gap_engine.GapEngine for read_array with the same minOverlap and minOverlapRatio, made here if not given
+                queue - gap_engine.GapQueue kept by the caller across calls, so that gaps that could not be filled are not tried again until the sequence changes.
+                        If not given, all the gaps are tried, widest first
         Output: (ref1, tot_gap, Cvec) - (new improved ref1, corresponding sequence with nucleotides, total number of gap positions/length, compatible read index array)
                 files that include new PacBio sequence and its compatible reads (fasta)
     '''
@@ -1658,49 +1636,48 @@ def greedy_fill_gap(read_array, ref0=None, minOverlap=10, minOverlapRatio=0.1, v
     # First try to fill gaps from the widest to the smallest
     if verbose:
         sys.stdout.write("Try to fill the gap in this sequence. \n")
-    Cvec = get_compatible_reads(ref0, read_array) # indices of reads that are compatible with ref0
-    Gap_pos = gap_pos(ref0, read_array, Cvec, minOverlap, minOverlapRatio) # positions not covered by the compatible reads (gap positions)
-    # starting sequence in string format
-    seq0 = array_to_seq(ref0)[-1] # with - for positions to delete
+    if engine is None:
+        engine = gap_engine.GapEngine(read_array, minOverlap, minOverlapRatio)
+    if queue is None:
+        queue = gap_engine.GapQueue(engine)
+    state0 = engine.state(ref0)
+    Cvec = state0.Cvec # indices of reads that are compatible with ref0
+    Gap_pos = state0.gaps # positions not covered by the compatible reads (gap positions)
     if len(Gap_pos) == 0: # If already covering the whole sequence
-        return ref0, len(seq0)-seq0.count('-'), Gap_pos, Cvec
+        return ref0, state0.max_len, Gap_pos, Cvec
 
     ## If there is still room to improve the sequence
-    for i in Gap_pos: # gap position will be written in lower case instead of upper case
-        seq0 = seq0[:i] + seq0[i].lower() + seq0[(i+1):] 
+    if verbose: # starting sequence in string format, with - for positions to delete
+        seq0 = array_to_seq(ref0)[-1]
+        for i in Gap_pos: # gap position will be written in lower case instead of upper case
+            seq0 = seq0[:i] + seq0[i].lower() + seq0[(i+1):] 
     gap_start_ind, gap_end_ind = get_gaps(Gap_pos) # starting and ending positions of all the gaps, in left to right order
     gap_lens = gap_end_ind - gap_start_ind + 1 # gap lengths
-    # sort gaps by their lengths
-    ind_gap_sort = argsort(gap_lens)[::-1] # sort in increasing order and then reverse the array
-    gap_start_ind = gap_start_ind[ind_gap_sort] # sort the gap indices and the lengths in decreasing order of the gap length
-    gap_end_ind = gap_end_ind[ind_gap_sort]
-    gap_lens = gap_lens[ind_gap_sort]
+    queue.update(state0) # gaps are taken from the queue, widest first
     
     # initialize the best solutions, and switches of ending conditions
     best_ref = ref0.copy()
     best_gap_pos = Gap_pos.copy()
     best_Cvec = Cvec.copy()
-    try:
-        old_max_len =  max(map(len, split_at_gap(Gap_pos, ref0)))
-    except ValueError:
-        old_max_len = 0
+    old_max_len = state0.max_len
 
     best_max_len = old_max_len
     improved = False
     gap_ind = 0
 
     if verbose: # log message
+        ind_gap_sort = argsort(gap_lens)[::-1] # sort in decreasing order of the gap length
         sys.stdout.write("\nGaps in starting sequence:\n")
-        for i in xrange(len(gap_lens)):
+        for i in ind_gap_sort:
             sys.stdout.write("({}, {}): {}\t".format(gap_start_ind[i], gap_end_ind[i], gap_lens[i]))
         sys.stdout.write("\nMaximum length is: {}\n".format(old_max_len))
-        sys.stdout.write("=== Maximum gap length is {}: ({}, {}).\n".format(gap_lens[0], gap_start_ind[0], gap_end_ind[0]))
-
+        sys.stdout.write("=== Maximum gap length is {}: ({}, {}).\n".format(gap_lens[ind_gap_sort[0]], gap_start_ind[ind_gap_sort[0]], gap_end_ind[ind_gap_sort[0]]))
 
-    while not improved and gap_ind < len(gap_lens): # until gap length improved, or all the gaps have been investigated
+    gap = queue.pop()
+    while not improved and gap is not None: # until gap length improved, or all the gaps worth trying have been investigated
         if verbose:
-            sys.stdout.write("Working on gap_ind:  {} : ({}, {})\n".format(gap_ind,gap_start_ind[gap_ind], gap_end_ind[gap_ind]))
-        reads_ind, reads_cov = get_reads_for_gap(read_array, (gap_start_ind[gap_ind], gap_end_ind[gap_ind]), skip_reads=Cvec) # get reads that can fill at least 1 base of the gap, and how many bases they fill
+            sys.stdout.write("Working on gap_ind:  {} : ({}, {})\n".format(gap_ind, gap[0], gap[1]))
+        reads_ind, reads_cov = queue.reads_for_gap(gap, state0.compatible) # get reads that can fill at least 1 base of the gap, and how many bases they fill
         ind_sort = argsort(reads_cov)[::-1]  # sort the read indices by the coverage of the gap
         reads_ind = reads_ind[ind_sort]
         # initialize the current best choice
@@ -1715,12 +1692,10 @@ def greedy_fill_gap(read_array, ref0=None, minOverlap=10, minOverlapRatio=0.1, v
             ref1 = get_new_ref(ref0, reads_ind[0], read_array) # get a new ref, according to the highest ranked read
             #print array_to_seq(ref0)[-1] # gap position will be written in lower case instead of upper case
             #print array_to_seq(ref1)[-1] # gap position will be written in lower case instead of upper case
-            Cvec1 = get_compatible_reads(ref1, read_array) # indices of reads that are compatible with ref1
-            gap_pos1 = gap_pos(ref1, read_array, Cvec1, minOverlap, minOverlapRatio) # positions not covered by the compatible reads (gap positions)
-            try:
-                max_len = max(map(len, split_at_gap(gap_pos1, ref1)))
-            except ValueError:
-                max_len = 0
+            state1 = engine.propose(state0, ref1) # only the reads covering the positions changed from ref0 are checked again
+            Cvec1 = state1.Cvec # indices of reads that are compatible with ref1
+            gap_pos1 = state1.gaps # positions not covered by the compatible reads (gap positions)
+            max_len = state1.max_len
             if len(gap_pos1) == 0: # by luck, all the gaps are filled!
                 if verbose:
                     sys.stdout.write("no more gaps\n")
@@ -1734,7 +1709,7 @@ def greedy_fill_gap(read_array, ref0=None, minOverlap=10, minOverlapRatio=0.1, v
                 gap_start_ind1, gap_end_ind1 = get_gaps(gap_pos1) # starting and ending positions of all the gaps, in left to right order
                 gap_lens1 = gap_end_ind1 - gap_start_ind1 + 1 # gap lengths
                 # if this step decreased the number of gaps by at least 1, and maximum gap is among them, then stop iteration
-                if len(setdiff1d(gap_pos1,Gap_pos)) == 0 and (sum(gap_lens1) - sum(gap_lens)) == gap_lens[gap_ind]:
+                if len(setdiff1d(gap_pos1,Gap_pos)) == 0 and (sum(gap_lens1) - sum(gap_lens)) == gap[1] - gap[0] + 1:
                     if verbose:
                         sys.stdout.write("This one gap is totally filled\n")
                     totally_filled = True
@@ -1751,14 +1726,13 @@ def greedy_fill_gap(read_array, ref0=None, minOverlap=10, minOverlapRatio=0.1, v
                         best_gap_pos = gap_pos1.copy()
                         best_Cvec = Cvec1.copy()
                     reads_ind = delete(reads_ind,0)
-                    delete_ind = []
-                    for i in xrange(len(reads_ind)): # delete the ones compatible with this chosen one, test these and see if the improvement is bigger. save remaining reads to check,
-                        if reads_ind[i] in Cvec1:
-                            delete_ind.append(i)
-                    reads_ind = delete(reads_ind,array(delete_ind))
+                    reads_ind = reads_ind[ ~state1.compatible[reads_ind] ] # delete the ones compatible with this chosen one, test these and see if the improvement is bigger. save remaining reads to check,
                     if verbose:
                         sys.stdout.write("maximum length: {}, remaining reads: {}, continue\n".format(best_max_len, len(reads_ind)))
                 #print array_to_seq(best_ref)[-1] # gap position will be written in lower case instead of upper case
+        if not improved: # not tried again until the sequence changes
+            queue.fail(gap)
+            gap = queue.pop()
         gap_ind += 1
         if verbose:
             sys.stdout.write("Next gap index: {}\n".format(gap_ind))
@@ -1792,7 +1766,9 @@ def fill_gap(read_array, minOverlap=10, minOverlapRatio = 0.1, outFastaFile=None
                 outDir, readinfo - required for verbose mode
         Output: (best_ref, Max_len, Cvec) - (best ref_array so far, number of gap from this ref_array, compatible reads' indices)
     '''
-    ref0 = greedy_fill_gap(read_array, ref0=None, minOverlap = minOverlap, minOverlapRatio=minOverlapRatio, verbose=verbose) # start with consensus sequence, summarized from all the reads
+    engine = gap_engine.GapEngine(read_array, minOverlap, minOverlapRatio) # shared by all the iterations
+    queue = gap_engine.GapQueue(engine) # gaps to fill, kept across the iterations
+    ref0 = greedy_fill_gap(read_array, ref0=None, minOverlap = minOverlap, minOverlapRatio=minOverlapRatio, verbose=verbose, engine=engine, queue=queue) # start with consensus sequence, summarized from all the reads
     iter_number = 1
     Max_len = ref0[1]
     print_tmp_files = False
@@ -1830,7 +1806,7 @@ def fill_gap(read_array, minOverlap=10, minOverlapRatio = 0.1, outFastaFile=None
             #write_compatible_reads(readsFasta, readinfo, ref0[-1], cur_dir + '/' )
         #print "ref0:", ref0
         if len(ref0[2]) > 0:
-            ref1 = greedy_fill_gap(read_array, ref0[0], minOverlap, minOverlapRatio, verbose=verbose)
+            ref1 = greedy_fill_gap(read_array, ref0[0], minOverlap, minOverlapRatio, verbose=verbose, engine=engine, queue=queue)
             max_len = ref1[1]
             if max_len > Max_len:
                 Max_len = max_len
@@ -1880,10 +1856,7 @@ def sam_record_gen(read_array1d, ref, qname, rname):
     TLEN = '0'
     SEQ = re.sub('-','',read_short)
     QUAL = '*'
-    char = re.findall('\D',CIGAR) # operation characters, MIDNSHP=X
-    char = [x.upper() for x in char]  # convert to upper case
-    count = map(int,re.findall('\d+',CIGAR))
-    NM = str(sum(count[i] for i in xrange(len(char)) if char[i] in 'XID')) # length of the mapped read (including clipped part)
+    NM = str(sum(n for n, op in cigar_parser.cigar_info(CIGAR).ops if op in 'XID')) # edit distance from the alignment
     rec = '\t'.join([qname, FLAG, str(rname), POS, MAPQ, CIGAR, RNEXT, PNEXT, TLEN, SEQ, QUAL, 'NM:i:'+NM]) + '\n'
     return rec
 ## ======================================================================
@@ -1891,7 +1864,7 @@ def samfile_gen(read_array, ref, readinfo, rname, rLen, out, Cvec=None):
     ''' Generate sam file given information of reads and reference in arrays.
         Input:  read_array - reads' information in array
                 ref - reference/PacBio information in 1d array
-                readinfo - dictionary read_string -> read_name
+                readinfo - read_signatures.ReadSignatures, names of the reads of each row
                 rLen - length of the reference sequence
                 rname - reference sequence name
                 Cvec - indices of read_array's rows to include in sam file
@@ -1900,12 +1873,12 @@ def samfile_gen(read_array, ref, readinfo, rname, rLen, out, Cvec=None):
     if Cvec is None:
         Cvec = xrange(read_array.shape[0])
     #print Cvec
-    read_names = [readinfo[key] for key in sorted(readinfo)]
+    read_names = readinfo.read_names()
     out.write('{}\t{}\t{}\n'.format('@HD', 'VN:1.4', 'SO:unsorted'))
     out.write('@SQ\tSN:{}\tLN:{}\n'.format(rname, rLen))
     out.write('@PG\tID:MetalRec\tPN:MetalRec\n')
     for i in Cvec:
-        read_array1d = read_array[i,:]
+        read_array1d = read_row(read_array, i)
         #print i, read_array1d
         qnames = read_names[i] # there could be more than one read with the same read info
         rec = sam_record_gen(read_array1d, ref, qnames[0], rname)
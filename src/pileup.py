@@ -0,0 +1,181 @@
+#!/usr/bin/python
+
+''' Pileup of the short reads aligned to a PacBio read, built by metalrec_lib.read_and_process_sam_samread.
+    Base calls at the PacBio positions are counted in one (rLen x 5) uint32 array (ACGTD columns) instead of one python list per position,
+    each read is added with a single fancy-indexed increment. Inserted bases are collected while the reads are added,
+    and counted at the end into an InsertionTable, which has the same dictionary style access as the old ref_ins_dict.
+'''
+import numpy
+
+alphabet = 'ACGTD' # all the possible base pairs at a position
+BASE_CODE = -numpy.ones(256, dtype=numpy.int64) # character => index in alphabet, -1 for other characters, same as alphabet.find
+for code, base in enumerate(alphabet):
+    BASE_CODE[ord(base)] = code
+CALL_WEIGHTS = 1 << numpy.arange(5) # bit of each base in a packed call code, same packing as banded_array.pack_calls
+CODE_BASES = [ [alphabet[k] for k in xrange(5) if (code >> k) & 1] for code in xrange(32) ] # packed call code => list of called bases
+CODE_COUNT = numpy.array([len(bases) for bases in CODE_BASES], dtype=numpy.int32) # number of called bases in a packed code
+
+## ======================================================================
+def base_codes(bases):
+    ''' Indices in alphabet of all the characters of a string, -1 for characters not in alphabet '''
+    return BASE_CODE[numpy.fromstring(bases, dtype=numpy.uint8)]
+## ======================================================================
+def pack_mask(mask):
+    ''' Pack a boolean array of base calls (last dimension ACGT or ACGTD) into one uint8 code per position '''
+    mask = numpy.asarray(mask)
+    return numpy.dot(mask.astype(numpy.int64), CALL_WEIGHTS[:mask.shape[-1]]).astype(numpy.uint8)
+## ======================================================================
+class InsertionTable(object):
+    ''' Counts of the bases inserted after the PacBio positions.
+        Attributes:
+                pos - sorted int64 array of the positions with insertions
+                ptr - int64 array of length len(pos)+1, rows ptr[k] to ptr[k+1]-1 of counts are for position pos[k]
+                counts - (number of inserted bases x 4) uint32 array, ACGT counts for each (position, index of inserted base)
+        table[pos] is the (inserted length x 4) counts array of a position, so table[pos][i][j] has the same meaning as ref_ins_dict[pos][i][j] before.
+    '''
+    def __init__(self, pos, ptr, counts):
+        self.pos = numpy.asarray(pos, dtype=numpy.int64)
+        self.ptr = numpy.asarray(ptr, dtype=numpy.int64)
+        self.counts = numpy.asarray(counts, dtype=numpy.uint32).reshape(-1, 4)
+        self._index = dict(zip(self.pos.tolist(), xrange(len(self.pos)))) # position => index in pos
+
+    @classmethod
+    def from_calls(cls, positions, indices, codes):
+        ''' Count inserted bases
+            Input:  positions - position of each inserted base
+                    indices - index of each inserted base among the bases inserted at the same position by the same read
+                    codes - index in alphabet of each inserted base (-1 is counted as 'T', like the old list indexing)
+        '''
+        positions = numpy.asarray(positions, dtype=numpy.int64)
+        indices = numpy.asarray(indices, dtype=numpy.int64)
+        codes = numpy.asarray(codes, dtype=numpy.int64)
+        if len(positions) == 0:
+            return cls([], [0], numpy.zeros((0, 4)))
+        maxLen = indices.max() + 1
+        keys, inverse = numpy.unique(positions * maxLen + indices, return_inverse=True) # one key for each (position, index)
+        counts = numpy.bincount(inverse * 4 + codes % 4, minlength=len(keys) * 4)
+        pos, first = numpy.unique(keys // maxLen, return_index=True) # keys are sorted, first row of each position
+        return cls(pos, numpy.append(first, len(keys)), counts)
+
+    def __len__(self):
+        return len(self.pos)
+
+    def __contains__(self, pos):
+        return pos in self._index
+
+    def __iter__(self):
+        return iter(self.pos.tolist())
+
+    def keys(self):
+        return self.pos.tolist()
+
+    def __getitem__(self, pos):
+        k = self._index[pos]
+        return self.counts[self.ptr[k]:self.ptr[k + 1]]
+
+    def get(self, pos, default=None):
+        if pos in self._index:
+            return self[pos]
+        return default
+
+    def lengths(self):
+        ''' Maximum inserted length at each position in pos '''
+        return numpy.diff(self.ptr)
+## ======================================================================
+class Pileup(object):
+    ''' Base calls of the reads aligned to a reference (PacBio) sequence.
+        Attributes:
+                bps - (rLen x 5) uint32 array, number of reads calling each of ACGTD at each position
+        Inserted bases are kept in lists until insertions() counts them.
+    '''
+    def __init__(self, rLen):
+        self.bps = numpy.zeros((rLen, 5), dtype=numpy.uint32)
+        self._ins_pos = []
+        self._ins_ind = []
+        self._ins_bases = []
+
+    def add_read(self, pos_dict, ins_dict):
+        ''' Add the base calls of one read
+            Input:  pos_dict - ref_pos => base call ('D' for deletion), for the match/mismatch/deletion positions
+                    ins_dict - ref_pos => inserted base(s)
+        '''
+        if len(pos_dict) > 0:
+            positions = numpy.fromiter(pos_dict.iterkeys(), dtype=numpy.int64, count=len(pos_dict))
+            codes = base_codes(''.join(pos_dict.itervalues())) # keys and values are listed in the same order
+            self.bps[positions, codes] += 1 # each position appears once in a read, so there are no repeated indices
+        for ins in ins_dict:
+            ins_chars = ins_dict[ins]
+            self._ins_pos.extend([ins] * len(ins_chars))
+            self._ins_ind.extend(xrange(len(ins_chars)))
+            self._ins_bases.append(ins_chars)
+
+    def insertions(self):
+        ''' InsertionTable of all the inserted bases added so far '''
+        return InsertionTable.from_calls(self._ins_pos, self._ins_ind, base_codes(''.join(self._ins_bases)))
+
+    def coverage(self):
+        ''' Coverage depth (number of non-insertion base calls) at each position '''
+        return self.bps.sum(axis=1, dtype=numpy.int64)
+## ======================================================================
+class PositionCalls(object):
+    ''' Base calls made from the pileup in a region, one packed code per position (bit k set if alphabet[k] is called).
+        Positions with exactly one called base are consensus positions, the others are polymorphic.
+        Attributes:
+                region - (begin, end) of the region
+                cvs - int64 array, coverage depth at each position of the region
+                codes - uint8 array, called bases at each position of the region
+                ins_pos, ins_ind - int64 arrays, position and index of the inserted bases with at least one called base
+                ins_codes - uint8 array, called bases of each of these inserted bases
+    '''
+    def __init__(self, region, cvs, codes, ins_pos, ins_ind, ins_codes):
+        self.region = region
+        self.cvs = cvs
+        self.codes = codes
+        self.ins_pos = ins_pos
+        self.ins_ind = ins_ind
+        self.ins_codes = ins_codes
+
+    def is_consensus(self):
+        ''' Boolean masks of the consensus positions and of the consensus inserted bases '''
+        return CODE_COUNT[self.codes] == 1, CODE_COUNT[self.ins_codes] == 1
+
+    def as_dicts(self):
+        ''' Same output as metalrec_lib.get_poly_pos: poly_bps, poly_ins, consensus_bps, consensus_ins dictionaries and the list of coverage depths '''
+        is_cons, is_cons_ins = self.is_consensus()
+        begin = self.region[0]
+        positions = numpy.arange(begin, begin + len(self.codes)).tolist()
+        codes = self.codes.tolist()
+        consensus_bps = dict((positions[k], CODE_BASES[codes[k]][0]) for k in numpy.flatnonzero(is_cons).tolist())
+        poly_bps = dict((positions[k], list(CODE_BASES[codes[k]])) for k in numpy.flatnonzero(~is_cons).tolist())
+        ins_keys = zip(self.ins_pos.tolist(), self.ins_ind.tolist())
+        codes = self.ins_codes.tolist()
+        consensus_ins = dict((ins_keys[k], CODE_BASES[codes[k]][0]) for k in numpy.flatnonzero(is_cons_ins).tolist())
+        poly_ins = dict((ins_keys[k], list(CODE_BASES[codes[k]])) for k in numpy.flatnonzero(~is_cons_ins).tolist())
+        return poly_bps, poly_ins, consensus_bps, consensus_ins, self.cvs.tolist()
+## ======================================================================
+def call_positions(bps, ins_table, region):
+    ''' Consensus and polymorphic base calls in a region, from the base call counts.
+        A base is called at a position if it has at least minCover(cv) reads (1 read if cv <= 3, 2 reads otherwise);
+        if no base is called this way, every base with a read is called. Inserted bases are called with the threshold of their position,
+        and dropped if no base is called.
+        Input:  bps - (rLen x 5) base call counts
+                ins_table - InsertionTable
+                region - (begin, end) of the region
+        Output: PositionCalls
+    '''
+    begin, end = region
+    bps = numpy.asarray(bps)[begin:end].astype(numpy.int64)
+    cvs = bps.sum(axis=1) # coverage depths
+    min_covers = numpy.where(cvs <= 3, 1, 2) # minimum read support for a base call to be considered correct
+    codes = pack_mask(bps >= min_covers[:, numpy.newaxis])
+    weak = numpy.flatnonzero(codes == 0) # no base has enough read support, treat base call with 1 read support as valid
+    codes[weak] = pack_mask(bps[weak] > 0)
+    # inserted bases after the positions in the region
+    lo, hi = numpy.searchsorted(ins_table.pos, region)
+    lengths = ins_table.lengths()[lo:hi]
+    ins_pos = numpy.repeat(ins_table.pos[lo:hi], lengths) # position of every inserted base
+    ins_ind = numpy.arange(lengths.sum()) - numpy.repeat(numpy.cumsum(lengths) - lengths, lengths) # index of every inserted base at its position
+    counts = ins_table.counts[ins_table.ptr[lo]:ins_table.ptr[hi]]
+    ins_codes = pack_mask(counts >= min_covers[ins_pos - begin][:, numpy.newaxis])
+    called = numpy.flatnonzero(ins_codes) # insertion positions without a called base are not considered existent
+    return PositionCalls((begin, end), cvs, codes, ins_pos[called], ins_ind[called], ins_codes[called])
@@ -0,0 +1,289 @@
+#!/usr/bin/python
+
+''' Base calls of the unique reads aligned to a PacBio read, built by metalrec_lib.read_and_process_sam_samread.
+    Before, every read was turned into a string key dict_to_string(pos_dict) + ':' + dict_to_string(ins_dict), and
+    make_read_array1d parsed the key again with regular expressions for every region. A read is now kept as its signature:
+    the first non-insertion position, one uint8 base per non-insertion position from there on, and the insertion table
+    (positions, inserted lengths and bases); the bases are kept as they are in the read, and turned into codes when the
+    calls of a region are made. Reads with the same signature share one row, and the packed signature bytes are the dictionary key.
+    The rows are still ordered by the read string of the old key (built once per unique read), since the order of the rows
+    breaks the ties between reads in metalrec_lib.greedy_fill_gap.
+'''
+import numpy
+import banded_array
+
+alphabet = 'ACGTD' # all the possible base pairs at a position
+OTHER = 5 # code of a base call that is not in alphabet
+NO_CALL = 255 # position between the first and last calls of a read that the read does not call
+SIGNATURE_CODE = numpy.empty(256, dtype=numpy.uint8) # character => index in alphabet, OTHER for other characters
+SIGNATURE_CODE.fill(OTHER)
+for code, base in enumerate(alphabet):
+    SIGNATURE_CODE[ord(base)] = code
+
+## ======================================================================
+def signature_codes(bases):
+    ''' Codes of all the characters of a string '''
+    return SIGNATURE_CODE[numpy.fromstring(bases, dtype=numpy.uint8)]
+## ======================================================================
+def signature_bases(bases):
+    ''' Bytes of all the characters of a string '''
+    return numpy.fromstring(bases, dtype=numpy.uint8)
+## ======================================================================
+def signature(pos_dict, ins_dict):
+    ''' Signature of one read
+        Input:  pos_dict - ref_pos => base call ('D' for deletion), for the match/mismatch/deletion positions
+                ins_dict - ref_pos => inserted base(s)
+        Output: (key, start, bases, ins_pos, ins_len, ins_bases) - key is the packed bytes of the other entries
+    '''
+    if len(pos_dict) > 0:
+        positions = numpy.fromiter(pos_dict.iterkeys(), dtype=numpy.int64, count=len(pos_dict))
+        start = positions.min()
+        bases = numpy.empty(positions.max() - start + 1, dtype=numpy.uint8)
+        bases.fill(NO_CALL)
+        bases[positions - start] = signature_bases(''.join(pos_dict.itervalues())) # keys and values are listed in the same order
+    else:
+        start = 0
+        bases = numpy.zeros(0, dtype=numpy.uint8)
+    ins_keys = sorted(ins_dict)
+    ins_pos = numpy.array(ins_keys, dtype=numpy.int64)
+    ins_len = numpy.array([len(ins_dict[pos]) for pos in ins_keys], dtype=numpy.int64)
+    ins_bases = signature_bases(''.join([ins_dict[pos] for pos in ins_keys]))
+    key = numpy.array([start, len(bases), len(ins_pos)], dtype=numpy.int64).tostring() + bases.tostring() + ins_pos.tostring() + ins_len.tostring() + ins_bases.tostring()
+    return key, start, bases, ins_pos, ins_len, ins_bases
+## ======================================================================
+def read_string(read_signature):
+    ''' dict_to_string(pos_dict) + ':' + dict_to_string(ins_dict) of a signature, the old readinfo key of the read '''
+    key, start, bases, ins_pos, ins_len, ins_bases = read_signature
+    called = numpy.flatnonzero(bases != NO_CALL)
+    bpstring = ''.join([str(pos) + base for pos, base in zip((called + start).tolist(), bases[called].tostring())])
+    ins_string = ins_bases.tostring()
+    ins_ends = numpy.cumsum(ins_len).tolist()
+    insstring = ''.join([str(pos) + ins_string[(end - length):end] for pos, length, end in zip(ins_pos.tolist(), ins_len.tolist(), ins_ends)])
+    return bpstring + ':' + insstring
+## ======================================================================
+class ReadSignatures(object):
+    ''' Unique read signatures and the names of the reads with each signature, used instead of the readinfo dictionary.
+        After table() the signatures of all the rows are concatenated:
+                starts - int64 array, start position of each row
+                bp_ptr - int64 array of length nrows+1, bases of row i are bp_bases[bp_ptr[i]:bp_ptr[i+1]]
+                ins_ptr - int64 array of length nrows+1, insertions of row i are ins_pos/ins_len[ins_ptr[i]:ins_ptr[i+1]]
+                ins_bases - uint8 array, inserted bases of all the insertions, in the same order
+    '''
+    def __init__(self):
+        self._index = dict() # signature key => index in _signatures
+        self._signatures = []
+        self._names = [] # names of the reads with each signature
+        self._order = None # indices in _signatures, in row order
+        self._table = None
+
+    def add(self, read_signature, qname):
+        ''' Add one read with its signature (from function signature) '''
+        key = read_signature[0]
+        i = self._index.get(key)
+        if i is None:
+            i = len(self._signatures)
+            self._index[key] = i
+            self._signatures.append(read_signature)
+            self._names.append([])
+            self._order = None
+            self._table = None
+        self._names[i].append(qname)
+
+    def __len__(self):
+        return len(self._signatures)
+
+    def order(self):
+        ''' Indices of the signatures in row order, the order of their read strings '''
+        if self._order is None:
+            strings = [read_string(sig) for sig in self._signatures]
+            self._order = sorted(xrange(len(self._signatures)), key=strings.__getitem__)
+        return self._order
+
+    def read_names(self):
+        ''' List of the read names of each row '''
+        return [self._names[i] for i in self.order()]
+
+    def counts(self):
+        ''' Number of reads of each row '''
+        return numpy.array([len(self._names[i]) for i in self.order()], dtype=numpy.int32)
+
+    def table(self):
+        ''' (starts, bp_ptr, bp_bases, ins_ptr, ins_pos, ins_len, ins_bases) of all the rows '''
+        if self._table is None:
+            sigs = [self._signatures[i] for i in self.order()]
+            starts = numpy.array([sig[1] for sig in sigs], dtype=numpy.int64)
+            bp_ptr = numpy.concatenate(([0], numpy.cumsum([len(sig[2]) for sig in sigs]))).astype(numpy.int64)
+            ins_ptr = numpy.concatenate(([0], numpy.cumsum([len(sig[3]) for sig in sigs]))).astype(numpy.int64)
+            columns = [numpy.concatenate([numpy.zeros(0, dtype=dtype)] + [sig[k] for sig in sigs]).astype(dtype) for k, dtype in ((2, numpy.uint8), (3, numpy.int64), (4, numpy.int64), (5, numpy.uint8))]
+            self._table = (starts, bp_ptr, columns[0], ins_ptr, columns[1], columns[2], columns[3])
+        return self._table
+## ======================================================================
+def _expand(ptr):
+    ''' Row index and index within the row of every entry of the rows delimited by ptr '''
+    lengths = numpy.diff(ptr)
+    rows = numpy.repeat(numpy.arange(len(lengths)), lengths)
+    return rows, numpy.arange(ptr[-1]) - ptr[:-1][rows]
+## ======================================================================
+def _row_span(rows, values, nrows):
+    ''' Minimum and maximum value of each row, rows have to be sorted
+        Output: (nrows x 2) int64 array, (max int64, -1) for the rows without values
+    '''
+    span = numpy.empty((nrows, 2), dtype=numpy.int64)
+    span[:, 0] = numpy.iinfo(numpy.int64).max
+    span[:, 1] = -1
+    if len(rows) > 0:
+        first = numpy.flatnonzero(numpy.concatenate(([True], rows[1:] != rows[:-1])))
+        span[rows[first], 0] = numpy.minimum.reduceat(values, first)
+        span[rows[first], 1] = numpy.maximum.reduceat(values, first)
+    return span
+## ======================================================================
+class RegionTables(object):
+    ''' Dense lookup tables of a region, built once and shared by all the reads in the region instead of dictionary lookups for every base.
+        Attributes:
+                start, npos - start of the region on the extended sequence, and its length (len(type_array))
+                types - type of each position, same as type_array
+                cons - index in alphabet of the consensus base at each consensus position
+                poly - packed possible calls at each polymorphic position
+                bp_offset, bp_ext - bp_ext[pos - bp_offset] is the extended position of the original non-insertion position pos, -1 if pos is not in the region
+                ins_offset, maxLen, ins_ext - ins_ext[(pos - ins_offset) * maxLen + j] is the extended position of the j-th base inserted at pos, -1 if none
+                ins_types - positions of the insertion positions (type 1 or 3) in the region
+                ins_rank - number of insertion positions before each position, with one more entry at the end
+    '''
+    def __init__(self, bp_pos_dict, ins_pos_dict, type_array, poly_bps_ext, poly_ins_ext, consensus_bps_ext, consensus_ins_ext, ext_region=None):
+        if ext_region is None:
+            all_pos = bp_pos_dict.values() + ins_pos_dict.values() # values instead of keys, since it's the "extended" region
+            ext_region = (min(all_pos), max(all_pos)+1 ) # the end is one bigger than the 0-based end
+        self.start = ext_region[0]
+        self.types = numpy.asarray(type_array)
+        self.npos = len(self.types)
+
+        # calls made at each position: consensus base index, and packed polymorphic calls
+        self.cons = numpy.zeros(self.npos, dtype=numpy.int64)
+        self.poly = numpy.zeros(self.npos, dtype=numpy.int64)
+        for calls in (consensus_bps_ext, consensus_ins_ext):
+            if len(calls) > 0:
+                self.cons[numpy.fromiter(calls.iterkeys(), dtype=numpy.int64, count=len(calls)) - self.start] = signature_codes(''.join(calls.itervalues()))
+        for calls in (poly_bps_ext, poly_ins_ext):
+            for pos in calls:
+                self.poly[pos - self.start] = sum([1 << alphabet.index(base) for base in calls[pos]])
+
+        # original position => extended position
+        keys = numpy.fromiter(bp_pos_dict.iterkeys(), dtype=numpy.int64, count=len(bp_pos_dict))
+        self.bp_offset = keys.min() if len(keys) > 0 else 0
+        self.bp_ext = -numpy.ones(keys.max() - self.bp_offset + 1 if len(keys) > 0 else 0, dtype=numpy.int64)
+        self.bp_ext[keys - self.bp_offset] = numpy.fromiter(bp_pos_dict.itervalues(), dtype=numpy.int64, count=len(bp_pos_dict))
+        pos = numpy.array([key[0] for key in ins_pos_dict], dtype=numpy.int64)
+        ind = numpy.array([key[1] for key in ins_pos_dict], dtype=numpy.int64)
+        self.ins_offset = pos.min() if len(pos) > 0 else 0
+        self.maxLen = ind.max() + 1 if len(ind) > 0 else 0
+        self.ins_ext = -numpy.ones((pos.max() - self.ins_offset + 1) * self.maxLen if len(pos) > 0 else 0, dtype=numpy.int64)
+        self.ins_ext[(pos - self.ins_offset) * self.maxLen + ind] = numpy.fromiter(ins_pos_dict.itervalues(), dtype=numpy.int64, count=len(ins_pos_dict))
+
+        is_ins = (self.types == 1) | (self.types == 3)
+        self.ins_types = numpy.flatnonzero(is_ins)
+        self.ins_rank = numpy.concatenate(([0], numpy.cumsum(is_ins)))
+
+    def bp_positions(self, positions):
+        ''' Extended positions of original non-insertion positions, -1 for the positions not in the region '''
+        if len(self.bp_ext) == 0:
+            return -numpy.ones(len(positions), dtype=numpy.int64)
+        ind = positions - self.bp_offset
+        inside = (ind >= 0) & (ind < len(self.bp_ext))
+        return numpy.where(inside, self.bp_ext[numpy.where(inside, ind, 0)], -1)
+
+    def ins_positions(self, positions, indices):
+        ''' Extended positions of inserted bases (original position, index among the bases inserted there), -1 for the bases not in the region '''
+        if len(self.ins_ext) == 0:
+            return -numpy.ones(len(positions), dtype=numpy.int64)
+        ind = (positions - self.ins_offset) * self.maxLen + indices
+        inside = (positions >= self.ins_offset) & (indices < self.maxLen) & (ind < len(self.ins_ext))
+        return numpy.where(inside, self.ins_ext[numpy.where(inside, ind, 0)], -1)
+
+    def read_calls(self, codes, rel, cons_type, poly_type):
+        ''' Packed calls of the reads at positions of the region, and whether each read base call disagrees with them.
+            At a consensus position the consensus base is called; at a polymorphic position the read's own base if it is among the
+            possible calls, all the possible calls otherwise. Positions of other types get no call.
+            Input:  codes - signature codes of the read base calls
+                    rel - positions in the region
+                    cons_type, poly_type - types of the consensus and polymorphic positions (0 and 2, or 1 and 3 for insertions)
+            Output: bits - packed calls, changed - boolean array
+        '''
+        t = self.types[rel]
+        c = self.cons[rel]
+        m = self.poly[rel]
+        codes = codes.astype(numpy.int64)
+        in_poly = (m >> codes) & 1 == 1
+        bits = numpy.where(t == cons_type, 1 << c, numpy.where(t == poly_type, numpy.where(in_poly, 1 << numpy.minimum(codes, 4), m), 0))
+        changed = ((t == cons_type) & (codes != c)) | ((t == poly_type) & ~in_poly)
+        return bits, changed
+## ======================================================================
+def region_bands(signatures, tables):
+    ''' Base calls of all the rows of a ReadSignatures in a region, same as metalrec_lib.make_read_array1d for every read string,
+        computed for all the reads at once.
+        A read that does not call any non-insertion position of the region, or that needs at least 5 changes to agree with
+        the consensus/polymorphic calls, covers nothing. A read that misses an insertion position between its first and last
+        non-insertion positions calls a deletion there.
+        Input:  signatures - ReadSignatures
+                tables - RegionTables of the region
+        Output: rows - indices of the rows that cover some positions
+                read_array - banded_array.BandedReadArray of these rows, npos is the length of the region
+    '''
+    start = tables.start
+    npos = tables.npos
+    nrows = len(signatures)
+    starts, bp_ptr, bp_bases, ins_ptr, ins_pos, ins_len, ins_bases = signatures.table()
+
+    # non-insertion base calls of the reads in the region
+    rows, offsets = _expand(bp_ptr)
+    ext = tables.bp_positions(starts[rows] + offsets)
+    called = numpy.flatnonzero((bp_bases != NO_CALL) & (ext >= 0))
+    bp_rows = rows[called]
+    bp_rel = ext[called] - start
+    bp_bits, bp_changed = tables.read_calls(SIGNATURE_CODE[bp_bases[called]], bp_rel, 0, 2)
+
+    # inserted base calls of the reads in the region
+    insertions, ins_ind = _expand(numpy.concatenate(([0], numpy.cumsum(ins_len)))) # insertion and index within it of every inserted base
+    ins_rows = numpy.repeat(numpy.arange(nrows), numpy.diff(ins_ptr))[insertions]
+    ext = tables.ins_positions(ins_pos[insertions], ins_ind)
+    inside = numpy.flatnonzero((ext >= 0) & (ext - start < npos)) # when more than 1 base pair is inserted, the position could go out of the region
+    in_rows = ins_rows[inside]
+    in_rel = ext[inside] - start
+    ins_bits, ins_changed = tables.read_calls(SIGNATURE_CODE[ins_bases[inside]], in_rel, 1, 3)
+
+    # reads without non-insertion positions in the region, or with at least 5 disagreements, are discarded
+    bp_span = _row_span(bp_rows, bp_rel, nrows)
+    changed = numpy.bincount(bp_rows, weights=bp_changed, minlength=nrows) + numpy.bincount(in_rows, weights=ins_changed, minlength=nrows)
+    keep = (bp_span[:, 1] >= 0) & (changed < 5)
+
+    # deletions at the insertion positions a read misses between its first and last non-insertion positions
+    kept_rows = numpy.flatnonzero(keep)
+    lo = numpy.zeros(nrows, dtype=numpy.int64) # tables.ins_types[lo[i]:hi[i]] are the insertion positions inside the span of row i
+    hi = numpy.zeros(nrows, dtype=numpy.int64)
+    lo[kept_rows] = tables.ins_rank[bp_span[kept_rows, 0]]
+    hi[kept_rows] = tables.ins_rank[bp_span[kept_rows, 1] + 1]
+    del_ptr = numpy.concatenate(([0], numpy.cumsum(hi[kept_rows] - lo[kept_rows])))
+    del_start = numpy.zeros(nrows, dtype=numpy.int64)
+    del_start[kept_rows] = del_ptr[:-1]
+    missed = numpy.ones(del_ptr[-1], dtype=bool)
+    rank = tables.ins_rank[in_rel]
+    hit = numpy.flatnonzero(keep[in_rows] & (tables.types[in_rel] % 2 == 1) & (rank >= lo[in_rows]) & (rank < hi[in_rows]))
+    missed[del_start[in_rows[hit]] + rank[hit] - lo[in_rows[hit]]] = False
+    del_ind, ind = _expand(del_ptr)
+    del_rows = kept_rows[del_ind][missed]
+    del_rel = tables.ins_types[lo[kept_rows[del_ind]] + ind][missed]
+
+    # calls of the kept reads, the calls from the three sources are at different (row, position)
+    bp_sel = numpy.flatnonzero(keep[bp_rows] & (bp_bits != 0))
+    ins_sel = numpy.flatnonzero(keep[in_rows] & (ins_bits != 0))
+    spans = [_row_span(bp_rows[bp_sel], bp_rel[bp_sel], nrows), _row_span(in_rows[ins_sel], in_rel[ins_sel], nrows), _row_span(del_rows, del_rel, nrows)]
+    first_pos = numpy.minimum(numpy.minimum(spans[0][:, 0], spans[1][:, 0]), spans[2][:, 0])
+    last_pos = numpy.maximum(numpy.maximum(spans[0][:, 1], spans[1][:, 1]), spans[2][:, 1])
+    rows = numpy.flatnonzero(last_pos >= 0)
+    ptr = numpy.concatenate(([0], numpy.cumsum(last_pos[rows] - first_pos[rows] + 1)))
+    offset = numpy.zeros(nrows, dtype=numpy.int64) # position p of row i is band_codes[offset[i] + p]
+    offset[rows] = ptr[:-1] - first_pos[rows]
+    band_codes = numpy.zeros(ptr[-1], dtype=numpy.uint8)
+    band_codes[offset[bp_rows[bp_sel]] + bp_rel[bp_sel]] = bp_bits[bp_sel]
+    band_codes[offset[in_rows[ins_sel]] + in_rel[ins_sel]] = ins_bits[ins_sel]
+    band_codes[offset[del_rows] + del_rel] = 1 << 4
+    return rows, banded_array.BandedReadArray(first_pos[rows], ptr, band_codes, npos)
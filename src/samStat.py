@@ -9,9 +9,14 @@ Created on Fri May 23 13:14:18 2014
 @author: cjg
 """
 import sys
+import os
 import argparse
+import multiprocessing
 import pysam
+import numpy
 import mapStat
+import samrecord
+import bamreader
 
 def samStat_pysam(samFile, outputFile):
     ''' From resulted sam or bam file of mapping, find information of reference sequences and reads.
@@ -118,10 +123,195 @@ def samStat_pysam(samFile, outputFile):
 
     myout2.close()
 
+## =================================================================
+## Coverage depth from the aligned blocks of the reads:
+## only block start/end events are recorded, in a difference array,
+## and the depth at each base is the cumulative sum at the end.
+## =================================================================
+COV_FLUSH_SIZE = 1000000 # number of buffered block events per reference before they are added to the difference array
+
+def new_coverage(refLen):
+    ''' Initialize coverage information for a reference sequence of length refLen
+        Output: dictionary with the int32 difference array and buffers for block starts and ends (0-based, end exclusive)
+    '''
+    return {'diff':numpy.zeros(refLen + 1, dtype=numpy.int32), 'starts':[], 'ends':[]}
+
+def flush_coverage(cov):
+    ''' Add the buffered block starts and ends to the difference array, and empty the buffers '''
+    if len(cov['starts']) > 0:
+        size = len(cov['diff'])
+        starts = numpy.minimum(numpy.array(cov['starts'], dtype=numpy.int64), size - 1) # blocks running past the end of the reference are cut
+        ends = numpy.minimum(numpy.array(cov['ends'], dtype=numpy.int64), size - 1)
+        cov['diff'] += (numpy.bincount(starts, minlength=size) - numpy.bincount(ends, minlength=size)).astype(numpy.int32)
+        cov['starts'] = []
+        cov['ends'] = []
+
+def get_coverage(cov):
+    ''' Coverage depth at each base of the reference, as an int32 array '''
+    flush_coverage(cov)
+    return numpy.cumsum(cov['diff'][:-1], dtype=numpy.int32)
+
+## =================================================================
+## Statistics of the reference sequences from a stream of alignment records.
+## References get integer IDs from their order in the header, and each counter
+## is a numpy column indexed by reference ID. The values of the records are
+## buffered and added to the columns with bincount.
+## A big sam file is split into chunks of lines scanned by worker processes,
+## and the statistics of the chunks are added up at the end.
+## =================================================================
+REF_COUNTS = ('nReads', 'nReadsBp', 'nMatchBp', 'nInsBp', 'nDelBp', 'nSubBp', 'nEdit') # columns of the statistics table
+ROW_FLUSH_SIZE = 100000 # number of buffered records before they are added to the columns
+
+class RefStatTable(object):
+    ''' Statistics of the reference sequences of a sam header
+        Input:  refNames, refLens - reference sequence dictionary of the header
+        Attributes:
+                ref_ids - dictionary reference name => ID (index in the header)
+                columns - dictionary counter name (REF_COUNTS) => int64 array of its value for each reference ID
+                coverage - dictionary reference ID => coverage (see new_coverage), only for the references with alignments
+    '''
+    def __init__(self, refNames, refLens):
+        self.refNames = refNames
+        self.refLens = refLens
+        self.ref_ids = dict(zip(refNames, xrange(len(refNames))))
+        self.columns = dict((key, numpy.zeros(len(refNames), dtype=numpy.int64)) for key in REF_COUNTS)
+        self.coverage = dict()
+        self._rows = [] # buffered (refID, nReadsBp, nMatchBp, nInsBp, nDelBp, nSubBp, nEdit) of the records
+
+    def ref_coverage(self, refID):
+        ''' Coverage of a reference, initialized the first time '''
+        cov = self.coverage.get(refID)
+        if cov is None:
+            cov = self.coverage[refID] = new_coverage(self.refLens[refID])
+        return cov
+
+    def add(self, refID, nReadsBp, nMatchBp, nInsBp, nDelBp, nSubBp, nEdit):
+        ''' Count one alignment record '''
+        self._rows.append((refID, nReadsBp, nMatchBp, nInsBp, nDelBp, nSubBp, nEdit))
+        if len(self._rows) >= ROW_FLUSH_SIZE:
+            self.flush()
+
+    def flush(self):
+        ''' Add the buffered records to the columns '''
+        if len(self._rows) > 0:
+            rows = numpy.array(self._rows, dtype=numpy.int64)
+            nrefs = len(self.refNames)
+            self.columns['nReads'] += numpy.bincount(rows[:, 0], minlength=nrefs)
+            for i, key in enumerate(REF_COUNTS[1:]):
+                self.columns[key] += numpy.bincount(rows[:, 0], weights=rows[:, i + 1], minlength=nrefs).round().astype(numpy.int64)
+            self._rows = []
+
+    def merge(self, other):
+        ''' Add the statistics of another table of the same header (e.g. from another part of the file) '''
+        self.flush()
+        other.flush()
+        for cov in other.coverage.itervalues():
+            flush_coverage(cov)
+        for key in REF_COUNTS:
+            self.columns[key] += other.columns[key]
+        for refID, cov in other.coverage.iteritems():
+            if refID in self.coverage:
+                self.coverage[refID]['diff'] += cov['diff']
+            else:
+                self.coverage[refID] = cov
+
+    def write(self, refFile):
+        ''' Write the statistics of the references with alignments, in header order '''
+        self.flush()
+        columns = [self.columns[key] for key in REF_COUNTS]
+        with open(refFile, 'w') as myout1:
+            myout1.write("{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\n".format('refName', 'refLen','nReads', 'nReadsBp', 'nMatchBp','nInsBp','nDelBp','nSubBp','nEdit','nCovBp','maxCov','avgCov','coverage'))
+            for refID in sorted(self.coverage):
+                refLen = self.refLens[refID]
+                nReads, nReadsBp, nMatchBp, nInsBp, nDelBp, nSubBp, nEdit = [int(column[refID]) for column in columns]
+                coverage = get_coverage(self.coverage[refID]) # coverage depth at each base
+                nCovBp = int(numpy.count_nonzero(coverage))
+                maxCov = int(coverage.max()) if refLen > 0 else 0
+                myout1.write("{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\n".format(self.refNames[refID], refLen,nReads, nReadsBp, nMatchBp,nInsBp,nDelBp,nSubBp,nEdit,nCovBp,maxCov,float(nReadsBp)/float(refLen),float(nCovBp)/float(refLen)))
+
+def scan_records(records, refNames, refLens, report=10000):
+    ''' Statistics of the reference sequences from alignment records
+        Input:  records - iterable of SamRecord (or BamRecord)
+                refNames, refLens - reference sequence dictionary of the header
+                report - print progress every report records, 0 for no progress
+        Output: table - RefStatTable
+                count - number of records scanned
+    '''
+    count = 0 # number of aligned records scanned
+    table = RefStatTable(refNames, refLens)
+    ref_ids = table.ref_ids
+    for read in records: # alignment records, only the columns used below are split
+        count += 1
+        cigarstring = read.cigar # CIGAR string for this aligned read
+        if cigarstring == '*':
+            continue
+        refID = ref_ids.get(read.rname) # ref seq to which this read is mapped
+        if refID is None:
+            raise ValueError("read {} is aligned to reference {}, which is not in the header".format(read.qname, read.rname))
+
+        ## check CIGAR string
+        cigarLens = mapStat.cigar(cigarstring)
+
+        # edit distance
+        NM = read.tag('NM')
+        sub_len = cigarLens['sub_len'] # cigarLens is shared through the CIGAR cache, do not modify it
+        if NM is not None and sub_len is None:
+            sub_len = NM - cigarLens['ins_len'] - cigarLens['del_len']
+
+        # update the counters of the reference sequence, matching and substitution bps if possible
+        table.add(refID, cigarLens['seq_len'], cigarLens['match_len'] or 0, cigarLens['ins_len'], cigarLens['del_len'], sub_len or 0, NM or 0)
+
+        # update the coverage at the mapped positions: record where the aligned blocks start and end
+        coverage = table.ref_coverage(refID)
+        for block_start, block_end in read.ref_blocks():
+            coverage['starts'].append(block_start)
+            coverage['ends'].append(block_end)
+        if len(coverage['starts']) >= COV_FLUSH_SIZE:
+            flush_coverage(coverage)
+
+        if report > 0 and count % report == 0:
+            sys.stdout.write('  scanned {} records\n'.format(count))
+    table.flush()
+    for coverage in table.coverage.itervalues():
+        flush_coverage(coverage)
+    return table, count
+
+def sam_chunks(samFile, nChunks):
+    ''' Split the alignment lines of a sam file into about nChunks parts of the same size
+        Output: list of (start, end) byte offsets, each part starts at the beginning of a line
+    '''
+    size = os.path.getsize(samFile)
+    with open(samFile, 'r') as f:
+        header_end = 0
+        line = f.readline()
+        while line and line[0] == '@': # header lines
+            header_end += len(line)
+            line = f.readline()
+        bounds = [header_end]
+        for i in xrange(1, nChunks):
+            pos = header_end + (size - header_end) * i // nChunks
+            if pos <= bounds[-1]:
+                continue
+            f.seek(pos - 1)
+            f.readline() # the part starts after the end of the line containing pos - 1
+            pos = f.tell()
+            if bounds[-1] < pos < size:
+                bounds.append(pos)
+        bounds.append(size)
+    return zip(bounds[:-1], bounds[1:])
+
+def scan_chunk(chunk):
+    ''' scan_records on one part of a sam file, in a worker process
+        Input:  chunk - (samFile, start, end) from sam_chunks
+    '''
+    samFile, start, end = chunk
+    with samrecord.SamReader(samFile) as mysam:
+        return scan_records(mysam.records_between(start, end), mysam.ref_names, mysam.ref_lens, report=0)
+
 ## =================================================================
 ## samStat function without using pysam, which is unstable sometimes
 ## =================================================================
-def samStat(samFile, outputFile, removeSlash=False):
+def samStat(samFile, outputFile, removeSlash=False, processes=1):
     ''' From resulted sam or bam file of mapping, find information of reference sequences and reads.
         For reference sequences: 
         1. base coverage percentage
@@ -137,88 +327,26 @@ def samStat(samFile, outputFile, removeSlash=False):
         1. samFile: sam (bam) file name
         2. outputFile: file for writing output
         3. removeSlash: whether or not to remove characters from the last slash sign in the read name (BLASR sometimes automatically append these)
-        4. 
+        4. processes: number of processes scanning parts of a sam file in parallel (a BAM file is scanned by one process, with as many threads decompressing it)
     '''
-    nReferences = 0 # number of reference sequences
-    refLens = [] # list of reference length
-    refNames = []# list of reference names
-    count = 0 # number of aligned records in the sam file
-
-    # dictionaries for the reference sequences and the read sequences
-    refSeq_dict = dict()
-    #readSeq_dict = dict()
-
     sys.stdout.write(">> Scan sam file \n")
     # start scanning sam file
-    with open(samFile,'r') as mysam:
-        for line in mysam:
-            if line[0] == '@': # header line
-                if line[1:3] == 'SQ': # reference sequence dictionary
-                    nReferences += 1
-                    rname = line[(line.find('SN:') + len('SN:')) : line.find('\t',line.find('SN:'))] # referenece sequence name
-                    rLen = line[(line.find('LN:') + len('LN:')) : line.find('\t',line.find('LN:'))] # reference sequence length
-                    refLens.append(int(rLen))
-                    refNames.append(rname)
-            else: # non-header line
-                line = line.strip()            
-                count += 1
-                read = mapStat.readAlign(line) # parse the alignment record
-
-                if read['cigarstring']=='*':
-                    continue
-                rname = read['rname'] # ref seq to which this read is mapped
-                qname = read['qname'] # name of the query sequence (read)
-                #print qname, "\t", rname, "\t"
-                #print read['cigarstring']
-                
-                
-                # if this reference sequence is not in the dictionary, initiate it
-                if not refSeq_dict.has_key(rname):
-                    refLen = refLens[refNames.index(rname)] # length of the reference sequence
-                    refSeq_dict[rname] = {'refLen':refLen, 'nReads':0, 'nReadsBp':0, 'nMatchBp':0,'nInsBp':0, 'nDelBp':0, 'nSubBp':0, 'nEdit':0,'coverage':[0]*refLen}
-
-                #if not readSeq_dict.has_key(qname):
-                #    readSeq_dict[qname] = {'nMapping':0, 'mapInfo':list()}
-
-                #print qname, '\t', rname, '\t', refLen
-
-                ## check CIGAR string                
-                cigarstring = read['cigarstring'] # CIGAR string for this aligned read
-                cigarLens = mapStat.cigar(cigarstring)
-
-                ## update the dictionary corresponding to the reference sequence
-                refSeq_dict[rname]['nReads'] += 1 # update number of mapped reads
-                #readSeq_dict[qname]['nMapping'] += 1 # update number of mappings
-
-                refSeq_dict[rname]['nReadsBp'] += cigarLens['seq_len'] # update number of bps mapped to this ref seq
-                refSeq_dict[rname]['nInsBp'] += cigarLens['ins_len'] # update number of insertion bps
-                refSeq_dict[rname]['nDelBp'] += cigarLens['del_len'] # update number of deletion bps
-
-                # update edit distance
-                if read['NM'] is not None:
-                    refSeq_dict[rname]['nEdit'] += read['NM']
-                    if cigarLens['sub_len'] is None:
-                        cigarLens['sub_len'] = read['NM'] - cigarLens['ins_len'] - cigarLens['del_len']
-
-                # update matching and substitution bps if possible
-                if cigarLens['match_len'] is not None:
-                    refSeq_dict[rname]['nMatchBp'] += cigarLens['match_len']
-                if cigarLens['sub_len'] is not None:
-                    refSeq_dict[rname]['nSubBp'] += cigarLens['sub_len']
-
-                # update the coverage at the mapped positions
-                for apos in read['positions']:
-                    refSeq_dict[rname]['coverage'][apos-1] += 1
-
-                # store the mapping information for this read:
-                # start and end positions for both the query read and the ref seq
-                # is this a secondary alignment?
-                # is this a reverse complement?
-                #readSeq_dict[qname]['mapInfo'].append((read['qstart'],read['qend'], read['rstart'], read['rend'], read['is_secondary_alignment'], read['is_reversecomplement'],read['NM'],rname))
-
-                if count % 10000 == 0:
-                    sys.stdout.write('  scanned {} records\n'.format(count))
-                
+    if processes > 1 and not bamreader.is_bgzf(samFile):
+        chunks = [(samFile, start, end) for start, end in sam_chunks(samFile, 4 * processes)] # more parts than processes to balance the work
+        with samrecord.SamReader(samFile) as mysam:
+            table = RefStatTable(mysam.ref_names, mysam.ref_lens)
+        count = 0
+        pool = multiprocessing.Pool(processes)
+        for part_table, part_count in pool.imap_unordered(scan_chunk, chunks): # reduce the partial statistics as they come
+            table.merge(part_table)
+            count += part_count
+            sys.stdout.write('  scanned {} records\n'.format(count))
+        pool.close()
+        pool.join()
+    else:
+        with samrecord.open_sam(samFile, processes) as mysam:
+            table, count = scan_records(mysam, mysam.ref_names, mysam.ref_lens)
+
     ## get number of covered base pairs in the refrence sequences
 #    sys.stdout.write(">> Get number of covered basepairs \n")
 #    for key in refSeq_dict:
@@ -227,15 +355,7 @@ def samStat(samFile, outputFile, removeSlash=False):
     sys.stdout.write(">> Write statistics in output file \n")
 
     # print out statistics information for the reference sequences
-    myout1 = open(outputFile+".ref", 'w')
-    myout1.write("{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\n".format('refName', 'refLen','nReads', 'nReadsBp', 'nMatchBp','nInsBp','nDelBp','nSubBp','nEdit','nCovBp','maxCov','avgCov','coverage'))
-
-    for key in refSeq_dict:
-        d = refSeq_dict[key]
-        nCovBp = d['refLen'] - d['coverage'].count(0)
-        myout1.write("{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\n".format(key, d['refLen'],d['nReads'], d['nReadsBp'], d['nMatchBp'],d['nInsBp'],d['nDelBp'],d['nSubBp'],d['nEdit'],nCovBp,max(d['coverage']),float(d['nReadsBp'])/float(d['refLen']),float(nCovBp)/float(d['refLen'])))
-
-    myout1.close()
+    table.write(outputFile+".ref")
 
     # print out statistics information for the reads
     #myout2 = open(outputFile+".read", 'w')
@@ -262,7 +382,8 @@ parser = argparse.ArgumentParser(description="parse sam file and get summary sta
                                  )
 
 ## input files and directories
-parser.add_argument("-i","--in",help="input sam file",dest='samFile',required=True)
+parser.add_argument("-i","--in",help="input sam or BAM file",dest='samFile',required=True)
+parser.add_argument("-p","--processes",help="number of processes scanning parts of a sam file (threads decompressing a BAM file)",dest='processes',default=1,type=int)
 
 ## output directory
 parser.add_argument("-o","--out",help="output statistics file",dest='outputFile',required=True)
@@ -275,7 +396,7 @@ def main(argv=None):
     if argv is None:
         args = parser.parse_args()
 
-    samStat(args.samFile,args.outputFile)
+    samStat(args.samFile,args.outputFile,processes=args.processes)
 
 ##==============================================================
 ## call from command line (instead of interactively)
@@ -0,0 +1,236 @@
+#!/usr/bin/python
+
+''' Index of the alignments of each reference sequence in a sorted sam or BAM file, so that the alignments to one PacBio read can be
+    read from one big alignment file, instead of splitting it into one small sam file per read.
+    The file has to be sorted by reference (samtools sort), or at least have the alignments of each reference next to each other.
+    The index keeps, for each reference, where its alignments start and end in the file: byte offsets for a sam file,
+    virtual offsets for a BAM file. It is written next to the alignment file (<alignment file>.ridx) the first time it is needed,
+    one tab separated line per reference: name, start, end, number of records.
+    For a BAM file indexed by samtools index, the .bai file is used if there is no .ridx file.
+'''
+import argparse
+import os
+import struct
+import sys
+import samrecord
+import bamreader
+
+INDEX_SUFFIX = '.ridx'
+INDEX_HEADER = '#samindex 1\n'
+BAI_MAGIC = 'BAI\x01'
+BAI_PSEUDO_BIN = 37450 # bin with the start and end virtual offsets and the record counts of a reference
+
+## ======================================================================
+def _sam_offsets(samFile):
+    ''' Generator of (rname, start, end) byte offsets of the alignment lines of a sam file '''
+    offset = 0
+    with open(samFile, 'r') as f:
+        for line in f:
+            start = offset
+            offset += len(line)
+            if line[0] != '@' and line[0] != '\n':
+                yield line.split('\t', 3)[2], start, offset
+## ======================================================================
+def _bam_offsets(bamFile):
+    ''' Generator of (rname, start, end) virtual offsets of the alignment records of a BAM file '''
+    with samrecord.BamReader(bamFile) as reader:
+        bgzf = reader.bgzf
+        start = bgzf.tell()
+        for data in bamreader.raw_records(bgzf):
+            refID = struct.unpack_from('<i', data)[0]
+            end = bgzf.tell()
+            yield (reader.ref_names[refID] if refID >= 0 else '*'), start, end
+            start = end
+## ======================================================================
+def build_index(samFile):
+    ''' Index an alignment file by reading it once
+        Input:  samFile - sam or BAM file, with the alignments of each reference next to each other
+        Output: index - dictionary reference name => (start, end, number of records)
+    '''
+    offsets = _bam_offsets(samFile) if bamreader.is_bgzf(samFile) else _sam_offsets(samFile)
+    index = dict()
+    rname = None
+    for name, start, end in offsets:
+        if name != rname:
+            if name in index:
+                raise ValueError("alignments of {} are not together in {}, sort the file first (samtools sort)".format(name, samFile))
+            index[name] = [start, end, 0]
+            rname = name
+        index[name][1] = end
+        index[name][2] += 1
+    return dict((name, tuple(entry)) for name, entry in index.iteritems())
+## ======================================================================
+def write_index(index, indexFile):
+    ''' Write an index, to a temporary file renamed when complete, since several processes might index the same file '''
+    tmpFile = '{}.{}.tmp'.format(indexFile, os.getpid())
+    with open(tmpFile, 'w') as f:
+        f.write(INDEX_HEADER)
+        for name in sorted(index, key=lambda name: index[name][0]): # in file order
+            f.write('{}\t{}\t{}\t{}\n'.format(name, *index[name]))
+    os.rename(tmpFile, indexFile)
+## ======================================================================
+def read_index(indexFile):
+    ''' Read an index written by write_index '''
+    index = dict()
+    with open(indexFile, 'r') as f:
+        if f.readline() != INDEX_HEADER:
+            raise IOError("{} is not a samindex index".format(indexFile))
+        for line in f:
+            name, start, end, count = line.rstrip('\n').split('\t')
+            index[name] = (int(start), int(end), int(count))
+    return index
+## ======================================================================
+def read_bai(baiFile, ref_names):
+    ''' Reference ranges from a BAM index made by samtools index
+        Input:  baiFile - .bai file
+                ref_names - reference names of the BAM header
+        Output: index - same as build_index, the number of records is -1 when the index does not have it
+    '''
+    with open(baiFile, 'rb') as f:
+        data = f.read()
+    if data[:4] != BAI_MAGIC:
+        raise IOError("{} is not a BAM index".format(baiFile))
+    n_ref = struct.unpack_from('<i', data, 4)[0]
+    offset = 8
+    index = dict()
+    for refID in xrange(n_ref):
+        n_bin = struct.unpack_from('<i', data, offset)[0]
+        offset += 4
+        pseudo = None
+        starts = []
+        ends = []
+        for i in xrange(n_bin):
+            bin_id, n_chunk = struct.unpack_from('<Ii', data, offset)
+            chunks = struct.unpack_from('<{}Q'.format(2 * n_chunk), data, offset + 8)
+            offset += 8 + 16 * n_chunk
+            if bin_id == BAI_PSEUDO_BIN: # (ref_beg, ref_end), (n_mapped, n_unmapped)
+                pseudo = (chunks[0], chunks[1], chunks[2] + chunks[3])
+            elif n_chunk > 0:
+                starts.append(min(chunks[0::2]))
+                ends.append(max(chunks[1::2]))
+        n_intv = struct.unpack_from('<i', data, offset)[0]
+        offset += 4 + 8 * n_intv # linear index, not needed for whole references
+        if pseudo is not None:
+            index[ref_names[refID]] = pseudo
+        elif len(starts) > 0:
+            index[ref_names[refID]] = (min(starts), max(ends), -1)
+    return index
+## ======================================================================
+def _is_newer(fileName, samFile):
+    return os.path.exists(fileName) and os.path.getmtime(fileName) >= os.path.getmtime(samFile)
+## ======================================================================
+def load_index(samFile, ref_names=None):
+    ''' Index of an alignment file: its .ridx file if up to date, its .bai file for a BAM file, otherwise it is built (and saved if possible)
+        Input:  samFile - sam or BAM file name
+                ref_names - reference names of the header, needed to use a .bai file
+        Output: index - dictionary reference name => (start, end, number of records)
+    '''
+    indexFile = samFile + INDEX_SUFFIX
+    if _is_newer(indexFile, samFile):
+        return read_index(indexFile)
+    if ref_names is not None and bamreader.is_bgzf(samFile):
+        for baiFile in (samFile + '.bai', os.path.splitext(samFile)[0] + '.bai'):
+            if _is_newer(baiFile, samFile):
+                return read_bai(baiFile, ref_names)
+    sys.stderr.write("indexing {}\n".format(samFile))
+    index = build_index(samFile)
+    try:
+        write_index(index, indexFile)
+    except (IOError, OSError): # e.g. read-only directory, the index is only used in this run
+        sys.stderr.write("could not write index file {}\n".format(indexFile))
+    return index
+## ======================================================================
+class ReferenceReader(object):
+    ''' Read the alignments of one reference from an indexed alignment file, same interface as samrecord.SamReader.
+        The header only keeps the @SQ line of this reference, so it reads like a sam file with only this reference.
+        Input:  samFile - sam or BAM file name
+                rname - reference name
+                threads - number of threads decompressing a BAM file
+    '''
+    def __init__(self, samFile, rname, threads=1):
+        self.reader = samrecord.open_sam(samFile, threads)
+        if rname not in self.reader.ref_ids:
+            self.reader.close()
+            raise ValueError("reference {} is not in the header of {}".format(rname, samFile))
+        self.rname = rname
+        self.header_lines = [line for line in self.reader.header_lines if line[1:3] != 'SQ' or samrecord.parse_sq_line(line)[0] == rname]
+        self.ref_names = [rname]
+        self.ref_lens = [self.reader.ref_lens[self.reader.ref_ids[rname]]]
+        self.ref_ids = {rname: 0}
+        self.range = load_index(samFile, self.reader.ref_names).get(rname) # None if there is no alignment to this reference
+
+    def __iter__(self):
+        if self.range is None:
+            return
+        for record in self.reader.records_between(self.range[0], self.range[1]):
+            if record.rname == self.rname: # a .bai range can start or end in the middle of a block of another reference
+                yield record
+
+    def close(self):
+        self.reader.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+## ======================================================================
+def fetch(samFile, rname):
+    ''' Generator of the alignment records (SamRecord or BamRecord) of one reference in an indexed alignment file '''
+    with ReferenceReader(samFile, rname) as reader:
+        for record in reader:
+            yield record
+
+## =================================================================
+## argument parser
+## =================================================================
+parser = argparse.ArgumentParser(description="Index a sorted sam or BAM file by reference, and extract the alignments of some references",
+                                 prog = 'samindex', #program name
+                                 prefix_chars='-', # prefix for options
+                                 fromfile_prefix_chars='@', # if options are read from file, '@args.txt'
+                                 conflict_handler='resolve', # for handling conflict options
+                                 add_help=True, # include help in the options
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter # print default values for options in help message
+                                 )
+
+## input files and directories
+parser.add_argument("-i","--in",help="input sam or BAM file, sorted by reference",dest='samFile',required=True)
+parser.add_argument("-r","--ref",help="reference sequence names to extract, one sam file each",dest='rnames',nargs='*',default=[])
+
+## output directory
+parser.add_argument("-o","--out",help="output directory for the extracted sam files",dest='outputDir',default='.')
+
+## =================================================================
+## main function
+## =================================================================
+def main(argv=None):
+    if argv is None:
+        args = parser.parse_args()
+    else:
+        args = parser.parse_args(argv)
+
+    if not os.path.exists(args.samFile):
+        sys.stderr.write("file {} does not exist\n".format(args.samFile))
+        return -1
+    if len(args.rnames) == 0: # only (re)build the index
+        index = build_index(args.samFile)
+        write_index(index, args.samFile + INDEX_SUFFIX)
+        sys.stdout.write("{} references indexed in {}\n".format(len(index), args.samFile + INDEX_SUFFIX))
+        return 0
+    if not os.path.exists(args.outputDir):
+        os.makedirs(args.outputDir)
+    for rname in args.rnames:
+        with ReferenceReader(args.samFile, rname) as reader:
+            with open(os.path.join(args.outputDir, rname.replace('/', '__') + '.sam'), 'w') as out:
+                out.writelines(reader.header_lines)
+                for record in reader:
+                    out.write(record.line)
+    return 0
+
+##==============================================================
+## call from command line (instead of interactively)
+##==============================================================
+
+if __name__ == '__main__':
+    sys.exit(main())
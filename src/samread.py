@@ -1,6 +1,7 @@
 #!/usr/bin/python
 
 import metalrec_lib
+import aligner # banded global alignment
 import time
 import re
 import sys
@@ -219,7 +220,9 @@ class SamRead:
 
     # re-align read to PacBio sequence and shift indels to the leftmost possible positions
     def re_align(self, rseq, maxSub=-1, maxIns=-1, maxDel=-1,maxSubRate=0.05, maxInDelRate=0.3, max_round = 10,checkEnds=True):
-        ''' realign the read to PacBio sequence, including retrieving clipped parts and scrubbing '''
+        ''' realign the read to PacBio sequence, including retrieving clipped parts and scrubbing
+            max_round is ignored: the banded aligner puts the indels at their leftmost positions in one round, the parameter is kept for the callers
+        '''
         #print self.qname
         done = False # indicator of whether realigning is done
         rLen = len(rseq)
@@ -234,33 +237,16 @@ class SamRead:
             #print "sequence B: ", self.qSeq
             #print "\n"
             ## global pairwise alignment, 1 penalty for mismatch and 0.9 penalty for indels, opening and ending gaps in Illumina reads don't get penalized
+            ## the banded aligner returns the alignment whose indels are at the leftmost positions, no need to pick among equivalent alignments and shift indels
             s_time = time.time()
-            realign_res = pairwise2.align.globalms(rseq[(ref_region_start-1):ref_region_end], seg, 0, -1, -0.9, -0.9, penalize_end_gaps=[True, False])
+            band = int(maxInDelRate * len(seg)) + 1 if maxInDelRate > 0 else None # reads with more indels than that are discarded anyway
+            realign_res = aligner.global_align(rseq[(ref_region_start-1):ref_region_end], seg, penalize_end_gaps=(True, False), band=band)
             e_time = time.time()
             sys.stdout.write("align time :" + str(e_time - s_time) +  " seconds\n")
             
-            #print len(realign_res), " equivalent good mappings, after extending the Illumina read"
-            #print format_alignment(*realign_res[0])
-            new_align, align_start, align_end = metalrec_lib.pick_align(realign_res) # pick the best mapping: indel positions are the leftmost collectively
-            #align_start = new_align[3] # starting position of the alignment for the new extended alignment
-            #print format_alignment(*new_align) # for DEBUG
-            new_align1 = metalrec_lib.shift_to_left_chop(new_align)
-            rounds = 0
-            s_time = time.time()
-            while new_align1[:2] != new_align[:2] and rounds < max_round:
-                #print "realign round ", rounds
-                #print format_alignment(*new_align1) # for DEBUG
-                new_align = list(new_align1)
-                #print "before realign: ", new_align
-                new_align1 = metalrec_lib.shift_to_left_chop(new_align)
-                #print "after  realign: ", new_align1
-                #print format_alignment(*new_align1)
-                rounds += 1
-                
-            e_time = time.time()
-            sys.stdout.write("shuffle time :" + str(e_time - s_time) +  " seconds\n")
-            #print "done"
-            #print format_alignment(*new_align) # for DEBUG
+            #print format_alignment(*realign_res)
+            new_align1, align_start, align_end = metalrec_lib.pick_align([realign_res]) # trim the opening and ending gaps in the Illumina read
+            #print format_alignment(*new_align1) # for DEBUG
 
             # update information in the sam record
             self.rstart = ref_region_start + align_start # starting position
@@ -321,8 +307,8 @@ class SamRead:
         if cigar_info['sub_len'] > 1: # only do this if there is more than 1 substitution errors
             if maxSubRate is None:
                 maxSubRate = cigar_info['sub_len'] / float(cigar_info['seq_len']) # average substitution rate in this read
-            all_Nums = array(map(int,re.findall('\d+',self.cigarstring)))
-            all_Chars = array(re.findall('\D+',self.cigarstring))
+            all_Nums = array([n for n, op in cigar_info.ops])
+            all_Chars = array([op for n, op in cigar_info.ops])
             non_clip_chars = where(all_Chars!='S')[0]
             Nums = all_Nums[non_clip_chars]
             Chars = all_Chars[non_clip_chars]
@@ -0,0 +1,358 @@
+#!/usr/bin/python
+
+''' Streaming access to sam files shared by samStat, SplitSam, fastaGenFromSam and metalrec.
+    SamRecord keeps the raw alignment line and only splits it up to the column that is asked for,
+    so tools that look at a couple of columns do not pay for splitting (and storing) all of them.
+    SamReader reads the header lines first and then yields one SamRecord per alignment line.
+    BamReader and BamRecord do the same for BAM files (decoded by bamreader), open_sam picks the reader from the file content.
+'''
+import sys
+import cigar_parser
+import bamreader
+
+## ======================================================================
+class SamRecord(object):
+    ''' One alignment line of a sam file, columns are split lazily.
+        Columns (0-based): 0 QNAME, 1 FLAG, 2 RNAME, 3 POS, 4 MAPQ, 5 CIGAR, 6 RNEXT, 7 PNEXT, 8 TLEN, 9 SEQ, 10 QUAL, 11+ tags
+    '''
+    __slots__ = ('line', '_fields', '_nsplit')
+    binary = False # True for the records of a BAM file, which never have the space separated columns of blasr output
+
+    def __init__(self, line):
+        self.line = line # raw alignment line, including the newline character if it was read from file
+        self._fields = None
+        self._nsplit = 0 # number of leading columns already separated in _fields
+
+    def field(self, i):
+        ''' i-th (0-based) column as a string, the line is split only as far as needed '''
+        if i >= self._nsplit:
+            self._fields = self.line.rstrip('\n').split('\t', i + 1)
+            self._nsplit = i + 1
+        return self._fields[i]
+
+    def fields(self):
+        ''' all columns as a list of strings '''
+        if self._nsplit != sys.maxsize:
+            self._fields = self.line.rstrip('\n').split('\t')
+            self._nsplit = sys.maxsize # completely split
+        return self._fields
+
+    # mandatory fields
+    @property
+    def qname(self):
+        return self.field(0) # query template name
+
+    @property
+    def flag(self):
+        return int(self.field(1)) # bitwise flag
+
+    @property
+    def rname(self):
+        return self.field(2) # reference sequence name
+
+    @property
+    def pos(self):
+        return int(self.field(3)) # 1-based leftmost mapping position on the reference sequence
+
+    @property
+    def mapq(self):
+        try:
+            return int(self.field(4)) # mapping quality
+        except ValueError: # if map value is not integer
+            return -1
+
+    @property
+    def cigar(self):
+        return self.field(5) # CIGAR string
+
+    @property
+    def seq(self):
+        return self.field(9) # segment sequence
+
+    @property
+    def qual(self):
+        return self.field(10) # base qualities
+
+    def cigar_info(self):
+        ''' Parsed (cached) CIGAR string, see cigar_parser.CigarInfo '''
+        return cigar_parser.cigar_info(self.field(5))
+
+    def ref_end(self):
+        ''' 1-based ending mapping position on the reference sequence '''
+        return self.pos + self.cigar_info().ref_len - 1
+
+    def tag(self, name, default=None):
+        ''' Value of an optional tag (e.g. 'NM'), converted to int for type i. Search the raw line without splitting it. '''
+        tag_pos = self.line.find('\t' + name + ':')
+        if tag_pos == -1:
+            return default
+        value_end = self.line.find('\t', tag_pos + 1)
+        if value_end == -1:
+            value_end = len(self.line.rstrip('\n'))
+        tag_type = self.line[tag_pos + 4]
+        value = self.line[(tag_pos + 6):value_end]
+        if tag_type == 'i':
+            return int(value)
+        return value
+
+    def ref_blocks(self):
+        ''' Regions of the reference covered by the alignment (match/mismatch/deletion), skipped regions (N) excluded
+            Output: list of (start, end) tuples, 0-based and end exclusive, adjacent blocks merged
+        '''
+        blocks = []
+        start = self.pos - 1
+        end = start
+        for count, op in self.cigar_info().ops:
+            if op in 'MX=D':
+                end += count
+            elif op == 'N':
+                if end > start:
+                    blocks.append((start, end))
+                end += count
+                start = end
+        if end > start:
+            blocks.append((start, end))
+        return blocks
+
+    # FLAG explanation, same as samread.SamRead
+    def is_paired(self):
+        return self.flag & 0x1 == 0x1 # 0x1: read is paired
+
+    def is_unmapped(self):
+        return self.flag & 0x4 == 0x4 # 0x4: read unmapped
+
+    def is_reverse(self):
+        return self.flag & 0x10 == 0x10 # 0x10: read being reverse complemented
+
+    def is_secondary(self):
+        return self.flag & 0x100 == 0x100 # 0x100: secondary alignment, false if mapping is primary
+
+    def is_supplementary(self):
+        return self.flag & 0x800 == 0x800 # 0x800: supplementary alignment (part of a chimeric alignment)
+## ======================================================================
+class BamRecord(SamRecord):
+    ''' One alignment record of a BAM file, with the same interface as SamRecord.
+        Columns are decoded from the binary record when they are asked for, the sam line (attribute line) is only made if it is used.
+    '''
+    __slots__ = ('data', 'ref_names', '_core', '_line')
+    binary = True
+
+    def __init__(self, data, ref_names):
+        self.data = data # binary record, without the block_size field
+        self.ref_names = ref_names # reference names of the BAM header, for refID
+        self._core = bamreader.CORE.unpack_from(data) # refID, pos, l_read_name, mapq, bin, n_cigar_op, flag, l_seq, next_refID, next_pos, tlen
+        self._fields = None
+        self._nsplit = 0
+        self._line = None
+
+    @property
+    def line(self):
+        ''' sam line of the record, including the newline character '''
+        if self._line is None:
+            self._line = '\t'.join(self.fields()) + '\n'
+        return self._line
+
+    def _offsets(self):
+        ''' Offsets of the CIGAR, sequence, qualities and tags in data '''
+        cigar_start = 32 + self._core[2]
+        seq_start = cigar_start + 4 * self._core[5]
+        qual_start = seq_start + (self._core[7] + 1) // 2
+        return cigar_start, seq_start, qual_start, qual_start + self._core[7]
+
+    def _ref_name(self, refID):
+        return self.ref_names[refID] if refID >= 0 else '*'
+
+    def field(self, i):
+        ''' i-th (0-based) column as a string, only this column is decoded '''
+        if self._nsplit == sys.maxsize:
+            return self._fields[i]
+        core = self._core
+        if i == 0:
+            return self.qname
+        elif i == 1:
+            return str(core[6])
+        elif i == 2:
+            return self._ref_name(core[0])
+        elif i == 3:
+            return str(core[1] + 1)
+        elif i == 4:
+            return str(core[3])
+        elif i == 5:
+            return bamreader.decode_cigar(self.data, self._offsets()[0], core[5])
+        elif i == 6:
+            if core[8] < 0:
+                return '*'
+            return '=' if core[8] == core[0] else self._ref_name(core[8])
+        elif i == 7:
+            return str(core[9] + 1)
+        elif i == 8:
+            return str(core[10])
+        elif i == 9:
+            return bamreader.decode_seq(self.data, self._offsets()[1], core[7])
+        elif i == 10:
+            return bamreader.decode_qual(self.data, self._offsets()[2], core[7])
+        return self.fields()[i]
+
+    def fields(self):
+        ''' all columns as a list of strings '''
+        if self._nsplit != sys.maxsize:
+            self._fields = [self.field(i) for i in xrange(11)] + ['{}:{}:{}'.format(*tag) for tag in bamreader.decode_tags(self.data, self._offsets()[3])]
+            self._nsplit = sys.maxsize # completely decoded
+        return self._fields
+
+    @property
+    def qname(self):
+        return self.data[32:(31 + self._core[2])] # read name is NUL terminated
+
+    @property
+    def flag(self):
+        return self._core[6]
+
+    @property
+    def pos(self):
+        return self._core[1] + 1
+
+    @property
+    def mapq(self):
+        return self._core[3]
+
+    def tag(self, name, default=None):
+        ''' Value of an optional tag, converted to int for integer types '''
+        for tag, tag_type, value in bamreader.decode_tags(self.data, self._offsets()[3]):
+            if tag == name:
+                return int(value) if tag_type == 'i' else value
+        return default
+## ======================================================================
+def parse_sq_line(line):
+    ''' Reference name and length from a @SQ header line
+        Input:  line - header line starting with @SQ
+        Output: (rname, rLen)
+    '''
+    rname = None
+    rLen = None
+    for item in line.rstrip('\n').split('\t')[1:]:
+        if item[:3] == 'SN:':
+            rname = item[3:]
+        elif item[:3] == 'LN:':
+            rLen = int(item[3:])
+    return rname, rLen
+## ======================================================================
+class SamReader(object):
+    ''' Read a sam file: header lines are read when the reader is created, alignment records are streamed.
+        Input:  samFile - sam file name, or an open file object (e.g. sys.stdin)
+        Attributes:
+                header_lines - list of header lines (newline kept)
+                ref_names, ref_lens - names and lengths of the reference sequences from the @SQ lines, in header order
+                ref_ids - dictionary reference name => index in ref_names
+    '''
+    def __init__(self, samFile):
+        if hasattr(samFile, 'read'):
+            self.handle = samFile
+            self.own_handle = False
+        else:
+            self.handle = open(samFile, 'r')
+            self.own_handle = True
+        self.header_lines = []
+        self.ref_names = []
+        self.ref_lens = []
+        self.ref_ids = dict()
+        self._pending = None # first alignment line, read while looking for the end of the header
+        for line in self.handle:
+            if line[0] != '@':
+                self._pending = line
+                break
+            self.header_lines.append(line)
+            if line[1:3] == 'SQ': # reference sequence dictionary
+                rname, rLen = parse_sq_line(line)
+                self.ref_ids[rname] = len(self.ref_names)
+                self.ref_names.append(rname)
+                self.ref_lens.append(rLen)
+
+    def __iter__(self):
+        if self._pending is not None:
+            line = self._pending
+            self._pending = None
+            if line[0] != '\n':
+                yield SamRecord(line)
+        for line in self.handle:
+            if line[0] == '@' or line[0] == '\n': # header line in the middle of the file (e.g. concatenated sam files) or empty line
+                continue
+            yield SamRecord(line)
+
+    def records_between(self, start, end):
+        ''' Generator of the records between two byte offsets of the file (e.g. from a samindex index), the file has to be seekable '''
+        self._pending = None
+        self.handle.seek(start)
+        remaining = end - start
+        if remaining <= 0:
+            return
+        for line in self.handle:
+            remaining -= len(line)
+            if line[0] != '@' and line[0] != '\n':
+                yield SamRecord(line)
+            if remaining <= 0:
+                break
+
+    def close(self):
+        if self.own_handle:
+            self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+## ======================================================================
+class BamReader(object):
+    ''' Read a BAM file, same interface as SamReader: the header is read when the reader is created, BamRecords are streamed.
+        Input:  bamFile - BAM file name
+                threads - number of threads decompressing the BGZF blocks
+        Attributes:
+                header_lines, ref_names, ref_lens, ref_ids - same as SamReader, the reference dictionary comes from the binary header
+    '''
+    def __init__(self, bamFile, threads=1):
+        self.bgzf = bamreader.BgzfReader(bamFile, threads)
+        text, self.ref_names, self.ref_lens = bamreader.read_header(self.bgzf)
+        self.header_lines = text.splitlines(True)
+        self.ref_ids = dict(zip(self.ref_names, xrange(len(self.ref_names))))
+
+    def __iter__(self):
+        ref_names = self.ref_names
+        for data in bamreader.raw_records(self.bgzf):
+            yield BamRecord(data, ref_names)
+
+    def records_between(self, start, end):
+        ''' Generator of the records between two virtual offsets of the file (e.g. from a samindex index or a BAI index) '''
+        ref_names = self.ref_names
+        self.bgzf.seek(start)
+        for data in bamreader.raw_records(self.bgzf, end):
+            yield BamRecord(data, ref_names)
+
+    def close(self):
+        self.bgzf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+## ======================================================================
+def open_sam(samFile, threads=1):
+    ''' SamReader or BamReader for an alignment file, BAM files are recognized by their content
+        Input:  samFile - sam or BAM file name, or an open file object of a sam file (e.g. sys.stdin)
+                threads - number of threads decompressing a BAM file
+    '''
+    if not hasattr(samFile, 'read') and bamreader.is_bgzf(samFile):
+        return BamReader(samFile, threads)
+    return SamReader(samFile)
+## ======================================================================
+def read_sam(samFile):
+    ''' Generator of SamRecord for all alignment lines of a sam file, header lines are skipped
+        Input:  samFile - sam or BAM file name, or open file object of a sam file
+        Output: SamRecord (BamRecord) objects
+    '''
+    with open_sam(samFile) as reader:
+        for record in reader:
+            yield record
@@ -0,0 +1,186 @@
+#!/usr/bin/python
+
+''' Reading fasta and fastq files by records, shared by splitReads, get_long_reads, get_contig and mergeFastq.
+    Files compressed with gzip or BGZF are decompressed (gzio).
+    The file is read in large blocks and each record is sliced out of the blocks in one piece, instead of adding the lines
+    of a record to a string one at a time (quadratic for long PacBio reads). The sequence length is computed from the
+    slice, so callers do not need to split the record again.
+    Records are SeqRecord(name, seq, qual, length) tuples; in raw mode they are (text, length) pairs, where text is the
+    record as it is in the file, for tools that only pass the records through.
+'''
+import collections
+import re
+import sys
+import StringIO
+import gzio
+
+BLOCK_SIZE = 1 << 20 # bytes read at a time
+FASTA_EXTS = ["fa", "Fa", "faa", "Faa", "fna", "Fna", "fasta", "Fasta"]
+FASTQ_EXTS = ["fq", "Fq", "fastq", "Fastq"]
+
+BLANK_LINE = re.compile(r'(?:^|\n)(?:[ \t\r\f\v]*\n|[ \t\r\f\v]+\Z)') # a line with only whitespace (line.strip() == '')
+SeqRecord = collections.namedtuple('SeqRecord', ['name', 'seq', 'qual', 'length']) # name is the header line without '>' or '@', qual is None for fasta
+
+## ======================================================================
+def file_type(fileName):
+    ''' 'fasta' or 'fastq' from the extension of the file name (before .gz), None if it is neither '''
+    fileExt = fileName[:-3].split(".")[-1] if fileName.endswith('.gz') else fileName.split(".")[-1]
+    if fileExt in FASTA_EXTS:
+        return "fasta"
+    elif fileExt in FASTQ_EXTS:
+        return "fastq"
+    return None
+## ======================================================================
+def _blocks(handle, block_size):
+    ''' Generator of the blocks of an open file '''
+    block = handle.read(block_size)
+    while block:
+        yield block
+        block = handle.read(block_size)
+## ======================================================================
+def _fasta_texts(handle, block_size):
+    ''' Generator of the text of each fasta record, from '>' to the newline before the next '>' '''
+    pending = [] # pieces of the record that continues into the next block
+    for block in _blocks(handle, block_size):
+        start = 0
+        if block[0] == '>' and len(pending) > 0 and pending[-1][-1] == '\n': # record boundary between the blocks
+            text = ''.join(pending)
+            if text.strip() != '':
+                yield text
+            pending = []
+        end = block.find('\n>')
+        while end >= 0:
+            pending.append(block[start:(end + 1)])
+            text = ''.join(pending)
+            if text.strip() != '': # text before the first record
+                yield text
+            pending = []
+            start = end + 1
+            end = block.find('\n>', start)
+        if start < len(block):
+            pending.append(block[start:])
+    text = ''.join(pending)
+    if text.strip() != '':
+        yield text
+## ======================================================================
+def _fastq_texts(handle, block_size):
+    ''' Generator of the text of each fastq record, 4 lines '''
+    rest = '' # incomplete record at the end of the last block
+    for block in _blocks(handle, block_size):
+        block = rest + block if rest else block # rest is less than one record
+        start = 0
+        while True:
+            end = start
+            for i in xrange(4):
+                end = block.find('\n', end) + 1
+                if end == 0:
+                    break
+            if end == 0:
+                break
+            yield block[start:end]
+            start = end
+        rest = block[start:]
+    if rest.strip() != '': # last record without a newline at the end
+        yield rest
+## ======================================================================
+def _open(seqFile):
+    if hasattr(seqFile, 'read'):
+        return seqFile, False
+    return gzio.open_input(seqFile), True
+## ======================================================================
+def read_fasta(seqFile, raw=False, block_size=BLOCK_SIZE):
+    ''' Generator of the records of a fasta file, blank lines (and lines with only whitespace) are skipped
+        Input:  seqFile - fasta file name (possibly compressed), or an open file object (e.g. sys.stdin, gzio.InflateReader)
+                raw - yield (text, length) instead of SeqRecord
+        Output: SeqRecord(name, seq, None, length), or (text, length)
+    '''
+    handle, own_handle = _open(seqFile)
+    try:
+        for text in _fasta_texts(handle, block_size):
+            if BLANK_LINE.search(text) is not None: # blank lines, including lines with only spaces, tabs or '\r'
+                lines = text.split('\n') # lines are only split at '\n', as when a file is read line by line
+                last = lines.pop() # '' if the record ends with a newline
+                text = ''.join([line + '\n' for line in lines if line.strip() != '']) + (last if last.strip() != '' else '')
+            header_end = text.find('\n') + 1
+            if header_end == 0: # header line without sequence at the end of the file
+                header_end = len(text)
+            length = len(text) - header_end - text.count('\n', header_end)
+            if raw:
+                yield text, length
+            else:
+                yield SeqRecord(text[1:header_end].rstrip('\r\n'), text[header_end:].replace('\n', ''), None, length)
+    finally:
+        if own_handle:
+            handle.close()
+## ======================================================================
+def read_fastq(seqFile, raw=False, block_size=BLOCK_SIZE):
+    ''' Generator of the records of a fastq file, 4 lines per record
+        Input:  seqFile - fastq file name (possibly compressed), or an open file object (e.g. sys.stdin, gzio.InflateReader)
+                raw - yield (text, length) instead of SeqRecord
+        Output: SeqRecord(name, seq, qual, length), or (text, length)
+    '''
+    handle, own_handle = _open(seqFile)
+    try:
+        for text in _fastq_texts(handle, block_size):
+            header_end = text.find('\n') + 1
+            seq_end = text.find('\n', header_end)
+            length = seq_end - header_end
+            if raw:
+                yield text, length
+            else:
+                qual_start = text.find('\n', seq_end + 1) + 1
+                yield SeqRecord(text[1:(header_end - 1)], text[header_end:seq_end], text[qual_start:].rstrip('\n'), length)
+    finally:
+        if own_handle:
+            handle.close()
+## ======================================================================
+def read_seqs(seqFile, fileType, raw=False, block_size=BLOCK_SIZE):
+    ''' read_fasta or read_fastq, fileType is 'fasta' or 'fastq' '''
+    if fileType == "fasta":
+        return read_fasta(seqFile, raw, block_size)
+    elif fileType == "fastq":
+        return read_fastq(seqFile, raw, block_size)
+    raise ValueError("unknown sequence file type {}".format(fileType))
+## ======================================================================
+def read_fasta_lines(handle):
+    ''' The line by line fasta generator read_fasta replaced (getReadFromFasta of splitReads and get_long_reads), kept to check read_fasta against
+        Output: (text, length) of each record, length counted as splitReads and get_long_reads did.
+                The old generator also yielded an empty record for an empty file, which is left out here.
+    '''
+    output = ""
+    for line in handle:
+        if line.strip("\n").strip() != "":
+            if line[0] != ">":
+                output += line
+            else:
+                if output != "":
+                    yield output, sum(map(len, output.split("\n")[1:]))
+                output = line
+    if output != "":
+        yield output, sum(map(len, output.split("\n")[1:]))
+## ======================================================================
+CHECK_FASTA = ['>a\nACGT\nAC\n', '>a\nACGT\n   \nAC\n', '>a\nACGT\n\t\nAC\n', '>a\r\nACGT\r\n\r\nAC\r\n>b\r\n\r\nGG\r\n', '\n>a x\n\nAC\n \n>b\nGT\n\n',
+               '>a\nAC\n>b\n', '>a\nAC\nGT', '>a\nAC\n  ', 'junk\n>a\nAC\n', '>a\nA C\n \t \nG\rT\n>b\n>c\nT\n']
+def check_fasta(texts=CHECK_FASTA, block_sizes=(1, 2, 3, 5, 8, BLOCK_SIZE)):
+    ''' Compare read_fasta in raw mode with read_fasta_lines on fasta texts, with several block sizes so that records and lines are cut between blocks
+        Output: list of (text, block size, records of read_fasta, records of read_fasta_lines) that differ
+    '''
+    mismatches = []
+    for text in texts:
+        expected = list(read_fasta_lines(StringIO.StringIO(text)))
+        for block_size in block_sizes:
+            records = list(read_fasta(StringIO.StringIO(text), raw=True, block_size=block_size))
+            if records != expected:
+                mismatches.append((text, block_size, records, expected))
+    return mismatches
+
+##==============================================================
+## call from command line: check read_fasta against the line by line reader
+##==============================================================
+
+if __name__ == '__main__':
+    mismatches = check_fasta()
+    for text, block_size, records, expected in mismatches:
+        sys.stderr.write("read_fasta differs on {!r} with block size {}: {!r} instead of {!r}\n".format(text, block_size, records, expected))
+    sys.stderr.write("{} fasta checks failed\n".format(len(mismatches)))
+    sys.exit(1 if len(mismatches) > 0 else 0)
@@ -12,35 +12,12 @@ import argparse
 import time
 import re
 import argparse
+import seqreader
+import gzio
 
 ## =================================================================
-## Function: getRead
+## Function: getHMMFromFile (fasta/fastq records are read by seqreader)
 ## =================================================================
-def getReadFromFasta(fin):
-    output = ""
-    for line in fin:
-        if line.strip("\n").strip() != "":
-            if line[0] != ">":
-                output += line
-            else:
-                if output != "":
-                    yield output
-                output = line
-    yield output
-
-def getReadFromFastq(fin):
-    output = ""
-    count = 0
-    for line in fin:
-        if count != 4:
-            output += line
-            count = count + 1
-        else:
-            yield output
-            output = line
-            count = 1
-    yield output
-
 def getHMMFromFile(fin):
     output = ""
     length = 0
@@ -57,38 +34,37 @@ def getHMMFromFile(fin):
 ## =================================================================
 ## Function: splitReads
 ## =================================================================
-def splitReads(inputFile, prefix, count, summary, bpcount):
+def splitReads(inputFile, prefix, count, summary, bpcount, compress=False, threads=1):
     ''' Split big fasta/fastq file into smaller ones, each contains a number of reads.
-        Input:  inputFile - big file to split
+        Input:  inputFile - big file to split, can be gzip/BGZF compressed
                 count - number of reads in each small file
+                compress - write the small files compressed (BGZF, .gz)
+                threads - number of threads decompressing the input and compressing the output
                 lengthCutoff - Only save reads that are longer than this length
                 pair - If reads are interleaved in fastq file, if so, do not split a pair
-        Output: prefix_03d.fasta/q
+        Output: prefix_03d.fasta/q(.gz)
     '''
-    fileExt = inputFile.split(".")[-1] # file type, fasta or fastq, autodetect
-    if fileExt in ["fa", "Fa", "faa", "Faa", "fna", "Fna", "fasta", "Fasta"]:  # either fa or fq
-        fileType = "fasta" 
-    elif fileExt in ["fq", "Fq", "fastq", "Fastq"]:  # either fa or fq
-        fileType = "fastq" 
-    elif fileExt == "hmm":
-        fileType = "hmm"
-    else:
-        sys.stderr.write("File type is not correct...\n") 
+    fileType = seqreader.file_type(inputFile) # file type, fasta or fastq, autodetect
+    if fileType is None:
+        if inputFile.split(".")[-1] == "hmm" or inputFile.endswith(".hmm.gz"):
+            fileType = "hmm"
+        else:
+            sys.stderr.write("File type is not correct...\n") 
 
 
+    outExt = fileType + (".gz" if compress else "") # extension of the small files
     fileCount = 1
     summary.write("file_name\tmax_len\tmin_len\n")
-    outFileName = "{}{}.{}".format(prefix, fileCount, fileType)
-    fout = open(outFileName, 'w')
+    outFileName = "{}{}.{}".format(prefix, fileCount, outExt)
+    fout = gzio.open_output(outFileName, threads)
     readCount = 0
     max_read_len = 0
     min_read_len = 100000
     sys.stderr.write("number of records in each file:{}\n".format(count))
-    with open(inputFile,'r') as fin:
+    with gzio.open_input(inputFile, threads) as fin:
         if fileType == "fastq":
-            for readLines in getReadFromFastq(fin):
+            for readLines, seq_len in seqreader.read_fastq(fin, raw=True):
                 fout.write(readLines)
-                seq_len = len(readLines.split("\n")[1])
                 max_read_len = max_read_len if max_read_len > seq_len else seq_len
                 min_read_len = min_read_len if min_read_len < seq_len else seq_len
                 readCount = readCount + (seq_len if bpcount else 1)
@@ -98,13 +74,12 @@ def splitReads(inputFile, prefix, count, summary, bpcount):
                     max_read_len = 0
                     min_read_len = 100000
                     fileCount = fileCount + 1
-                    outFileName = "{}{}.{}".format(prefix, fileCount, fileType)
-                    fout = open(outFileName, 'w')
+                    outFileName = "{}{}.{}".format(prefix, fileCount, outExt)
+                    fout = gzio.open_output(outFileName, threads)
                     readCount = 0
         elif fileType == "fasta":
-            for readLines in getReadFromFasta(fin):
+            for readLines, seq_len in seqreader.read_fasta(fin, raw=True):
                 fout.write(readLines)
-                seq_len = sum(map(len, readLines.split("\n")[1:]))
                 max_read_len = max_read_len if max_read_len > seq_len else seq_len
                 min_read_len = min_read_len if min_read_len < seq_len else seq_len
                 readCount = readCount + (seq_len if bpcount else 1)
@@ -114,8 +89,8 @@ def splitReads(inputFile, prefix, count, summary, bpcount):
                     max_read_len = 0
                     min_read_len = 100000
                     fileCount = fileCount + 1
-                    outFileName = "{}{}.{}".format(prefix, fileCount, fileType)
-                    fout = open(outFileName, 'w')
+                    outFileName = "{}{}.{}".format(prefix, fileCount, outExt)
+                    fout = gzio.open_output(outFileName, threads)
                     readCount = 0
         elif fileType == "hmm":
             for readLines,hmm_len in getHMMFromFile(fin):
@@ -129,8 +104,8 @@ def splitReads(inputFile, prefix, count, summary, bpcount):
                     max_read_len = 0
                     min_read_len = 100000
                     fileCount = fileCount + 1
-                    outFileName = "{}{}.{}".format(prefix, fileCount, fileType)
-                    fout = open(outFileName, 'w')
+                    outFileName = "{}{}.{}".format(prefix, fileCount, outExt)
+                    fout = gzio.open_output(outFileName, threads)
                     readCount = 0
     fout.close()
     if readCount > 0:
@@ -163,6 +138,8 @@ parser.add_argument("-c", "--count", help="number of sequences per file", dest='
 #parser.add_argument("-l", "--length", help="length cutoff for the sequences", dest='lengthCutoff', required=False, default=1, type=int)
 parser.add_argument("-v","--verbose",help="verbose, more output",action='store_true',dest='verbose')
 parser.add_argument("-bp","--bpcount",help="instead of equal number of sequences, do equal number of bps/aas/residues",action='store_true',dest='bpcount')
+parser.add_argument("-z","--gzip",help="write the small files compressed (BGZF, .gz)",action='store_true',dest='compress')
+parser.add_argument("-t","--threads",help="number of threads for decompressing the input and compressing the output",dest='threads',default=1,type=int)
 ## =================================================================
 ## main function
 ## =================================================================
@@ -185,9 +162,9 @@ def main(argv=None):
     sys.stderr.write("\n===========================================================\n")
     start_time = time.time()
 
-    splitReads(args.seqFile, args.outputPrefix, args.seqCount, args.summary, args.bpcount)
+    splitReads(args.seqFile, args.outputPrefix, args.seqCount, args.summary, args.bpcount, args.compress, args.threads)
     #with open(args.seqFile, 'r') as fin:
-    #    for a in getReadFromFastq(fin):
+    #    for a in seqreader.read_fastq(fin, raw=True):
     #        sys.stdout.write(">>>>\n{}".format(a))
 
     sys.stderr.write("total time :" + str(time.time() - start_time) +  " seconds")